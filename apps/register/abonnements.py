@@ -1,10 +1,82 @@
+from __future__ import annotations
+
+import copy
 import datetime
 import sqlite3
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Dict, List, NamedTuple, Tuple
 
 from dateutil.relativedelta import relativedelta
 
+CLIENT_COLUMNS = "id, first_name, last_name, reduced, email, phone, date_of_birth, sex, street_name, street_number, " \
+                 "city_zip, city_name, country"
+ABONNEMENT_COLUMNS = "id, client_id, abo_type, include_gear, buy_date, end_date, entrances_remaining"
+CLIENT_UPDATE_QUERY = "UPDATE client SET first_name=?, last_name=?, reduced=?, email=?, phone=?, date_of_birth=?, " \
+                      "sex=?, street_name=?, street_number=?, city_zip=?, city_name=?, country=?, first_name_norm=?, " \
+                      "last_name_norm=? WHERE id=?"
+ABONNEMENT_UPDATE_QUERY = "UPDATE abonnement SET client_id=?, abo_type=?, include_gear=?, buy_date=?, end_date=?, " \
+                          "entrances_remaining=? WHERE id=?"
+ABONNEMENT_END_DATE_UPDATE_QUERY = "UPDATE abonnement SET end_date=? WHERE id=?"
+ABONNEMENT_CHECK_IN_QUERY = "UPDATE abonnement SET entrances_remaining = entrances_remaining - ? " \
+                            "WHERE id = ? AND entrances_remaining >= ?"
+ENTRANCE_INSERT_QUERY = "INSERT INTO entrance(client_id, abonnement_id, timestamp, day, hour, weekday, till) " \
+                        "VALUES(?, ?, ?, ?, ?, ?, ?)"
+# How long a transaction waits for the writes of the write-behind queue to be written before it gives up
+QUEUED_WRITES_TIMEOUT = 0.5
+# How often the read replica is checked for changes made by other tills, in seconds
+REPLICA_REFRESH_INTERVAL = 15.
+# Typed before a member number at the check-in desk, so that a member number is never mistaken for a card's code
+MEMBER_NUMBER_PREFIX = "#"
+CLIENT_ABONNEMENT_COLUMNS = ", ".join(["c." + column for column in CLIENT_COLUMNS.split(", ")] +
+                                      ["a." + column for column in ABONNEMENT_COLUMNS.split(", ")])
+
+
+def normalize_name(name: str) -> str:
+    """ Converts a name to the form in which it is searched: lower case and without accents, so that 'Jérémy' and
+    'jeremy' are the same. """
+    name = name.strip().lower()
+    if name.isascii():
+        return name
+    decomposed = unicodedata.normalize("NFKD", name)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def get_trigrams(text: str) -> set:
+    """ Get the set of trigrams of a normalized text. Every word is padded so that its beginning and end also count. """
+    trigrams = set()
+    for word in text.split():
+        padded = "  " + word + " "
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def get_trigram_similarity(query_trigrams: set, text: str) -> Tuple[float, float]:
+    """ Get how well a normalized text matches the trigrams of a normalized query as the share of the query's trigrams
+    which are found in the text, and, to break ties between equally good matches, the share of the trigrams which both
+    have in common. """
+    text_trigrams = get_trigrams(text)
+    if len(query_trigrams) == 0 or len(text_trigrams) == 0:
+        return 0., 0.
+    common = len(query_trigrams & text_trigrams)
+    return common / len(query_trigrams), common / len(query_trigrams | text_trigrams)
+
+
+def locked(method: Callable) -> Callable:
+    """ Makes a method of the db interfacer hold the interfacer's lock while it runs, so that the statements it runs on
+    the shared connection, and the rows it reads, are never interleaved with another thread's. """
+    @wraps(method)
+    def locked_method(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked_method
+
 
 class BMCClient:
     """ The BMCCLient class is used to represent a client. Clients can be read from, and written to our database using
@@ -115,187 +187,808 @@ class BMCAbonnement:
         return msg
 
 
+class BMCClientName(NamedTuple):
+    """ The BMCClientName is the light representation of a client which is shown while searching. The client's full
+    data is only read from the database once the client is selected. """
+    db_id: int
+    first_name: str
+    last_name: str
+
+
+class BMCClientRow:
+    """ The BMCClientRow is a read-only view on a client's row as it was read from the database, which is what client
+    searches return. It only holds the row's tuple, and a field is converted when it is accessed, so that showing a
+    list of matches costs next to nothing. The full client object, with its input formatting and date parsing, is only
+    made by to_client, e.g. for the client which is selected. """
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields: Tuple):
+        self.fields = fields
+
+    @property
+    def db_id(self) -> int:
+        return self.fields[0]
+
+    @property
+    def first_name(self) -> str:
+        return self.fields[1]
+
+    @property
+    def last_name(self) -> str:
+        return self.fields[2]
+
+    @property
+    def email(self) -> str or None:
+        return self.fields[4]
+
+    @property
+    def phone(self) -> str or None:
+        return self.fields[5]
+
+    @property
+    def date_of_birth(self) -> datetime.date or None:
+        if self.fields[6] is None:
+            return None
+        return datetime.datetime.strptime(self.fields[6], "%Y-%m-%d").date()
+
+    def to_client_name(self) -> BMCClientName:
+        return BMCClientName(self.fields[0], self.fields[1], self.fields[2])
+
+    def to_client(self) -> BMCClient:
+        """ Get the full client object of the row. """
+        return BMCAboDBInterfacer.convert_sql_client_to_python_client(self.fields)
+
+    def __repr__(self):
+        return "BMCClientRow({}, {}, {})".format(self.fields[0], self.fields[1], self.fields[2])
+
+
 class BMCAboDBInterfacer:
     """ The BMCAbonnement class is used to represent an abonnement. These can be read from, and written to our
     database using the db interface class. """
 
-    def __init__(self, path_to_db: Path or str):
-        """ Interface class to bridge python to the abonnements sqlite database. """
+    def __init__(self, path_to_db: Path or str, wal: bool = False):
+        """ Interface class to bridge python to the abonnements sqlite database. The interfacer owns one connection to
+        the db which is opened on first use and kept open until the interfacer is closed, so that searches and
+        check-ins do not pay for opening the db over and over again. Opening the db never changes its schema, which is
+        upgraded by scripts/migrate_db.py, see upgrade_schema.
+
+        With wal, the db is switched to WAL mode, which lets reads go on while another connection writes. WAL mode
+        persists in the db's file and needs shared memory, so it is only safe for a db on a local disk, and never for
+        one in a synced folder such as Dropbox.
+
+        The connection is used by the client search's worker thread as well as by the GUI thread. Every read and every
+        transaction holds the interfacer's lock, so that no two threads ever use the connection, or the read replica's,
+        at once.
+
+        When a write-behind queue is set, updates of clients and abonnements are handed to it instead of being written
+        right away. The queued writes are written before any transaction, so that all writes reach the db in order.
+
+        Once a read replica is loaded, reads which are not part of a transaction are served from it, and every write is
+        mirrored to it once it is committed: the writes of a transaction when the transaction commits, and the queued
+        writes when the queue has written them. The replica is loaded again when other tills changed the db, and in the
+        meantime clients and their abonnements are read from the db itself.
+        """
         self.path_to_db = path_to_db
+        self.wal = wal
+        self.lock = threading.RLock()
+        self._connection = None
+        self._transaction_depth = 0
+        self._transaction_thread = None
+        self.fuzzy_search_available = False
+        self.write_queue = None
+        self.replica = None
+        self._transaction_mirrors = []
+        self._data_version = None
+        self.change_count = 0
+        self._replica_change_count = None
+        self._replica_checked_at = 0.
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        with self.lock:
+            if self._connection is None:
+                # Autocommit mode: reads never hold a transaction open, and writes are grouped in explicit transactions
+                self._connection = sqlite3.connect(str(self.path_to_db), isolation_level=None,
+                                                   check_same_thread=False)
+                if self.wal:
+                    self._connection.execute("PRAGMA journal_mode=WAL")
+                    self._connection.execute("PRAGMA synchronous=NORMAL")
+                self._connection.execute("PRAGMA cache_size=-8000")
+                self._connection.execute("PRAGMA temp_store=MEMORY")
+                self.fuzzy_search_available = self.open_search_index()
+            return self._connection
+
+    def open_search_index(self) -> bool:
+        """ Prepares the connection for fuzzy searches, which need the full text index of the clients' trigrams, and
+        returns whether they are available: the index only exists once it is created by upgrade_schema, and can only be
+        used when the sqlite library has the FTS5 extension and its trigram tokenizer. The vocabulary of the index, from
+        which the rarest trigrams are picked, is a temporary table of the connection. """
+        connection = self.connection
+        if connection.execute("SELECT 1 FROM sqlite_master "
+                              "WHERE type = 'table' AND name = 'client_search'").fetchone() is None:
+            return False
+        try:
+            connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.client_search_vocab "
+                               "USING fts5vocab(main, client_search, 'row')")
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    def upgrade_schema(self, search_index: bool = False) -> None:
+        """ Adds the columns, indexes, views and tables which the register needs to a db which does not have them yet.
+        This is done by scripts/migrate_db.py while no till is open, and never when a till opens the db, as the changes
+        lock the whole db and persist in its file. The full text index of fuzzy searches is only added with
+        search_index, see create_search_index. """
+        self.create_search_columns()
+        if search_index:
+            self.create_search_index()
+        self.create_validity_view()
+        self.create_card_code_column()
+        self.create_entrance_table()
+        self.fuzzy_search_available = self.open_search_index()
+
+    def create_search_columns(self) -> None:
+        """ Clients are searched on normalized copies of their names, which can be indexed. The columns are added to
+        databases which do not have them yet, and filled in for clients which were added without them. """
+        connection = self.connection
+        # The columns are looked up within the transaction, so that they are never added twice
+        with self.transaction():
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(client)")]
+            if "first_name_norm" not in columns:
+                connection.execute("ALTER TABLE client ADD COLUMN first_name_norm TEXT")
+            if "last_name_norm" not in columns:
+                connection.execute("ALTER TABLE client ADD COLUMN last_name_norm TEXT")
+            missing = connection.execute("SELECT id, first_name, last_name FROM client "
+                                         "WHERE first_name_norm IS NULL OR last_name_norm IS NULL").fetchall()
+            connection.executemany("UPDATE client SET first_name_norm=?, last_name_norm=? WHERE id=?",
+                                   [(normalize_name(first_name), normalize_name(last_name), client_id)
+                                    for client_id, first_name, last_name in missing])
+            connection.execute("CREATE INDEX IF NOT EXISTS client_first_name_norm "
+                               "ON client(first_name_norm, last_name_norm)")
+            connection.execute("CREATE INDEX IF NOT EXISTS client_last_name_norm "
+                               "ON client(last_name_norm, first_name_norm)")
+
+    def create_validity_view(self) -> None:
+        """ The rules which make an abonnement valid, i.e. entrances left on a C10S or an end date which has not passed
+        yet on a 3M, are written as the valid_abonnement view, so that members can be looked up without loading all
+        abonnements. The indexes let sqlite answer the view from the matching abonnements only. """
+        with self.transaction() as connection:
+            connection.execute("CREATE INDEX IF NOT EXISTS abonnement_client_id ON abonnement(client_id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS abonnement_type_end_date ON abonnement(abo_type, end_date)")
+            connection.execute("CREATE INDEX IF NOT EXISTS abonnement_type_entrances_remaining "
+                               "ON abonnement(abo_type, entrances_remaining)")
+            connection.execute("CREATE VIEW IF NOT EXISTS valid_abonnement AS "
+                               "SELECT * FROM abonnement "
+                               "WHERE (abo_type = 'C10S' AND entrances_remaining > 0) "
+                               "OR (abo_type = '3M' AND end_date >= date('now', 'localtime'))")
+
+    def create_card_code_column(self) -> None:
+        """ Members can check in with the code of their membership card, typed or scanned at the desk. The column and
+        its unique index are added to databases which do not have them yet. Clients without a card have no code. """
+        connection = self.connection
+        with self.transaction():
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(client)")]
+            if "card_code" not in columns:
+                connection.execute("ALTER TABLE client ADD COLUMN card_code TEXT")
+            connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS client_card_code ON client(card_code)")
+
+    def create_entrance_table(self) -> None:
+        """ Every entrance of a member is logged in the append-only entrance table, so that visits can be counted per
+        member, hour or weekday. The day, hour and weekday (1 is Monday) of an entrance are stored next to its
+        timestamp so that the counts can be read from the indexes alone. """
+        with self.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS entrance (id INTEGER PRIMARY KEY, "
+                               "client_id INTEGER NOT NULL, abonnement_id INTEGER, timestamp TEXT NOT NULL, "
+                               "day TEXT NOT NULL, hour INTEGER NOT NULL, weekday INTEGER NOT NULL, till TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entrance_client_day ON entrance(client_id, day)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entrance_hour_day ON entrance(hour, day)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entrance_weekday_day ON entrance(weekday, day)")
+
+    def create_search_index(self) -> None:
+        """ Fuzzy searches use a full text index of the clients' trigrams, which is kept in sync with the client table
+        by triggers. The index is created and filled for databases which do not have it yet. An sqlite3.OperationalError
+        is raised when the sqlite library lacks the FTS5 extension or its trigram tokenizer. Once the index exists,
+        clients can no longer be written with such a library, as the triggers fail. """
+        with self.transaction() as connection:
+            exists = connection.execute("SELECT 1 FROM sqlite_master "
+                                        "WHERE type = 'table' AND name = 'client_search'").fetchone() is not None
+            if not exists:
+                connection.execute("CREATE VIRTUAL TABLE client_search USING fts5("
+                                   "first_name_norm, last_name_norm, email, phone, "
+                                   "content='client', content_rowid='id', tokenize='trigram')")
+                connection.execute("CREATE TRIGGER client_search_insert AFTER INSERT ON client BEGIN "
+                                   "INSERT INTO client_search(rowid, first_name_norm, last_name_norm, email, phone) "
+                                   "VALUES (new.id, new.first_name_norm, new.last_name_norm, new.email, new.phone); "
+                                   "END")
+                connection.execute("CREATE TRIGGER client_search_delete AFTER DELETE ON client BEGIN "
+                                   "INSERT INTO client_search(client_search, rowid, first_name_norm, last_name_norm, "
+                                   "email, phone) VALUES ('delete', old.id, old.first_name_norm, "
+                                   "old.last_name_norm, old.email, old.phone); "
+                                   "END")
+                connection.execute("CREATE TRIGGER client_search_update AFTER UPDATE ON client BEGIN "
+                                   "INSERT INTO client_search(client_search, rowid, first_name_norm, last_name_norm, "
+                                   "email, phone) VALUES ('delete', old.id, old.first_name_norm, "
+                                   "old.last_name_norm, old.email, old.phone); "
+                                   "INSERT INTO client_search(rowid, first_name_norm, last_name_norm, email, phone) "
+                                   "VALUES (new.id, new.first_name_norm, new.last_name_norm, new.email, new.phone); "
+                                   "END")
+                connection.execute("INSERT INTO client_search(client_search) VALUES ('rebuild')")
+
+    @property
+    def read_connection(self) -> sqlite3.Connection:
+        """ The connection to read from: the read replica's once it is ready, except within a transaction, which must
+        read what it writes. """
+        if self.replica is not None and self._transaction_depth == 0:
+            self.refresh_replica()
+            if self.replica.connection is not None:
+                return self.replica.connection
+        return self.connection
+
+    def get_read_connections(self) -> List[sqlite3.Connection]:
+        """ Get the connections to read a client from, in order: the read replica's, when reads are served from it and
+        the db was not changed by another till since the replica was loaded, nor is being loaded again, and the db's. A
+        read which finds no row in the replica is done again on the db all the same. """
+        read_connection = self.read_connection
+        if read_connection is self.connection or self.replica.is_loading or \
+                self.get_change_count() != self._replica_change_count:
+            return [self.connection]
+        return [read_connection, self.connection]
+
+    def start_replica(self) -> None:
+        """ Starts loading the in-memory read replica of the db in the background. """
+        # Imported here so that the module can be imported as apps.register.abonnements as well, e.g. by the scripts
+        from replica import BMCReadReplica
+        self.replica = BMCReadReplica(self.path_to_db, self.lock)
+        self.load_replica()
+
+    def load_replica(self) -> None:
+        """ Loads the read replica, again if it is loaded already, in the background. """
+        self._replica_change_count = self.get_change_count()
+        self._replica_checked_at = time.monotonic()
+        setup_statements = ["CREATE VIRTUAL TABLE IF NOT EXISTS temp.client_search_vocab "
+                            "USING fts5vocab(main, client_search, 'row')"] if self.fuzzy_search_available else []
+        self.replica.start(setup_statements)
+
+    def refresh_replica(self) -> None:
+        """ Loads the read replica again when the db was changed by another till since it was loaded, or when it was
+        dropped. This is checked at most every REPLICA_REFRESH_INTERVAL seconds, as every load copies the whole db. """
+        if self.replica.is_loading or time.monotonic() - self._replica_checked_at < REPLICA_REFRESH_INTERVAL:
+            return
+        self._replica_checked_at = time.monotonic()
+        if not self.replica.is_ready or self.get_change_count() != self._replica_change_count:
+            self.load_replica()
+
+    def set_write_queue(self, write_queue) -> None:
+        """ Hands the updates of clients and abonnements to a write-behind queue from now on. The writes which the queue
+        commits to the db are mirrored to the read replica. """
+        self.write_queue = write_queue
+        write_queue.add_listener(self.path_to_db, self)
+
+    def mirror(self, statement: str, params: Tuple or List[Tuple] = (), many: bool = False) -> None:
+        """ Applies a committed write to the read replica as well, if there is one. A write which is part of a
+        transaction is only applied once the transaction commits, and dropped if it is rolled back. """
+        with self.lock:
+            if self._transaction_depth > 0:
+                self._transaction_mirrors.append((statement, params, many))
+            elif self.replica is not None:
+                self.replica.mirror(statement, params, many)
+
+    def before_queued_writes(self) -> None:
+        """ Called by the write-behind queue before it writes a batch, so that the changes which other tills made until
+        then are counted before the queue's own commits are, see after_queued_writes. """
+        self.get_change_count()
+
+    def after_queued_writes(self, writes: List[Tuple[str, Tuple]], others_committed: bool) -> None:
+        """ Called by the write-behind queue once it committed a batch of writes, which are mirrored to the read
+        replica. The queue's commits change the db's data version too, but are no changes of other tills, so the new
+        version is taken as it is, unless the queue found that another connection committed in the meantime. """
+        with self.lock:
+            self._data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+            if others_committed:
+                self.change_count += 1
+            for statement, params in writes:
+                self.mirror(statement, params)
+
+    def mirror_new_rows(self, table: str, after_id: int) -> None:
+        """ Copies the rows of a table which were added after the row with the given id to the read replica. """
+        if self.replica is not None:
+            rows = self.connection.execute("SELECT * FROM {} WHERE id > ? ORDER BY id".format(table),
+                                           (after_id,)).fetchall()
+            if len(rows) > 0:
+                self.mirror("INSERT INTO {} VALUES({})".format(table, ", ".join("?" * len(rows[0]))), rows, many=True)
+
+    @locked
+    def get_max_id(self, table: str) -> int:
+        return self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM {}".format(table)).fetchone()[0]
+
+    def get_change_count(self) -> int:
+        """ Get how many times the db was found to be changed by another till since the interfacer was made. This relies
+        on sqlite's data version of the db, which changes whenever another connection commits a change to it, and
+        leaves out the commits of the write-behind queue. """
+        with self.lock:
+            data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+            if self._data_version is not None and data_version != self._data_version:
+                self.change_count += 1
+            self._data_version = data_version
+            return self.change_count
 
     def connect_to_db(self) -> sqlite3.Connection:
-        """ Open the connection to the db. """
-        return sqlite3.connect(self.path_to_db)
+        """ Get the connection to the db. """
+        return self.connection
+
+    @contextmanager
+    def transaction(self) -> sqlite3.Connection:
+        """ Runs the statements of a with block in one transaction which is committed at the end of the block, or rolled
+        back when the block raises. Transactions can be nested, in which case only the outermost one commits. The
+        outermost one first waits for the queued writes, see wait_for_queued_writes. """
+        if self._transaction_thread != threading.get_ident():
+            self.wait_for_queued_writes()
+        with self.lock:
+            connection = self.connection
+            if self._transaction_depth == 0:
+                connection.execute("BEGIN IMMEDIATE")
+                self._transaction_thread = threading.get_ident()
+            self._transaction_depth += 1
+            try:
+                yield connection
+            except BaseException:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self._transaction_thread = None
+                    self._transaction_mirrors = []
+                    connection.execute("ROLLBACK")
+                raise
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self._transaction_thread = None
+                mirrors, self._transaction_mirrors = self._transaction_mirrors, []
+                try:
+                    connection.execute("COMMIT")
+                except sqlite3.Error:
+                    if connection.in_transaction:
+                        connection.execute("ROLLBACK")
+                    raise
+                for statement, params, many in mirrors:
+                    self.mirror(statement, params, many)
+
+    def wait_for_queued_writes(self) -> None:
+        """ Waits until the writes of the write-behind queue, if any, are written to the db. The interfacer's lock is
+        not held meanwhile, so that searches go on, and the till is never blocked for more than QUEUED_WRITES_TIMEOUT
+        seconds: when the db is too busy for the writes to be done by then, an sqlite3.OperationalError is raised and
+        the transaction is not started. """
+        if self.write_queue is None or self.write_queue.pending_count == 0:
+            return
+        if not self.write_queue.flush(timeout=QUEUED_WRITES_TIMEOUT):
+            raise sqlite3.OperationalError("database is locked: {} queued writes are still waiting to be "
+                                           "written".format(self.write_queue.pending_count))
+
+    def close(self) -> None:
+        """ Closes the connection to the db, and drops the read replica. The connection is opened again when the db is
+        used again. """
+        if self.replica is not None:
+            self.replica.close()
+            self.replica = None
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
 
     # Create
-    def create_client(self, client: BMCClient) -> None:
-        """ Create a new client entry in the database. """
-        with self.connect_to_db() as connection:
+    def create_client(self, client: BMCClient) -> int:
+        """ Create a new client entry in the database, and return its db id. """
+        with self.transaction() as connection:
             cursor = connection.cursor()
-            cursor.execute("INSERT INTO client VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                           (None,
-                            client.first_name,
-                            client.last_name,
-                            client.reduced_price,
-                            client.email,
-                            client.phone,
-                            client.date_of_birth,
-                            client.sex,
-                            client.street_name,
-                            client.street_number,
-                            client.city_zip,
-                            client.city_name, client.country))
-
-    def create_abonnement(self, abonnement: BMCAbonnement) -> None:
-        """ Create a new abonnement in the database. """
-        with self.connect_to_db() as connection:
-            owner_id = self.get_client_id(abonnement.owner)
+            cursor.execute("INSERT INTO client(" + CLIENT_COLUMNS + ", first_name_norm, last_name_norm) "
+                           "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.get_client_values(client))
+            self.mirror_new_rows("client", cursor.lastrowid - 1)
+            return cursor.lastrowid
+
+    def create_clients(self, clients: List[BMCClient]) -> Dict[Tuple[str, str], int]:
+        """ Create many new client entries in the database at once, in a single transaction: either all clients are
+        created or none are. Returns the map of every client's (first name, last name) to its db id. """
+        with self.transaction() as connection:
+            max_id = self.get_max_id("client")
+            connection.executemany("INSERT INTO client(" + CLIENT_COLUMNS + ", first_name_norm, last_name_norm) "
+                                   "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (self.get_client_values(client) for client in clients))
+            self.mirror_new_rows("client", max_id)
+            return self.get_client_ids()
+
+    def create_abonnement(self, abonnement: BMCAbonnement) -> int:
+        """ Create a new abonnement in the database, and return its db id. """
+        with self.transaction() as connection:
+            owner_id = abonnement.owner.db_id if abonnement.owner.db_id is not None else \
+                self.get_client_id(abonnement.owner)
             cursor = connection.cursor()
             cursor.execute("INSERT INTO abonnement VALUES(?, ?, ?, ?, ?, ?, ?)",
-                           (None,
-                            owner_id,
-                            abonnement.abo_type,
-                            abonnement.include_gear,
-                            abonnement.buy_date,
-                            abonnement.end_date,
-                            abonnement.entrances_remaining))
+                           self.get_abonnement_values(abonnement, owner_id))
+            self.mirror_new_rows("abonnement", cursor.lastrowid - 1)
+            return cursor.lastrowid
+
+    def create_entrances(self, abonnement: BMCAbonnement, num_entrances: int, till: str = None) -> None:
+        """ Logs num_entrances entrances, at the current time, of the owner of an abonnement. Entrances are logged in
+        the transaction of the check-in they belong to. """
+        now = datetime.datetime.now().replace(microsecond=0)
+        params = [(abonnement.owner.db_id, abonnement.db_id, now.isoformat(sep=" "), now.date().isoformat(), now.hour,
+                   now.isoweekday(), till)] * num_entrances
+        with self.transaction() as connection:
+            connection.executemany(ENTRANCE_INSERT_QUERY, params)
+            self.mirror(ENTRANCE_INSERT_QUERY, params, many=True)
+
+    def create_abonnements(self, abonnements: List[BMCAbonnement],
+                           client_ids: Dict[Tuple[str, str], int] = None) -> None:
+        """ Create many new abonnements in the database at once, in a single transaction: either all abonnements are
+        created or none are. Owners without a db id are looked up by name in client_ids, as returned by create_clients,
+        or in a map of all clients which is read once if client_ids is not provided. """
+        with self.transaction() as connection:
+            max_id = self.get_max_id("abonnement")
+            if client_ids is None and any(abonnement.owner.db_id is None for abonnement in abonnements):
+                client_ids = self.get_client_ids()
+            values = []
+            for abonnement in abonnements:
+                owner = abonnement.owner
+                owner_id = owner.db_id if owner.db_id is not None else client_ids.get((owner.first_name,
+                                                                                      owner.last_name))
+                if owner_id is None:
+                    raise ValueError("Client {} {} does not exist".format(owner.first_name, owner.last_name))
+                values.append(self.get_abonnement_values(abonnement, owner_id))
+            connection.executemany("INSERT INTO abonnement VALUES(?, ?, ?, ?, ?, ?, ?)", values)
+            self.mirror_new_rows("abonnement", max_id)
+
+    @staticmethod
+    def get_client_values(client: BMCClient) -> Tuple:
+        """ Get the values of a new client's row in the order of the client columns, followed by its normalized
+        names. """
+        return (None,
+                client.first_name,
+                client.last_name,
+                client.reduced_price,
+                client.email,
+                client.phone,
+                client.date_of_birth,
+                client.sex,
+                client.street_name,
+                client.street_number,
+                client.city_zip,
+                client.city_name, client.country,
+                normalize_name(client.first_name),
+                normalize_name(client.last_name))
+
+    @staticmethod
+    def get_abonnement_values(abonnement: BMCAbonnement, owner_id: int) -> Tuple:
+        """ Get the values of a new abonnement's row in the order of the abonnement columns. """
+        return (None,
+                owner_id,
+                abonnement.abo_type,
+                abonnement.include_gear,
+                abonnement.buy_date,
+                abonnement.end_date,
+                abonnement.entrances_remaining)
 
     # Read
+    @locked
     def find_client_from_id(self, client_id: int) -> BMCClient or None:
         """ Query the database to find a client whose (unique) client_id matches the provided client_id. """
-        with self.connect_to_db() as connection:
+        for connection in self.get_read_connections():
             # Execute the query and convert results to python objects
             cursor = connection.cursor()
             cursor.execute("SELECT * FROM client WHERE ID == ?", (client_id,))
             sql_clients = cursor.fetchall()
-            if len(sql_clients) == 0:
-                return None
-            elif len(sql_clients) == 1:
-                return self.convert_sql_client_to_python_client(sql_clients[0])
-            else:
-                raise IOError("Found multiple matches for given first_name last_name combination")
+            if len(sql_clients) > 0:
+                break
+        if len(sql_clients) == 0:
+            return None
+        elif len(sql_clients) == 1:
+            return self.convert_sql_client_to_python_client(sql_clients[0])
+        else:
+            raise IOError("Found multiple matches for given first_name last_name combination")
 
+    @locked
     def find_client_from_name(self, first_name: str, last_name: str) -> BMCClient or None:
         """ The first_name last_name combination is unique by design in the database. Searches the matching client
         provided a first_name and a last_name. """
-        with self.connect_to_db() as connection:
-            querry = ("SELECT * FROM client "
-                      "WHERE first_name == '" + first_name + "' AND " 
-                      "last_name == '" + last_name + "'")
+        connection = self.read_connection
+        querry = ("SELECT * FROM client "
+                  "WHERE first_name == '" + first_name + "' AND " 
+                  "last_name == '" + last_name + "'")
 
-            # Execute the query and convert results to python objects
-            cursor = connection.cursor()
-            cursor.execute(querry)
-            sql_clients = cursor.fetchall()
-            if len(sql_clients) == 0:
-                return None
-            elif len(sql_clients) == 1:
-                return self.convert_sql_client_to_python_client(sql_clients[0])
-            else:
-                raise IOError("Found multiple matches for given first_name last_name combination")
-
-    def find_clients_from_namepart(self, name_part: str, first_or_last: str) -> List[BMCClient]:
-        """ Query the database to find clients whose names match the provided pattern. Possible to query on
-         first name or on last name by setting 'first_or_last' to respectively 'first' or 'last'. Results are returned
-         in alphabetical order. """
-        with self.connect_to_db() as connection:
-            # Determine whether to query on first name or last name
-            if first_or_last == "first":
-                querry = ("SELECT * FROM client "
-                          "WHERE first_name LIKE '" + name_part + "%' "
-                          "ORDER BY first_name ASC, last_name ASC")
-            elif first_or_last == "last":
-                querry = ("SELECT * FROM client "
-                          "WHERE last_name LIKE '" + name_part + "%' "
-                          "ORDER BY last_name ASC, first_name ASC")
-            else:
-                raise ValueError("first_or_last must be either 'first' or 'last'")
+        # Execute the query and convert results to python objects
+        cursor = connection.cursor()
+        cursor.execute(querry)
+        sql_clients = cursor.fetchall()
+        if len(sql_clients) == 0:
+            return None
+        elif len(sql_clients) == 1:
+            return self.convert_sql_client_to_python_client(sql_clients[0])
+        else:
+            raise IOError("Found multiple matches for given first_name last_name combination")
 
-            # Execute the query and convert results to python objects
-            cursor = connection.cursor()
-            cursor.execute(querry)
-            sql_clients = cursor.fetchall()
-            python_clients = []
-            for sql_client in sql_clients:
-                python_clients.append(self.convert_sql_client_to_python_client(sql_client))
+    @locked
+    def find_clients_from_fuzzy_name(self, name_part: str, limit: int = 50, min_similarity: float = 0.5,
+                                     max_candidate_rows: int = 1500) -> List[BMCClientRow]:
+        """ Query the database to find clients whose name, email or phone number resembles the provided name part,
+        ignoring case and accents, e.g. 'lombar' finds 'LOMBAERTS' and 'jeremy' finds 'Jérémy'. The full text index
+        returns the candidates which share the most trigrams with the name part, after which these are ranked on how
+        many of the name part's trigrams they contain. At most limit clients are returned, best matches first.
+
+        Only the name part's rarest trigrams are looked up, as many of them as fit in max_candidate_rows index rows (but
+        at least one), which keeps the search fast on large databases where some trigrams occur in most names. """
+        query = normalize_name(name_part)
+        if not self.fuzzy_search_available or len(query) < 3:
+            return []
+
+        trigrams = list({query[i:i + 3] for i in range(len(query) - 2)})
+        frequencies = dict(self.read_connection.execute(
+            "SELECT term, doc FROM client_search_vocab WHERE term IN ({})".format(", ".join("?" * len(trigrams))),
+            trigrams).fetchall())
+        trigrams = sorted((trigram for trigram in trigrams if trigram in frequencies), key=frequencies.get)
+        selected_trigrams, candidate_rows = [], 0
+        for trigram in trigrams:
+            if len(selected_trigrams) > 0 and candidate_rows + frequencies[trigram] > max_candidate_rows:
+                break
+            selected_trigrams.append(trigram)
+            candidate_rows += frequencies[trigram]
+        if len(selected_trigrams) == 0:
+            return []
+
+        # Every trigram is quoted so that the characters of the name part are never read as query syntax. Ranking is
+        # pointless when only one trigram is looked up, as all candidates then match equally well
+        match = " OR ".join('"{}"'.format(trigram.replace('"', '""')) for trigram in selected_trigrams)
+        candidate_ids = [row[0] for row in self.read_connection.execute(
+            "SELECT rowid FROM client_search WHERE client_search MATCH ? {}LIMIT ?".format(
+                "ORDER BY rank " if len(selected_trigrams) > 1 else ""), (match, 2 * limit))]
+        if len(candidate_ids) == 0:
+            return []
+        sql_clients = self.read_connection.execute(
+            "SELECT " + CLIENT_COLUMNS + ", first_name_norm, last_name_norm FROM client WHERE id IN ({})".format(
+                ", ".join("?" * len(candidate_ids))), candidate_ids).fetchall()
+
+        query_trigrams = get_trigrams(query)
+        ranked_clients = []
+        for sql_client in sql_clients:
+            first_name, last_name = sql_client[13] or "", sql_client[14] or ""
+            texts = [first_name + " " + last_name, last_name + " " + first_name, (sql_client[4] or "").lower(),
+                     sql_client[5] or ""]
+            similarity = max(get_trigram_similarity(query_trigrams, text) for text in texts)
+            if similarity[0] >= min_similarity:
+                ranked_clients.append((-similarity[0], -similarity[1], last_name, first_name, sql_client))
+        ranked_clients.sort(key=lambda ranked_client: ranked_client[:4])
+
+        return [BMCClientRow(ranked_client[4][:13]) for ranked_client in ranked_clients[:limit]]
 
-            return python_clients
+    @locked
+    def find_client_names(self, after_id: int = 0) -> List[BMCClientName]:
+        """ Get the id and name of all clients, or only of the clients added after the client with the given id. """
+        # Read from the db itself rather than from the replica, which does not have the clients added by other tills
+        return [BMCClientName(*row) for row in self.connection.execute(
+            "SELECT id, first_name, last_name FROM client WHERE id > ? ORDER BY id", (after_id,))]
 
     # Update
+    def write(self, statement: str, params: Tuple, key: str = None) -> None:
+        """ Writes one update to the db, through the write-behind queue when there is one, with the given key. The
+        update is mirrored to the read replica once it is committed. """
+        if self.write_queue is not None:
+            self.write_queue.submit(self.path_to_db, statement, params, key=key)
+            return
+        with self.transaction() as connection:
+            connection.execute(statement, params)
+            self.mirror(statement, params)
+
     def update_client(self, client: BMCClient) -> None:
         """ Updates all the information in a client entry. """
-        with self.connect_to_db() as connection:
-            cursor = connection.cursor()
-            cursor.execute("UPDATE client "
-                           "SET first_name=?,"
-                           "last_name=?,"
-                           "reduced=?,"
-                           "email=?,"
-                           "phone=?,"
-                           "date_of_birth=?,"
-                           "sex=?,"
-                           "street_name=?,"
-                           "street_number=?,"
-                           "city_zip=?,"
-                           "city_name=?, "
-                           "country=?"
-                           "WHERE id=?",
-                           (client.first_name, client.last_name, client.reduced_price, client.email, client.phone,
-                           client.date_of_birth, client.sex, client.street_name, client.street_number, client.city_zip,
-                           client.city_name, client.country, client.db_id))
+        self.write(CLIENT_UPDATE_QUERY, (client.first_name, client.last_name, client.reduced_price, client.email,
+                                         client.phone, client.date_of_birth, client.sex, client.street_name,
+                                         client.street_number, client.city_zip, client.city_name, client.country,
+                                         normalize_name(client.first_name), normalize_name(client.last_name),
+                                         client.db_id),
+                   key="client {}".format(client.db_id))
 
     def update_abonnement(self, abonnement: BMCAbonnement) -> None:
-        """ Updates all the information in a client entry. """
-        with self.connect_to_db() as connection:
-            cursor = connection.cursor()
-            cursor.execute("UPDATE abonnement "
-                           "SET client_id=?,"
-                           "abo_type=?,"
-                           "include_gear=?,"
-                           "buy_date=?,"
-                           "end_date=?,"
-                           "entrances_remaining=?"
-                           "WHERE id=?",
-                           (abonnement.owner.db_id, abonnement.abo_type, abonnement.include_gear, abonnement.buy_date,
-                            abonnement.end_date, abonnement.entrances_remaining, abonnement.db_id))
+        """ Updates all the information in an abonnement entry. """
+        self.write(ABONNEMENT_UPDATE_QUERY, (abonnement.owner.db_id, abonnement.abo_type, abonnement.include_gear,
+                                             abonnement.buy_date, abonnement.end_date, abonnement.entrances_remaining,
+                                             abonnement.db_id),
+                   key="abonnement {}".format(abonnement.db_id))
+
+    def update_abonnement_end_date(self, abonnement_id: int, end_date: datetime.date) -> None:
+        """ Sets the end date of an abonnement, and leaves its other fields as they are in the db. """
+        self.write(ABONNEMENT_END_DATE_UPDATE_QUERY, (end_date, abonnement_id),
+                   key="abonnement end date {}".format(abonnement_id))
+
+    def update_client_card_code(self, client_id: int, card_code: str or None) -> None:
+        """ Sets the code of a client's membership card, or removes it when card_code is None. Raises an
+        sqlite3.IntegrityError when the code already belongs to another client. """
+        with self.transaction() as connection:
+            connection.execute("UPDATE client SET card_code=? WHERE id=?", (card_code, client_id))
+            self.mirror("UPDATE client SET card_code=? WHERE id=?", (card_code, client_id))
+
+    def check_in_abonnements(self, check_ins: List[Tuple[BMCAbonnement, int]], till: str = None) -> None:
+        """ Checks in the owners of abonnements, given as (abonnement, num_entries), in one transaction. num_entries
+        entrances are subtracted from a C10S abonnement, but only if it has that many left in the db, otherwise a
+        ValueError is raised and nothing is changed. A 3M abonnement is left as it is. The entrances, one for a 3M
+        abonnement, are logged in the same transaction. """
+        with self.transaction() as connection:
+            for abonnement, num_entries in check_ins:
+                if abonnement.abo_type == "C10S":
+                    params = (num_entries, abonnement.db_id, num_entries)
+                    cursor = connection.execute(ABONNEMENT_CHECK_IN_QUERY, params)
+                    if cursor.rowcount == 0:
+                        raise ValueError("Abonnement {} has less than {} entrances left".format(abonnement.db_id,
+                                                                                                num_entries))
+                    self.mirror(ABONNEMENT_CHECK_IN_QUERY, params)
+                self.create_entrances(abonnement, num_entries if abonnement.abo_type == "C10S" else 1, till)
 
     # Delete
     def delete_abonnement(self, abonnement: BMCAbonnement) -> None:
         """ Deletes an abonnement. """
-        with self.connect_to_db() as connection:
+        with self.transaction() as connection:
             cursor = connection.cursor()
             cursor.execute("DELETE FROM abonnement WHERE id=?", (abonnement.db_id, ))
+            self.mirror("DELETE FROM abonnement WHERE id=?", (abonnement.db_id, ))
 
     # Helper methods
+    @locked
     def get_client_id(self, client: BMCClient) -> int or None:
         """ Get the ID of a client entry in the database based on its supposedly unique first name + last name
         combination. """
-        with self.connect_to_db() as connection:
-            cursor = connection.cursor()
-            cursor.execute("SELECT * FROM client WHERE first_name LIKE ? AND last_name LIKE ?",
-                           (client.first_name, client.last_name))
-            res = cursor.fetchall()
-            if len(res) == 1:
-                return int(res[0][0])
-            else:
+        connection = self.read_connection
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM client WHERE first_name LIKE ? AND last_name LIKE ?",
+                       (client.first_name, client.last_name))
+        res = cursor.fetchall()
+        if len(res) == 1:
+            return int(res[0][0])
+        else:
+            return None
+
+    @locked
+    def find_client_id_from_member_code(self, member_code: str) -> int or None:
+        """ Get the db id of the client whose membership card has the given code or, when the code is a member number
+        preceded by MEMBER_NUMBER_PREFIX, e.g. '#123', whose member number, i.e. db id, it is. A code without the prefix
+        is only ever looked up as a card's code. Returns None when there is no such client. """
+        member_code = member_code.strip()
+        if member_code.startswith(MEMBER_NUMBER_PREFIX):
+            member_number = member_code[len(MEMBER_NUMBER_PREFIX):].strip()
+            if not member_number.isdigit():
                 return None
+            query, params = "SELECT id FROM client WHERE id = ?", (int(member_number),)
+        else:
+            query, params = "SELECT id FROM client WHERE card_code = ?", (member_code,)
+        for connection in self.get_read_connections():
+            row = connection.execute(query, params).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    @locked
+    def find_client_card_code(self, client_id: int) -> str or None:
+        """ Get the code of a client's membership card, or None if the client has no card. """
+        row = self.read_connection.execute("SELECT card_code FROM client WHERE id = ?", (client_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    @locked
+    def get_client_ids(self) -> Dict[Tuple[str, str], int]:
+        """ Get the map of every client's (first name, last name) to its db id. """
+        return {(first_name, last_name): client_id for client_id, first_name, last_name in
+                self.read_connection.execute("SELECT id, first_name, last_name FROM client")}
 
+    @locked
     def get_client_abonnements(self, client: BMCClient) -> List[BMCAbonnement] or None:
-        """ Given a client returns all the abonnements associated with the client. """
-        with self.connect_to_db() as connection:
-            client_id = self.get_client_id(client)
-            if client_id:
-                cursor = connection.cursor()
-                cursor.execute("SELECT * FROM abonnement WHERE client_id == ?", (client_id,))
-                sql_abonnements = cursor.fetchall()
+        """ Given a client returns all the abonnements associated with the client, which all share the client as their
+        owner. The client is looked up by name only when it has no db id. """
+        client_id = client.db_id if client.db_id is not None else self.get_client_id(client)
+        if client_id:
+            for connection in self.get_read_connections():
+                cursor = connection.execute(
+                    "SELECT " + ABONNEMENT_COLUMNS + " FROM abonnement WHERE client_id == ?", (client_id,))
                 python_abonnements = []
-                for sql_abo in sql_abonnements:
-                    python_abonnements.append(self.convert_sql_abonnement_to_python_abonnement(sql_abo))
-                return python_abonnements
-            return None
+                for sql_abo in cursor:
+                    python_abonnements.append(self.convert_sql_abonnement_to_python_abonnement(sql_abo, client))
+                if len(python_abonnements) > 0:
+                    break
+            return python_abonnements
+        return None
 
-    def convert_sql_abonnement_to_python_abonnement(self, abonnement_fields: Tuple) -> BMCAbonnement:
-        """ Converts a client database table entry to a python client object. """
+    @locked
+    def find_client_with_abonnements(self, client_id: int) -> Tuple[BMCClient or None, List[BMCAbonnement]]:
+        """ Reads a client and all of the client's abonnements in one query. The abonnements all share the returned
+        client as their owner. Returns None and an empty list when there is no client with the given id. """
+        for connection in self.get_read_connections():
+            cursor = connection.execute(
+                "SELECT " + CLIENT_ABONNEMENT_COLUMNS + " FROM client c LEFT JOIN abonnement a ON a.client_id = c.id "
+                "WHERE c.id = ? ORDER BY a.id", (client_id,))
+            python_client, python_abonnements = None, []
+            for row in cursor:
+                if python_client is None:
+                    python_client = self.convert_sql_client_to_python_client(row[:13])
+                if row[13] is not None:
+                    python_abonnements.append(self.convert_sql_abonnement_to_python_abonnement(row[13:], python_client))
+            if python_client is not None:
+                break
+
+        return python_client, python_abonnements
+
+    @locked
+    def find_valid_abonnement_of_client(self, client_id: int) -> BMCAbonnement or None:
+        """ Reads a client's valid abonnement together with the client, or returns None if the client has no valid
+        abonnement. """
+        for connection in self.get_read_connections():
+            cursor = connection.execute(
+                "SELECT " + CLIENT_ABONNEMENT_COLUMNS + " FROM valid_abonnement a JOIN client c ON a.client_id = c.id "
+                "WHERE a.client_id = ?", (client_id,))
+            abonnements = self.convert_sql_client_abonnement_rows(cursor)
+            if len(abonnements) > 0:
+                break
+        if len(abonnements) > 1:
+            raise IOError("Found more than one valid abonnement for client {}".format(client_id))
+        return abonnements[0] if len(abonnements) == 1 else None
+
+    @locked
+    def count_valid_abonnements(self) -> Dict[str, int]:
+        """ Counts the valid abonnements per abonnement type. """
+        counts = {"3M": 0, "C10S": 0}
+        counts.update(self.read_connection.execute("SELECT abo_type, COUNT(*) FROM valid_abonnement GROUP BY abo_type"))
+        return counts
+
+    @locked
+    def count_visits_per_client(self, from_day: datetime.date = datetime.date.min,
+                                to_day: datetime.date = datetime.date.max) -> Dict[int, int]:
+        """ Counts the entrances of every client who came between two days, both included. """
+        return dict(self.read_connection.execute(
+            "SELECT client_id, COUNT(*) FROM entrance WHERE day >= ? AND day <= ? GROUP BY client_id",
+            (from_day.isoformat(), to_day.isoformat())))
+
+    @locked
+    def count_visits_of_client(self, client_id: int, from_day: datetime.date = datetime.date.min,
+                               to_day: datetime.date = datetime.date.max) -> int:
+        """ Counts the entrances of one client between two days, both included. """
+        return self.read_connection.execute(
+            "SELECT COUNT(*) FROM entrance WHERE client_id = ? AND day >= ? AND day <= ?",
+            (client_id, from_day.isoformat(), to_day.isoformat())).fetchone()[0]
+
+    @locked
+    def count_visits_per_hour(self, from_day: datetime.date = datetime.date.min,
+                              to_day: datetime.date = datetime.date.max) -> Dict[int, int]:
+        """ Counts the entrances between two days, both included, per hour of the day. """
+        return dict(self.read_connection.execute(
+            "SELECT hour, COUNT(*) FROM entrance WHERE day >= ? AND day <= ? GROUP BY hour",
+            (from_day.isoformat(), to_day.isoformat())))
+
+    @locked
+    def count_visits_per_weekday(self, from_day: datetime.date = datetime.date.min,
+                                 to_day: datetime.date = datetime.date.max) -> Dict[int, int]:
+        """ Counts the entrances between two days, both included, per weekday, 1 being Monday and 7 Sunday. """
+        return dict(self.read_connection.execute(
+            "SELECT weekday, COUNT(*) FROM entrance WHERE day >= ? AND day <= ? GROUP BY weekday",
+            (from_day.isoformat(), to_day.isoformat())))
+
+    @locked
+    def find_expiring_abonnements(self, days: int) -> List[BMCAbonnement]:
+        """ Reads the 3M abonnements which are still valid but end within the given number of days, together with their
+        owners, the first one to expire first. """
+        today = datetime.date.today()
+        cursor = self.read_connection.execute(
+            "SELECT " + CLIENT_ABONNEMENT_COLUMNS + " FROM abonnement a JOIN client c ON a.client_id = c.id "
+            "WHERE a.abo_type = '3M' AND a.end_date >= ? AND a.end_date <= ? ORDER BY a.end_date, c.id",
+            (today.isoformat(), (today + datetime.timedelta(days=days)).isoformat()))
+        return self.convert_sql_client_abonnement_rows(cursor)
+
+    def convert_sql_client_abonnement_rows(self, rows) -> List[BMCAbonnement]:
+        """ Converts the rows of a query on CLIENT_ABONNEMENT_COLUMNS to python abonnement objects. Rows of the same
+        client share one owner object. """
+        python_clients, python_abonnements = dict(), []
+        for row in rows:
+            if row[0] not in python_clients:
+                python_clients[row[0]] = self.convert_sql_client_to_python_client(row[:13])
+            python_abonnements.append(self.convert_sql_abonnement_to_python_abonnement(row[13:], python_clients[row[0]]))
+
+        return python_abonnements
+
+    def convert_sql_abonnement_to_python_abonnement(self, abonnement_fields: Tuple,
+                                                    owner: BMCClient = None) -> BMCAbonnement:
+        """ Converts an abonnement database table entry to a python abonnement object. The owner is read from the
+        database unless it is provided. """
         python_abonnement = BMCAbonnement(
             db_id=int(abonnement_fields[0]),
             abo_type=abonnement_fields[2],
@@ -303,7 +996,7 @@ class BMCAboDBInterfacer:
             end_date=datetime.datetime.strptime(abonnement_fields[5], "%Y-%m-%d").date() if abonnement_fields[5] is not None else None,
             entrances_remaining=int(abonnement_fields[6]) if abonnement_fields[6] is not None else None,
             include_gear=bool(abonnement_fields[3]),
-            owner=self.find_client_from_id(abonnement_fields[1])
+            owner=owner if owner is not None else self.find_client_from_id(abonnement_fields[1])
         )
 
         return python_abonnement
@@ -330,14 +1023,131 @@ class BMCAboDBInterfacer:
         return python_client
 
 
+class BMCClientNameIndex:
+    """ The BMCClientNameIndex holds the names of all clients in memory, so that searching clients on a name prefix
+    while typing never needs the database. Names are kept normalized as 'first last' and as 'last first' keys, in two
+    sorted lists of (key, client id) pairs, in which prefix searches are a bisection. """
+
+    def __init__(self):
+        self.names = dict()
+        self.first_last_keys = []
+        self.last_first_keys = []
+        self.max_id = 0
+
+    # Alternative constructor
+    @classmethod
+    def from_client_names(cls, client_names: List[BMCClientName]) -> BMCClientNameIndex:
+        """ Build an index of all given client names at once. """
+        index = BMCClientNameIndex()
+        for client_name in client_names:
+            index.names[client_name.db_id] = client_name
+            index.first_last_keys.append(index.get_first_last_key(client_name))
+            index.last_first_keys.append(index.get_last_first_key(client_name))
+            index.max_id = max(index.max_id, client_name.db_id)
+        index.first_last_keys.sort()
+        index.last_first_keys.sort()
+
+        return index
+
+    @staticmethod
+    def get_first_last_key(client_name: BMCClientName) -> Tuple[str, int]:
+        return normalize_name(client_name.first_name + " " + client_name.last_name), client_name.db_id
+
+    @staticmethod
+    def get_last_first_key(client_name: BMCClientName) -> Tuple[str, int]:
+        return normalize_name(client_name.last_name + " " + client_name.first_name), client_name.db_id
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, client_name: BMCClientName) -> None:
+        """ Adds a client to the index, or updates the client's name if it is already part of it. """
+        if client_name.db_id in self.names:
+            self.remove(client_name.db_id)
+        self.names[client_name.db_id] = client_name
+        insort(self.first_last_keys, self.get_first_last_key(client_name))
+        insort(self.last_first_keys, self.get_last_first_key(client_name))
+        self.max_id = max(self.max_id, client_name.db_id)
+
+    def remove(self, client_id: int) -> None:
+        """ Removes a client from the index. """
+        client_name = self.names.pop(client_id)
+        for keys, key in [(self.first_last_keys, self.get_first_last_key(client_name)),
+                          (self.last_first_keys, self.get_last_first_key(client_name))]:
+            del keys[bisect_left(keys, key)]
+
+    def search(self, name_part: str, limit: int = 50) -> List[BMCClientName]:
+        """ Get the clients whose first name or last name begins with the name part, ignoring case and accents. The
+        name part may also be the beginning of a full name, e.g. 'jeremy lo'. Clients whose first name matches come
+        first, ordered by first name then last name, followed by clients whose last name matches. A client whose first
+        and last name both match is only returned once. At most limit clients are returned. """
+        prefix = normalize_name(name_part)
+        matches, client_ids = [], set()
+        for keys in [self.first_last_keys, self.last_first_keys]:
+            i = bisect_left(keys, (prefix,))
+            while i < len(keys) and len(matches) < limit and keys[i][0].startswith(prefix):
+                if keys[i][1] not in client_ids:
+                    client_ids.add(keys[i][1])
+                    matches.append(self.names[keys[i][1]])
+                i += 1
+
+        return matches
+
+
+class BMCClientCache:
+    """ The BMCClientCache maps client db ids to the one client object, and the list of abonnements, which represent that
+    client in memory. Selecting a client which was recently used, or refreshing the current client after a change, is
+    then served from memory. The cache holds at most capacity clients, and evicts the least recently used one when it
+    is full. The abo manager writes its changes to the db before it changes the cached objects, and clears the cache
+    whenever another till may have changed the db. """
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, client_id: int) -> bool:
+        return client_id in self._entries
+
+    def get(self, client_id: int) -> Tuple[BMCClient, List[BMCAbonnement]] or None:
+        """ Get a client and the client's abonnements, or None if the client is not cached. """
+        if client_id not in self._entries:
+            self.miss_count += 1
+            return None
+        self.hit_count += 1
+        self._entries.move_to_end(client_id)
+        return self._entries[client_id]
+
+    def put(self, client: BMCClient, abonnements: List[BMCAbonnement]) -> None:
+        """ Caches a client and the client's abonnements, replacing the client's previous entry if any. """
+        self._entries[client.db_id] = (client, abonnements)
+        self._entries.move_to_end(client.db_id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, client_id: int) -> None:
+        """ Drops a client from the cache, so that the client is read from the db the next time it is needed. """
+        self._entries.pop(client_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
 class BMCAboManager:
     """ The BMCAboManager is responsible for managing the clients and abonnements and it basically an adittional bridge
     which wraps the client and abonnements classes in convenient methods, and interacts with them and the db through
     the DBInterfacer to read and write data. """
 
-    def __init__(self, path_to_db: str or Path):
+    def __init__(self, path_to_db: str or Path, wal: bool = False):
         self.path_to_db = path_to_db
-        self.db_interface = BMCAboDBInterfacer(path_to_db)
+        self.db_interface = BMCAboDBInterfacer(path_to_db, wal)
+        self.name_index = BMCClientNameIndex.from_client_names(self.db_interface.find_client_names())
+        self.client_cache = BMCClientCache()
+        self.change_count = None
 
         self.current_client = None
         self.current_client_abonnements = None
@@ -352,8 +1162,22 @@ class BMCAboManager:
     @current_client.setter
     def current_client(self, client: BMCClient or None) -> None:
         if isinstance(client, BMCClient):
+            cached = self.get_cached_client(client.db_id) if client.db_id is not None else None
+            if cached is not None and cached[0] is client:
+                self.set_current_client(client, cached[1])
+            else:
+                self.set_current_client(client, self.db_interface.get_client_abonnements(client))
+        else:
+            self.set_current_client(None, None)
+
+    def set_current_client(self, client: BMCClient or None, abonnements: List[BMCAbonnement] or None) -> None:
+        """ Sets the current client together with the client's abonnements, which were already read from the db or
+        updated in memory, and caches them. The client's valid abonnement is looked up again. """
+        if isinstance(client, BMCClient):
+            if client.db_id is not None and abonnements is not None:
+                self.client_cache.put(client, abonnements)
             self.__current_client = client
-            self.current_client_abonnements = self.db_interface.get_client_abonnements(self.current_client)
+            self.current_client_abonnements = abonnements
             valid_abos = []
             for ab in self.current_client_abonnements:
                 if ab.is_valid:
@@ -370,13 +1194,133 @@ class BMCAboManager:
             self.current_client_abonnements = None
             self.valid_client_abonnement = None
 
-    def search_clients(self, name_part: str) -> None:
-        """ Looks for clients whose first name OR last name begin with the provided name part and sets all the
-        matches in the matching_clients field. """
-        fn_matches = self.db_interface.find_clients_from_namepart(name_part, "first")
-        ln_matches = self.db_interface.find_clients_from_namepart(name_part, "last")
+    def close(self) -> None:
+        """ Closes the connection to the db. """
+        self.db_interface.close()
+
+    def get_cached_client(self, client_id: int) -> Tuple[BMCClient, List[BMCAbonnement]] or None:
+        """ Get a client and the client's abonnements from the cache, or None if the client is not cached. The cache
+        is cleared first when the db was changed by another till since it was last checked, as the change may be one
+        of a cached client. """
+        change_count = self.db_interface.get_change_count()
+        if change_count != self.change_count:
+            self.client_cache.clear()
+            self.change_count = change_count
+        return self.client_cache.get(client_id)
 
-        self.matching_clients = fn_matches + ln_matches
+    @contextmanager
+    def write_through(self, client_id: int) -> None:
+        """ Runs the db writes of a with block which change a client or the client's abonnements. The cached objects
+        are only changed once the writes are done. If the writes fail the client is dropped from the cache, so that
+        it is read again from the db the next time it is needed. """
+        try:
+            yield
+        except BaseException:
+            self.client_cache.invalidate(client_id)
+            raise
+
+    def search_clients(self, name_part: str, limit: int = 50) -> None:
+        """ Looks for clients whose first name OR last name begin with the provided name part, ignoring case and
+        accents, and sets the names of all matches in the matching_clients field. When there are less than limit of
+        these, they are followed by the clients whose names only resemble the name part. """
+        self.matching_clients = self.find_matching_clients(name_part, limit)
+
+    def find_matching_clients(self, name_part: str, limit: int = 50) -> List[BMCClientName]:
+        """ Get the names of the clients whose first name OR last name begin with the provided name part, ignoring case
+        and accents, from the in-memory name index, followed by the clients whose names only resemble the name part
+        when there are less than limit of these. Unlike search_clients it leaves the matching clients as they are, so
+        that it can be run by the client search's worker thread.
+
+        Clients which were added since the last search, e.g. by another till, are added to the index first. Reading
+        them is a range scan on the client ids, which costs next to nothing when there are none. """
+        with self.db_interface.lock:
+            for client_name in self.db_interface.find_client_names(self.name_index.max_id):
+                self.name_index.add(client_name)
+            matching_clients = self.name_index.search(name_part, limit)
+            if len(matching_clients) < limit:
+                client_ids = {client_name.db_id for client_name in matching_clients}
+                for client_row in self.fuzzy_search_clients(name_part, limit):
+                    if client_row.db_id not in client_ids and len(matching_clients) < limit:
+                        matching_clients.append(client_row.to_client_name())
+
+        return matching_clients
+
+    def select_matching_client(self, index: int) -> None:
+        """ Sets one of the matching clients as the current client. The client's full data is read from the db, unless
+        the client was recently used. """
+        client_id = self.matching_clients[index].db_id
+        cached = self.get_cached_client(client_id)
+        if cached is not None:
+            self.set_current_client(*cached)
+        else:
+            self.set_current_client(*self.db_interface.find_client_with_abonnements(client_id))
+
+    def find_member(self, member_code: str) -> int or None:
+        """ Get the db id of the client with the given card code or member number preceded by MEMBER_NUMBER_PREFIX, or
+        None if there is none. """
+        return self.db_interface.find_client_id_from_member_code(member_code)
+
+    def find_valid_abonnement(self, client_id: int) -> BMCAbonnement or None:
+        """ Get a member's valid abonnement, whose owner is the member, without making them the current client, or None
+        if the member has no valid abonnement. """
+        return self.db_interface.find_valid_abonnement_of_client(client_id)
+
+    def check_in_members(self, check_ins: List[Tuple[BMCAbonnement, int]], till: str = None) -> None:
+        """ Checks in members with their abonnements, given as (abonnement, num_entries), in one db transaction, and
+        logs their entrances as coming through the given till. The entrances of a C10S abonnement are subtracted in the
+        db first, and then from the abonnement and from the member's cached abonnement, if the member was recently
+        used. Raises a ValueError, and changes nothing, when a C10S abonnement has fewer than num_entries entrances
+        left. """
+        try:
+            self.db_interface.check_in_abonnements(check_ins, till)
+        except BaseException:
+            for abonnement, _ in check_ins:
+                self.client_cache.invalidate(abonnement.owner.db_id)
+            raise
+
+        for abonnement, num_entries in check_ins:
+            if abonnement.abo_type != "C10S":
+                continue
+            # The abonnement may be represented by other objects as well: the current client's or the cached one
+            cached = self.get_cached_client(abonnement.owner.db_id)
+            copies = {id(abonnement): abonnement}
+            for other in (cached[1] if cached is not None else []) + (self.current_client_abonnements or []):
+                if other.db_id == abonnement.db_id:
+                    copies[id(other)] = other
+            for checked_in_abonnement in copies.values():
+                checked_in_abonnement.entrances_remaining -= num_entries
+        if self.current_client is not None and any(abonnement.owner.db_id == self.current_client.db_id
+                                                   for abonnement, _ in check_ins):
+            self.set_current_client(self.current_client, self.current_client_abonnements)
+
+    def get_card_code(self) -> str or None:
+        """ Get the code of the current client's membership card, or None if there is no current client or the client
+        has no card. """
+        if self.current_client is None or self.current_client.db_id is None:
+            return None
+        return self.db_interface.find_client_card_code(self.current_client.db_id)
+
+    def assign_card_code(self, card_code: str or None) -> None:
+        """ Gives the current client the membership card with the given code, or takes the client's card away when
+        card_code is None. Raises a ValueError when the code starts with MEMBER_NUMBER_PREFIX, as it would be looked up
+        as a member number at check-in, and an sqlite3.IntegrityError when another client has the card. """
+        assert self.current_client is not None
+        card_code = card_code.strip() if card_code else None
+        if card_code is not None and card_code.startswith(MEMBER_NUMBER_PREFIX):
+            raise ValueError("A card code can not start with {}".format(MEMBER_NUMBER_PREFIX))
+        self.db_interface.update_client_card_code(self.current_client.db_id, card_code or None)
+
+    def get_active_member_count(self) -> int:
+        """ Get the number of current members, i.e. clients with a valid abonnement. """
+        return sum(self.db_interface.count_valid_abonnements().values())
+
+    def get_members_expiring_within(self, days: int) -> List[BMCAbonnement]:
+        """ Get the valid 3M abonnements which end within the given number of days, the first one to expire first. """
+        return self.db_interface.find_expiring_abonnements(days)
+
+    def fuzzy_search_clients(self, name_part: str, limit: int = 50) -> List[BMCClientRow]:
+        """ Get the clients whose name, email or phone number resembles the provided name part, best matches first. """
+        return self.db_interface.find_clients_from_fuzzy_name(name_part, limit)
 
     def create_new_client(self, first_name: str, last_name: str, reduced_price: bool = False, email: str = None,
                           phone: str = None, date_of_birth: datetime.date = None, sex: str = None,
@@ -388,21 +1332,26 @@ class BMCAboManager:
                                street_name,
                                street_number, city_zip, city_name, country)
 
-        self.db_interface.create_client(new_client)
-        self.current_client = self.db_interface.find_client_from_name(new_client.first_name, new_client.last_name)
+        new_client.db_id = self.db_interface.create_client(new_client)
+        self.set_current_client(new_client, [])
+        with self.db_interface.lock:
+            self.name_index.add(BMCClientName(new_client.db_id, new_client.first_name, new_client.last_name))
 
     def create_new_abonnement(self, abo_type: str, reduced_price: bool, include_gear: bool) -> None:
         """ Creates a new abonnement for the current client, and if neccesary updates the current client's reduced price
         field. """
         assert self.valid_client_abonnement is None
-        self.current_client.reduced_price = reduced_price
-        self.db_interface.update_client(self.current_client)
+        updated_client = copy.copy(self.current_client)
+        updated_client.reduced_price = reduced_price
         buy_date = datetime.date.today()
         end_date = datetime.date.today()+relativedelta(months=+3)+relativedelta(days=-1) if abo_type == "3M" else None
         entrances_remaining = 10 if abo_type == "C10S" else None
         abo = BMCAbonnement(self.current_client, abo_type, buy_date, None, include_gear, end_date, entrances_remaining)
-        self.db_interface.create_abonnement(abo)
-        self.current_client = self.current_client  # Triggers an update of the clients' abonnements
+        with self.write_through(self.current_client.db_id):
+            self.db_interface.update_client(updated_client)
+            abo.db_id = self.db_interface.create_abonnement(abo)
+        self.current_client.reduced_price = reduced_price
+        self.set_current_client(self.current_client, self.current_client_abonnements + [abo])
 
     def update_current_client(self, first_name: str, last_name: str, reduced_price: bool = False, email: str = None,
                               phone: str = None, date_of_birth: datetime.date = None, sex: str = None,
@@ -413,30 +1362,31 @@ class BMCAboManager:
         existing_client = BMCClient(first_name, last_name, self.current_client.db_id, reduced_price, email, phone,
                                     date_of_birth, sex, street_name, street_number, city_zip, city_name, country)
 
-        self.db_interface.update_client(existing_client)
-        self.current_client = existing_client
+        with self.write_through(existing_client.db_id):
+            self.db_interface.update_client(existing_client)
+        for abo in self.current_client_abonnements:
+            abo.owner = existing_client
+        self.set_current_client(existing_client, self.current_client_abonnements)
+        with self.db_interface.lock:
+            self.name_index.add(BMCClientName(existing_client.db_id, existing_client.first_name,
+                                              existing_client.last_name))
 
     def update_valid_abonnement_end_date(self, new_end_date: datetime.date):
         """ Modifies the current valid abonnement's end date and saves to the db. """
         assert self.valid_client_abonnement is not None
+        with self.write_through(self.current_client.db_id):
+            self.db_interface.update_abonnement_end_date(self.valid_client_abonnement.db_id, new_end_date)
         self.valid_client_abonnement.end_date = new_end_date
-        self.db_interface.update_abonnement(self.valid_client_abonnement)
-        self.current_client = self.current_client
-
-    def update_valid_abonnement_entrances(self, num_entries_to_subtract: int):
-        """ Subtracts a number of entries from a C10S type abonnement. """
-        assert self.valid_client_abonnement is not None
-        self.valid_client_abonnement.entrances_remaining -= num_entries_to_subtract
-        self.db_interface.update_abonnement(self.valid_client_abonnement)
-        self.current_client = self.current_client
+        self.set_current_client(self.current_client, self.current_client_abonnements)
 
     def delete_valid_abonnement(self):
         """ Deletes the current client's currently valid abonnement. """
         assert self.valid_client_abonnement is not None
         if self.valid_client_abonnement.db_id is not None:
-            self.db_interface.delete_abonnement(self.valid_client_abonnement)
-            self.valid_client_abonnement = None
-            self.current_client = self.current_client
+            with self.write_through(self.current_client.db_id):
+                self.db_interface.delete_abonnement(self.valid_client_abonnement)
+            abonnements = [abo for abo in self.current_client_abonnements if abo is not self.valid_client_abonnement]
+            self.set_current_client(self.current_client, abonnements)
         else:
             raise IOError("Requested DELETE on an abonnement which has no db id")
 
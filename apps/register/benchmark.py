@@ -0,0 +1,232 @@
+"""
+Replays a synthetic peak day at the desk against the register engine, without any view, and reports the latency of
+every operation. All data is written to a temporary folder, the real database and accountancy folder are never touched.
+
+Usage (from the apps/register folder):
+    python benchmark.py --sales 10000 --clients 5000
+    python benchmark.py --sales 10000 --clients 5000 --tills 3
+
+With more than one till, every till replays its sales in its own process, as a separate register would, and all tills
+share one session store.
+"""
+
+import argparse
+import datetime
+import multiprocessing
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from PyQt5.QtCore import QDate
+
+from abonnements import BMCAboDBInterfacer, MEMBER_NUMBER_PREFIX
+from engine import BMCRegisterEngine
+
+PRODUCTS = [("Barre", 2.5, 10 ** 6, "#ffd27f"), ("Magnésie", 6.0, 10 ** 6, "#d8d8d8"),
+            ("Boisson", 1.5, 10 ** 6, "#9ecbff"), ("Brosse", 4.0, 10 ** 6, "#c6f2b6")]
+FIRST_NAMES = ["Jérémy", "Kevin", "Michael", "Arnaud", "Mateo", "Fiona", "Corentin", "Louis", "Nicolas", "Zara",
+               "Marie", "Guillaume", "Chloé", "Hélène", "Noé", "Inès", "Lucas", "Emma", "Léa", "Hugo"]
+LAST_NAMES = ["Lombaerts", "Dupont", "Janssens", "Peeters", "Maes", "Jacobs", "Mertens", "Willems", "Claes", "Goossens",
+              "Wouters", "De Smet", "Dubois", "Lambert", "Lejeune", "Renard", "Martin", "Simon", "Laurent", "Leroy"]
+
+
+def create_database(db_path: Path, num_clients: int, rng: random.Random) -> List[str]:
+    """ Creates a database with the same tables as the production database, filled with random clients who all have
+    a valid abonnement, and returns the search prefixes which can be used to find them. """
+    today = datetime.date.today()
+    connection = sqlite3.connect(str(db_path))
+    with connection:
+        connection.execute("CREATE TABLE client (id INTEGER PRIMARY KEY AUTOINCREMENT, first_name TEXT NOT NULL, "
+                           "last_name TEXT NOT NULL, reduced INTEGER, email TEXT, phone TEXT, date_of_birth TEXT, "
+                           "sex TEXT, street_name TEXT, street_number TEXT, city_zip INTEGER, city_name TEXT, "
+                           "country TEXT, UNIQUE(first_name, last_name))")
+        connection.execute("CREATE TABLE abonnement (id INTEGER PRIMARY KEY AUTOINCREMENT, client_id INTEGER, "
+                           "abo_type TEXT, include_gear INTEGER, buy_date TEXT, end_date TEXT, "
+                           "entrances_remaining INTEGER)")
+        connection.execute("CREATE TABLE produit (name TEXT PRIMARY KEY, price REAL, stock INTEGER, color TEXT)")
+        connection.executemany("INSERT INTO produit VALUES(?, ?, ?, ?)", PRODUCTS)
+
+        prefixes = []
+        for i in range(num_clients):
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = "{}{}".format(rng.choice(LAST_NAMES).upper(), i)
+            cursor = connection.execute("INSERT INTO client VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (None, first_name, last_name, False, None, None, None, None, None, None, None,
+                                         None, None))
+            client_id = cursor.lastrowid
+            buy_date = today - datetime.timedelta(days=rng.randint(0, 80))
+            if rng.random() < 0.5:
+                connection.execute("INSERT INTO abonnement VALUES(?, ?, ?, ?, ?, ?, ?)",
+                                   (None, client_id, "3M", False, buy_date, buy_date + datetime.timedelta(days=90),
+                                    None))
+            else:
+                connection.execute("INSERT INTO abonnement VALUES(?, ?, ?, ?, ?, ?, ?)",
+                                   (None, client_id, "C10S", False, buy_date, None, 10 ** 6))
+            prefixes.append(last_name)
+    connection.close()
+    # The columns, indexes and tables which scripts/migrate_db.py adds to the production database
+    interfacer = BMCAboDBInterfacer(db_path)
+    interfacer.upgrade_schema(search_index=True)
+    interfacer.close()
+
+    return prefixes
+
+
+def create_config(root_dir: Path, db_path: Path, till: str = None) -> dict:
+    """ Creates a config dict with the production prices, pointing to the temporary folder and database. Every till
+    gets its own accountancy folder, and shares the session store of the other tills. """
+    logs_root_dir = root_dir.joinpath("accountancy" if till is None else "accountancy-{}".format(till))
+    logs_root_dir.joinpath("2000", "janvier").mkdir(parents=True)
+    logs_root_dir.joinpath("2000", "janvier", "2000-1-1.csv").write_text("Caisse fin;100.0\n", encoding="utf-8")
+
+    return {
+        "supervisors": ["Benchmark"],
+        "prices of entries": {"entrée normale": 9.0, "entrée réduit": 8.0, "entrée 3M BMC": 0.0,
+                              "entrée C10S BMC": 0.0, "achat 3M normale": 95.0, "achat 3M réduit": 80.0,
+                              "achat 10S normale": 80.0, "achat 10S réduit": 70.0, "achat abo matériel": 15.0},
+        "prices of rentals": {"location baudrier": 2.0, "location gri-gri": 2.0, "location chaussons": 5.0,
+                              "location kit complet": 6.0},
+        "logs root dir": str(logs_root_dir),
+        "abo db path": str(db_path),
+        "products db path": str(db_path),
+        "reduction factor": 0.85,
+        "shared session dir": str(root_dir) if till is not None else None,
+        "till": till,
+        "write queue path": str(root_dir.joinpath("write_queue.db" if till is None else "write_queue-{}.db".format(
+            till))),
+        "analytics snapshot path": str(root_dir.joinpath("analytics.db" if till is None else "analytics-{}.db".format(
+            till))),
+    }
+
+
+class LatencyRecorder:
+    """ Keeps track of the latencies of every timed operation. """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = dict()
+
+    def time(self, operation: str, function: Callable, *args):
+        """ Runs the function and records how long it took. """
+        start = time.perf_counter()
+        result = function(*args)
+        self.latencies.setdefault(operation, []).append(time.perf_counter() - start)
+        return result
+
+    def report(self) -> str:
+        """ Formats the number of calls, and the p50, p99 and max latency of every operation in milliseconds. """
+        lines = ["{:<20}{:>10}{:>12}{:>12}{:>12}".format("operation", "calls", "p50 (ms)", "p99 (ms)", "max (ms)")]
+        for operation in sorted(self.latencies):
+            latencies = sorted(self.latencies[operation])
+            p50 = latencies[int(0.50 * (len(latencies) - 1))]
+            p99 = latencies[int(0.99 * (len(latencies) - 1))]
+            lines.append("{:<20}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+                operation, len(latencies), 1000 * p50, 1000 * p99, 1000 * latencies[-1]))
+        return "\n".join(lines)
+
+
+def replay_peak_day(engine: BMCRegisterEngine, recorder: LatencyRecorder, prefixes: List[str], num_sales: int,
+                    rng: random.Random) -> None:
+    """ Replays num_sales sales which mix entries, rentals, products, staff reductions, cancellations, abo check-ins
+    (from a name search or from a member number) and the occasional custom operation, with the proportions of a busy
+    competition day. """
+    entries = ["entrée normale"] * 6 + ["entrée réduit"] * 3
+    rentals = ["location baudrier", "location gri-gri", "location chaussons", "location kit complet"]
+    products = [product[0] for product in PRODUCTS]
+
+    for _ in range(num_sales):
+        if rng.random() < 0.15:
+            recorder.time("member check-in", engine.check_in_member,
+                          MEMBER_NUMBER_PREFIX + str(rng.randint(1, len(prefixes))), 1)
+        elif rng.random() < 0.15:
+            recorder.time("client search", engine.abo_manager.search_clients, rng.choice(prefixes))
+            recorder.time("client select", engine.abo_manager.select_matching_client, 0)
+            recorder.time("abo check-in", engine.check_in_abonnement, 1)
+        else:
+            for _ in range(rng.choice([1, 1, 1, 2, 2, 3])):
+                recorder.time("ring item", engine.ring_item, rng.choice(entries))
+        for _ in range(rng.choice([0, 0, 1, 2])):
+            recorder.time("ring item", engine.ring_item, rng.choice(rentals))
+        if rng.random() < 0.25:
+            recorder.time("ring product", engine.ring_product, rng.choice(products))
+
+        if rng.random() < 0.01:
+            recorder.time("cancel", engine.cancel)
+            continue
+        if rng.random() < 0.02:
+            recorder.time("reduction", engine.apply_reduction, engine.config["reduction factor"])
+        recorder.time("validate", engine.validate, rng.choice(["cash", "card"]))
+
+        if rng.random() < 0.005:
+            recorder.time("custom op", engine.custom_operation, "achat fournitures", -float(rng.randint(1, 50)), "cash")
+
+
+def run_till(root_dir: Path, db_path: Path, prefixes: List[str], num_sales: int, seed: int, till: str = None) -> str:
+    """ Replays a peak day on one till and returns the report of its latencies and totals. """
+    rng = random.Random(seed)
+    recorder = LatencyRecorder()
+    config = create_config(root_dir, db_path, till)
+
+    engine = recorder.time("startup", BMCRegisterEngine, config)
+    recorder.time("login", engine.login, QDate.currentDate(), 100., "Benchmark")
+    start = time.perf_counter()
+    replay_peak_day(engine, recorder, prefixes, num_sales, rng)
+    duration = time.perf_counter() - start
+    recorder.time("visits per client", engine.abo_manager.db_interface.count_visits_per_client)
+    recorder.time("visits per hour", engine.abo_manager.db_interface.count_visits_per_hour)
+    recorder.time("visits per weekday", engine.abo_manager.db_interface.count_visits_per_weekday)
+    errors = recorder.time("close", engine.close)
+
+    lines = [recorder.report(), ""]
+    if till is not None:
+        lines.append("Till {}".format(till))
+    lines.append("{} sales replayed in {:.2f} s ({:.0f} sales/s)".format(num_sales, duration, num_sales / duration))
+    lines.append("Background writes: {}, coalesced: {}, average latency: {:.1f} ms, max latency: {:.1f} ms".format(
+        engine.io_worker.write_count, engine.io_worker.coalesced_count, 1000 * engine.io_worker.average_latency,
+        1000 * engine.io_worker.max_latency))
+    lines.append("DB writes: {} in {} batches, {} retries, {} failed, {} pending, max latency: {:.1f} ms".format(
+        engine.write_queue.write_count, engine.write_queue.batch_count, engine.write_queue.retry_count,
+        engine.write_queue.failed_count, engine.write_queue.pending_count, 1000 * engine.write_queue.max_latency))
+    lines.append("Analytics snapshots: {}, last one took {:.1f} ms".format(
+        engine.snapshot_scheduler.snapshot_count, 1000 * engine.snapshot_scheduler.last_duration))
+    lines.append("Session totals: €{} in cash, €{} by card, {} clients".format(
+        engine.session_manager.cash_earnings, engine.session_manager.card_earnings,
+        engine.session_manager.client_count))
+    for error in errors:
+        lines.append("Write error: {}".format(error))
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the register engine on a synthetic peak day.")
+    parser.add_argument("--sales", type=int, default=10000, help="number of sales to replay per till")
+    parser.add_argument("--clients", type=int, default=5000, help="number of clients in the database")
+    parser.add_argument("--tills", type=int, default=1, help="number of tills working at the same time")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random traffic")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root_dir = Path(tmp_dir)
+        db_path = root_dir.joinpath("prod.db")
+        prefixes = create_database(db_path, args.clients, random.Random(args.seed))
+
+        if args.tills == 1:
+            print(run_till(root_dir, db_path, prefixes, args.sales, args.seed))
+            return
+
+        tills = [chr(ord("A") + i) for i in range(args.tills)]
+        with multiprocessing.Pool(args.tills) as pool:
+            reports = pool.starmap(run_till, [(root_dir, db_path, prefixes, args.sales, args.seed + i, till)
+                                              for i, till in enumerate(tills)])
+        for report in reports:
+            print(report)
+            print()
+        day_report = next(root_dir.glob("*/*/*.csv"))
+        print("Merged day report of {} tills: {}".format(args.tills, day_report.relative_to(root_dir)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from pathlib import Path
+
+SNAPSHOT_INTERVAL = 15 * 60.
+
+
+def take_snapshot(db_path: Path or str, snapshot_path: Path or str) -> None:
+    """ Copies the db to the snapshot file with sqlite's backup API. The copy is made in a single read transaction, so
+    that it is consistent. It never blocks the tills' writes when the db is in WAL mode, and otherwise only for as long
+    as the copy takes. It is first written next to the snapshot and then renamed, so that a report which opens the
+    snapshot never sees a half written file. """
+    snapshot_path = Path(snapshot_path)
+    tmp_path = snapshot_path.with_name(snapshot_path.name + ".tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    source = sqlite3.connect("file:{}?mode=ro".format(Path(db_path).as_posix()), uri=True)
+    try:
+        target = sqlite3.connect(str(tmp_path))
+        try:
+            source.backup(target)
+            target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            target.close()
+    finally:
+        source.close()
+    os.replace(str(tmp_path), str(snapshot_path))
+
+
+def open_analytics_snapshot(snapshot_path: Path or str) -> sqlite3.Connection:
+    """ Opens a snapshot made by take_snapshot for reading. The connection can not write, neither to the snapshot nor,
+    by mistake, to the live db, so that reports and scripts never contend with the tills. """
+    snapshot_path = Path(snapshot_path)
+    if not snapshot_path.is_file():
+        raise IOError("analytics snapshot: {} not found".format(snapshot_path))
+    connection = sqlite3.connect("file:{}?mode=ro".format(snapshot_path.as_posix()), uri=True)
+    connection.execute("PRAGMA query_only=ON")
+    return connection
+
+
+class BMCSnapshotScheduler:
+    """ The BMCSnapshotScheduler takes a snapshot of the db for analytics and reporting every interval seconds, on a
+    background thread, so that membership and stock reports can be run against a recent copy of the db while the
+    register is open. A snapshot which fails is counted by error_count, reported by last_error until a snapshot
+    succeeds again, and tried again at the next interval. """
+
+    def __init__(self, db_path: Path or str, snapshot_path: Path or str, interval: float = SNAPSHOT_INTERVAL):
+        """ Initialize the scheduler and start its thread, which takes a first snapshot right away.
+
+        db_path: the live db.
+        snapshot_path: the file to which the snapshots are written. It is replaced by every new snapshot.
+        interval: the time in seconds between two snapshots.
+
+        """
+        self.db_path = db_path
+        self.snapshot_path = Path(snapshot_path)
+        self.interval = interval
+
+        self._condition = threading.Condition()
+        self._requested = True
+        self._closed = False
+
+        self.snapshot_count = 0
+        self.last_snapshot_time = None
+        self.last_duration = 0.
+        self.error_count = 0
+        self.last_error = None
+
+        self._thread = threading.Thread(target=self._run, name="BMCSnapshotScheduler", daemon=True)
+        self._thread.start()
+
+    # Methods to manage snapshots
+    def request(self) -> None:
+        """ Requests a snapshot right away, e.g. before running a report, without waiting for the next interval. """
+        with self._condition:
+            self._requested = True
+            self._condition.notify_all()
+
+    def close(self, take_last_snapshot: bool = True) -> None:
+        """ Stops the scheduler's thread, after taking a last snapshot so that it holds all of the day's data. """
+        with self._condition:
+            self._requested = take_last_snapshot
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self) -> None:
+        """ The scheduler's loop, which takes a snapshot when one was requested or when the interval is over. """
+        while True:
+            with self._condition:
+                if not self._requested and not self._closed:
+                    self._condition.wait(self.interval)
+                    if not self._closed:
+                        self._requested = True
+                requested, closed = self._requested, self._closed
+                self._requested = False
+            if requested:
+                self._snapshot()
+            if closed:
+                return
+
+    def _snapshot(self) -> None:
+        start = time.perf_counter()
+        try:
+            take_snapshot(self.db_path, self.snapshot_path)
+        except (sqlite3.Error, OSError) as e:
+            traceback.print_exc()
+            self.error_count += 1
+            self.last_error = e
+            return
+        self.last_error = None
+        self.last_duration = time.perf_counter() - start
+        self.last_snapshot_time = time.time()
+        self.snapshot_count += 1
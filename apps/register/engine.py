@@ -0,0 +1,229 @@
+import sqlite3
+import traceback
+from typing import Callable, List, Tuple
+
+from PyQt5.QtCore import QDate
+
+from abonnements import BMCAbonnement, BMCAboManager
+from db_snapshot import BMCSnapshotScheduler, SNAPSHOT_INTERVAL
+from persistence import BMCPersistenceWorker
+from products import BMCProduct, BMCProductsManager, STOCK_UPDATE_QUERY
+from session import BMCSessionManager
+from shared_store import BMCSharedSessionStore
+from write_queue import BMCWriteBehindQueue
+
+
+class BMCRegisterEngine:
+    """ The BMCRegisterEngine holds all of the registry's logic which does not depend on a view: it owns the session,
+    products and abo managers, and offers one method per operation a user can perform at the desk (login, ringing up
+    items, reductions, validating, custom operations, abo check-ins and closing the session). It needs neither a
+    QApplication nor any widget, so that it can be driven by the main controller as well as by scripts and
+    benchmarks. """
+
+    def __init__(self, config: dict):
+        """ Initialize the engine.
+
+        config: a dict with the 'configuration' variables such as prices, allowed users, paths, ... The prices of
+            sales are added to it once the products are loaded from the database.
+
+        """
+        self.config = config
+        self.products_manager = BMCProductsManager
+        self.abo_manager = None
+        self.update_config_with_products()
+        self.io_worker = BMCPersistenceWorker()
+        self.session_manager = BMCSessionManager(self.config)
+        self.session_manager.io_worker = self.io_worker
+        self.abo_manager = BMCAboManager(self.config["abo db path"], self.config.get("abo db wal", False))
+        self.check_ins: List[Tuple[BMCAbonnement, int]] = []
+        self.write_queue = None
+        if self.config.get("write queue path") is not None:
+            self.write_queue = BMCWriteBehindQueue(self.config["write queue path"])
+            self.abo_manager.db_interface.set_write_queue(self.write_queue)
+        self.abo_manager.db_interface.start_replica()
+        self.snapshot_scheduler = None
+        if self.config.get("analytics snapshot path") is not None:
+            self.snapshot_scheduler = BMCSnapshotScheduler(
+                self.config["abo db path"], self.config["analytics snapshot path"],
+                self.config.get("analytics snapshot interval", SNAPSHOT_INTERVAL))
+        self.shared_store = None
+        if self.config.get("shared session dir") is not None:
+            self.shared_store = BMCSharedSessionStore(self.config["shared session dir"], self.config["till"])
+
+    def update_config_with_products(self) -> None:
+        """ Products are dynamically loaded from database at application start. The products manager must be
+        initialised first so this function updates the existing config with sale products. The products are read from
+        the abo db's read replica if it is the same db and the replica is ready. """
+        self.products_manager.fetch_products(self.config["products db path"], self.get_products_replica_connection())
+        self.config["prices of sales"] = {}
+        for product in self.products_manager.products:
+            self.config["prices of sales"]["achat " + product.name] = product.price
+
+    def get_products_replica_connection(self) -> sqlite3.Connection or None:
+        """ Get the connection to the read replica of the products db, if there is one which is ready. """
+        if self.abo_manager is None or self.config["products db path"] != self.config["abo db path"]:
+            return None
+        replica = self.abo_manager.db_interface.replica
+        return replica.connection if replica is not None else None
+
+    # Methods to manage the session
+    def login(self, date: QDate, cash_count: float, supervisor: str,
+              ask_to_recover: Callable[[BMCSessionManager], bool] = None,
+              ask_to_start_new_session: Callable[[Exception], bool] = None) -> None:
+        """ Initialize the session, and check if a previous session backup exists, which should exist after an app
+        crash. If so, ask_to_recover is called with the backed up session manager and decides whether to continue
+        from the backup. Without ask_to_recover the backup is discarded. A backup which can not be read is renamed to
+        keep it aside, and a new session is started, unless ask_to_start_new_session is called with the error and
+        declines, in which case the error is raised. """
+        self.session_manager.initialize_paths(date)
+        self.session_manager.date = date
+        self.session_manager.initialize_cash_count(cash_count)
+        self.session_manager.supervisor = supervisor
+
+        # Check if a previous backup file_path resulting from a prior crash is present and if so give option to restore
+        if self.session_manager.backup_file_exist() is True:
+            try:
+                backup = BMCSessionManager.from_backup(self.session_manager.backup_path, self.config)
+            except Exception as e:
+                if ask_to_start_new_session is not None and not ask_to_start_new_session(e):
+                    raise
+                traceback.print_exc()
+                backup_path = self.session_manager.backup_path
+                backup_path.replace(backup_path.with_suffix(".bcp-illisible"))
+                backup = None
+            if backup is not None and ask_to_recover is not None and ask_to_recover(backup):
+                self.session_manager = backup
+                self.session_manager.io_worker = self.io_worker
+
+        # Always start from a fresh snapshot, which also empties any journal left behind by a previous session
+        self.session_manager.save_to_backup()
+        if self.shared_store is not None:
+            self.session_manager.attach_shared_store(self.shared_store)
+
+    def close(self) -> List[Exception]:
+        """ Writes the session's report, and the day's merged report when this is the last open till of a shared
+        session store, removes its backup once the report is written and waits for all writes to be done. Updates of
+        the db which can not be written yet, e.g. because the db is locked, stay in the write-behind queue's file and
+        are written at the next start. A last analytics snapshot is taken once the db is up to date. Returns the errors
+        which occurred while writing: the last one of the persistence worker, of the write-behind queue and of the last
+        analytics snapshot, if any. """
+        self.session_manager.save_to_file(remove_backup=True)
+        self.io_worker.close()
+        if self.write_queue is not None:
+            self.write_queue.close()
+        self.abo_manager.close()
+        if self.snapshot_scheduler is not None:
+            self.snapshot_scheduler.close()
+        errors = [self.io_worker.last_error, self.write_queue.last_error if self.write_queue is not None else None,
+                  self.snapshot_scheduler.last_error if self.snapshot_scheduler is not None else None]
+        return [error for error in errors if error is not None]
+
+    # Methods to handle transactions
+    def ring_item(self, transaction_type: str) -> None:
+        """ Adds an entry, rental or sale to the current transaction. """
+        self.session_manager.update_current_transaction(transaction_type)
+
+    def ring_product(self, product_name: str) -> BMCProduct:
+        """ Adds a product sale to the current transaction and takes it from the local stock. """
+        self.products_manager.adjust_local_stocks(product_name)
+        self.ring_item("achat " + product_name)
+        return self.products_manager.get_with_name(product_name)
+
+    def apply_reduction(self, reduction: float) -> None:
+        """ Applies a one time reduction on the total of the current transaction. """
+        self.session_manager.apply_reduction_on_current_transaction(reduction)
+
+    def validate(self, modality: str) -> None:
+        """ Validates the current transaction, and writes the new stock of the sold products to the db. The abo
+        check-ins of the transaction are written first, in one db transaction: a ValueError is raised when a C10S card
+        has too few entrances left, e.g. because it was used at another till meanwhile, and an sqlite3.Error when the db
+        is too busy, in which case the transaction is not validated. """
+        if len(self.check_ins) > 0:
+            self.abo_manager.check_in_members(self.check_ins, self.config.get("till"))
+            self.check_ins = []
+        self.session_manager.validate_current_transaction(modality)
+        stock_updates = self.products_manager.get_stock_updates()
+        products_db_path = self.config["products db path"]
+        if self.write_queue is not None:
+            self.write_queue.submit_many(products_db_path, [(STOCK_UPDATE_QUERY, (stock, name), "stock " + name)
+                                                            for stock, name in stock_updates])
+        else:
+            self.io_worker.submit(lambda: self.write_stock_updates(products_db_path, stock_updates))
+        self.products_manager.confirm_stock()
+
+    def write_stock_updates(self, products_db_path: str, stock_updates: List[Tuple[int, str]]) -> None:
+        """ Writes new stocks to the products db, and mirrors them to the abo db's read replica once they are written if
+        it is the same db. Run by the persistence worker when there is no write-behind queue, whose writes are mirrored
+        by the abo db interfacer. """
+        self.products_manager.write_stock_updates(products_db_path, stock_updates)
+        if self.get_products_replica_connection() is not None:
+            self.abo_manager.db_interface.mirror(STOCK_UPDATE_QUERY, stock_updates, many=True)
+
+    def cancel(self) -> List[BMCProduct]:
+        """ Cancels the current transaction, together with its abo check-ins, and puts the products which were sold back
+        in stock. Returns the products whose stock was restored. """
+        self.check_ins = []
+        restored_products = []
+        for product in self.products_manager.products:
+            if product.changed_stock:
+                product.restore()
+                restored_products.append(product)
+        self.session_manager.cancel_current_transaction()
+        return restored_products
+
+    def custom_operation(self, description: str, amount: float, modality: str) -> None:
+        """ Creates and immediately validates a custom transaction which can have any description, and value (also
+        negative values allowed). The current transaction, if any, is dropped together with its abo check-ins. """
+        self.check_ins = []
+        self.session_manager.add_custom_transaction(description, amount, modality)
+
+    # Methods to handle abonnements
+    def check_in_abonnement(self, num_entries: int = 1) -> None:
+        """ Checks in the abo manager's current client with their valid abonnement. A 3M abonnement adds one free entry
+        to the current transaction, a C10S abonnement adds num_entries free entries, see add_check_in. Raises a
+        RuntimeError when the client has no valid abonnement. """
+        valid_abo = self.abo_manager.valid_client_abonnement
+        if valid_abo is None:
+            raise RuntimeError("The current client has no valid abonnement")
+        self.add_check_in(valid_abo, num_entries)
+
+    def check_in_member(self, member_code: str, num_entries: int = 1) -> BMCAbonnement:
+        """ Checks in a member from their card code, or their member number typed after a '#', alone, without
+        selecting them as the abo manager's current client, and returns their valid abonnement. The entries are added
+        to the current transaction as in check_in_abonnement. Raises a LookupError when there is no such member, a
+        RuntimeError when the member has no valid abonnement and a ValueError when a C10S card has too few entrances
+        left. """
+        client_id = self.abo_manager.find_member(member_code)
+        if client_id is None:
+            raise LookupError("No member with card code or number {}".format(member_code))
+        valid_abo = self.abo_manager.find_valid_abonnement(client_id)
+        if valid_abo is None:
+            raise RuntimeError("Member {} has no valid abonnement".format(client_id))
+        self.add_check_in(valid_abo, num_entries)
+        return valid_abo
+
+    def add_check_in(self, abonnement: BMCAbonnement, num_entries: int) -> None:
+        """ Adds the free entries of a check-in with an abonnement to the current transaction. The check-in is only
+        written to the db, i.e. its entrances subtracted from a C10S card and logged in the entrance table, when the
+        transaction is validated, and dropped when it is cancelled. Raises a ValueError when a C10S card has fewer than
+        num_entries entrances left, not counting the ones of the transaction's earlier check-ins. """
+        if abonnement.abo_type == "C10S" and self.get_entrances_left(abonnement) < num_entries:
+            raise ValueError("Abonnement {} has less than {} entrances left".format(abonnement.db_id, num_entries))
+        self.ring_abonnement_entries(abonnement, num_entries)
+        self.check_ins.append((abonnement, num_entries))
+
+    def get_entrances_left(self, abonnement: BMCAbonnement) -> int:
+        """ Get the number of entrances which are left on a C10S card once the current transaction is validated. """
+        return abonnement.entrances_remaining - sum(num_entries for checked_in_abonnement, num_entries in self.check_ins
+                                                    if checked_in_abonnement.db_id == abonnement.db_id)
+
+    def ring_abonnement_entries(self, abonnement: BMCAbonnement, num_entries: int) -> None:
+        """ Adds the free entries of an abonnement to the current transaction: one for a 3M abonnement, num_entries for
+        a C10S abonnement. """
+        if abonnement.abo_type == "3M":
+            self.ring_item("entrée 3M BMC")
+        elif abonnement.abo_type == "C10S":
+            for _ in range(num_entries):
+                self.ring_item("entrée C10S BMC")
+        else:
+            raise RuntimeError("abo_type should be C10S or 3M")
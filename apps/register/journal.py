@@ -0,0 +1,121 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import List
+
+
+class BMCTransactionJournal:
+    """ The BMCTransactionJournal is an append-only log of a session's validated transactions. Every transaction is
+    written as one compact json line, so that saving a sale costs the same at the end of the day as it does at the
+    start. Together with a periodic snapshot of the session manager it makes it possible to recover a session after
+    a crash by replaying the journal on top of the most recent snapshot. """
+
+    def __init__(self, path: Path or str, fsync_every: int = 10, fsync_interval: float = 5.0,
+                 snapshot_every: int = 50):
+        """ Initialize a journal. The file is only opened when the first record is appended.
+
+        fsync_every: the maximum number of records which can be written before the file is forced to disk.
+        fsync_interval: the maximum number of seconds between two appends before the file is forced to disk.
+        snapshot_every: the number of records after which the session should take a new snapshot.
+
+        """
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+
+        self._file = None
+        self._unsynced_records = 0
+        self._records_since_snapshot = 0
+        self._last_sync = time.monotonic()
+
+    @staticmethod
+    def encode_transaction(seq: int, transaction) -> dict:
+        """ Converts a transaction to a compact record which only holds the items which were actually sold. """
+        sales = dict()
+        for key in transaction.sales_dict:
+            if transaction.sales_dict[key][0] != 0:
+                sales[key] = transaction.sales_dict[key]
+
+        return {
+            "seq": seq,
+            "modality": transaction.modality,
+            "value": transaction.value,
+            "client_count": transaction.client_count,
+            "reduction_applied": transaction.reduction_applied,
+            "sales": sales,
+        }
+
+    @staticmethod
+    def read_records(path: Path or str) -> List[dict]:
+        """ Reads all records from a journal file. A line which was only partially written when the app crashed can not
+        be decoded and is skipped. """
+        path = Path(path)
+        if not path.is_file():
+            return []
+
+        records = []
+        with open(str(path), encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+
+        return records
+
+    def append(self, seq: int, transaction) -> None:
+        """ Appends a transaction to the journal. """
+        self.write(self.encode(seq, transaction))
+
+    def encode(self, seq: int, transaction) -> str:
+        """ Converts a transaction to the line which is written to the journal. Encoding and writing are separate steps
+        so that a transaction can be encoded as soon as it is validated, and written later on by a background worker. """
+        self._records_since_snapshot += 1
+        return json.dumps(self.encode_transaction(seq, transaction), ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def write(self, line: str) -> None:
+        """ Writes an encoded line to the journal. The line is always handed to the os, but only forced to disk once
+        enough lines were written or enough time has passed since the last time it was forced to disk. """
+        if self._file is None:
+            self._file = open(str(self.path), mode="a", encoding="utf-8")
+            os.chmod(str(self.path), 0o777)
+        self._file.write(line)
+        self._file.flush()
+        self._unsynced_records += 1
+        if self._unsynced_records >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        """ Forces all records written so far to disk. """
+        if self._file is not None and self._unsynced_records > 0:
+            os.fsync(self._file.fileno())
+        self._unsynced_records = 0
+        self._last_sync = time.monotonic()
+
+    def needs_snapshot(self) -> bool:
+        """ Whether enough records were appended since the last snapshot to justify taking a new one. """
+        return self._records_since_snapshot >= self.snapshot_every
+
+    def mark_snapshot(self) -> None:
+        """ Restarts counting the records since the last snapshot, once a new snapshot has been taken. """
+        self._records_since_snapshot = 0
+
+    def truncate(self) -> None:
+        """ Empties the journal once a snapshot holding all of its records has safely been written. """
+        self.close()
+        open(str(self.path), mode="w", encoding="utf-8").close()
+
+    def close(self) -> None:
+        """ Forces the remaining records to disk and closes the file. """
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def remove(self) -> None:
+        """ Closes and deletes the journal file. """
+        self.close()
+        if self.path.is_file():
+            self.path.unlink()
@@ -7,18 +7,21 @@ import yaml
 from PyQt5.QtCore import QDate
 from PyQt5.QtWidgets import QApplication, QStatusBar, QMainWindow, QPushButton
 
-from abonnements import BMCAboManager
+from abonnements import normalize_name
+from engine import BMCRegisterEngine
 from exception import UnhandeledExceptionObserver
+from search import BMCClientSearcher
 from popups import ask_to_recover_from_backup_popup, ask_to_confirm_quit_popup, simple_dialog, \
-    ask_to_confirm_abo_delete, confirm_abo_creation_sponsor_popup, confirm_reduction_popup
-from products import BMCProductsManager
-from session import BMCSessionManager
+    ask_to_confirm_abo_delete, confirm_abo_creation_sponsor_popup, confirm_reduction_popup, ask_to_start_new_session_popup
 from widgets import BMCMainWidget, BMCLoginWidget, BMCHistoryWidget, BMCCustomOperationWidget, \
-    BMCAboWidget
+    BMCAboWidget, BMCCheckInWidget
 
 # Name and version the app
 APP_NAME, APP_VERSION = "Caisse BMC", "2.2"
 
+# The 3M abonnements which end within this many days are listed in the abo view, so that their owners can be reminded
+MEMBERS_EXPIRING_DAYS = 7
+
 # Make sure to be able to report all unhandled exceptions before crashing
 qt_exception_hook = UnhandeledExceptionObserver()
 
@@ -35,32 +38,50 @@ def main():
 
 class BMCMainController:
     """ This class implements the main controller of the application. The user uses the controller which interacts with
-     the data classes, and then updates the views which are mostly implemented as widgets. """
+     the data classes through the register engine, and then updates the views which are mostly implemented as
+     widgets. """
 
     def __init__(self):
         """ Initialize the controller.
 
-        config: a dict with the 'configuration' variables such as prices, allowed users, paths, ...
-        session_manager: an instance of the class which manages a session which mostly boils down to managing all
-            the current session's monetary transactions.
-        abo_manager: an instance of the class that manages clients and abonnements. This class mostly wraps around
-            the client, and abonnement classes, as well as the interface which connects to the database.
+        engine: the register engine which holds the config, and the session, products and abo managers, and which
+            implements all operations which do not depend on the view.
+        client_searcher: searches clients on a background thread while the user types.
         main_widget: The main view. Must be a QMainWindow.
         child_widget: A placeholder which can be used to spawn child widgets to delegate specific taskt such as
             asking for login information, showing a history log, ...
 
         """
         # Initialize data
-        self.config = self.get_config()
-        self.products_manager = BMCProductsManager
-        self.update_config_with_products()
-        self.session_manager = BMCSessionManager(self.config)
-        self.abo_manager = BMCAboManager(self.config["abo db path"])
+        self.engine = BMCRegisterEngine(self.get_config())
+        self.client_searcher = BMCClientSearcher(self.abo_manager)
+        self.client_searcher.results_ready.connect(self.update_matching_clients)
 
         # Initialize views
         self.main_widget = None
         self.child_widget = None
 
+    # Getters
+    @property
+    def config(self) -> dict:
+        return self.engine.config
+
+    @property
+    def session_manager(self):
+        return self.engine.session_manager
+
+    @property
+    def abo_manager(self):
+        return self.engine.abo_manager
+
+    @property
+    def products_manager(self):
+        return self.engine.products_manager
+
+    @property
+    def io_worker(self):
+        return self.engine.io_worker
+
     def initialize_view(self, view: QMainWindow) -> None:
         """ Set the main view. """
         self.main_widget = view
@@ -79,7 +100,15 @@ class BMCMainController:
         config["logs root dir"] = parsed_config["DOSSIER_COMPTABILITE"]
         config["abo db path"] = parsed_config["DATABASE"]
         config["products db path"] = parsed_config["DATABASE"]
+        config["abo db wal"] = parsed_config.get("MODE_WAL", False)
         config["reduction factor"] = parsed_config["REDUCTION_PERMANENTS"]
+        config["shared session dir"] = parsed_config.get("SESSION_PARTAGEE")
+        config["till"] = parsed_config.get("CAISSE", "A")
+        config["write queue path"] = parsed_config.get("ECRITURES_EN_ATTENTE",
+                                                       str(Path(__file__).parent.joinpath("write_queue.db")))
+        config["analytics snapshot path"] = parsed_config.get("INSTANTANE_ANALYSES",
+                                                              str(Path(__file__).parent.joinpath("analytics.db")))
+        config["analytics snapshot interval"] = 60 * parsed_config.get("INTERVALLE_INSTANTANE", 15)
 
         config_file_path = Path(__file__).parent.joinpath("resources", "config.yaml")
         if not Path(config["logs root dir"]).is_dir():
@@ -91,17 +120,12 @@ class BMCMainController:
         if not Path(config["products db path"]).is_file():
             raise IOError("products db path: {} not found Try editing the config file located at {}".format(
                 config["products db path"], config_file_path))
+        if config["shared session dir"] is not None and not Path(config["shared session dir"]).is_dir():
+            raise IOError("shared session dir: {} not found Try editing the config file located at {}".format(
+                config["shared session dir"], config_file_path))
 
         return config
 
-    def update_config_with_products(self):
-        """ Products are dynamically loaded from database at application start. The products manager must be
-        initialised first so this function updates the existing config with sale products. """
-        self.products_manager.fetch_products(self.config["products db path"])
-        self.config["prices of sales"] = {}
-        for product in self.products_manager.products:
-            self.config["prices of sales"]["achat " + product.name] = product.price
-
     # Methods to delegate views
     def give_control_to_child(self) -> None:
         """ Child widgets can be spawned. This method gives control to the child widget. """
@@ -121,12 +145,16 @@ class BMCMainController:
         """ Launches the separate and complex abo view which is responsible for handeling client data as well as
         abonnements data. """
         self.child_widget = BMCAboWidget(self)
+        self.update_members_view()
+
+    def launch_check_in_view(self) -> None:
+        """ Launches the compact check-in view, in which members are checked in from their card or member number. """
+        self.child_widget = BMCCheckInWidget(self)
 
     def launch_history_view(self) -> None:
         """ Shows an overview of this session's transaction as well as a resume with the most important information. """
-        transactions_str = self.session_manager.get_transactions_str()
         summary_str = self.session_manager.get_session_summary_str()
-        self.child_widget = BMCHistoryWidget(self, transactions_str, summary_str)
+        self.child_widget = BMCHistoryWidget(self, self.session_manager, summary_str)
 
     def launch_custom_ops_view(self) -> None:
         """ Allows to create a transaction which does not fit the 'standard' transaction format in terms of description
@@ -136,43 +164,38 @@ class BMCMainController:
     def launch_quit_view(self) -> None:
         """ Asks to confirm the intention to quit the app, and closes everything down cleanly if confirmed. """
         if ask_to_confirm_quit_popup(self.session_manager.cash_count):
-            self.session_manager.save_to_file()
-            self.session_manager.remove_backup_file()
+            self.client_searcher.close()
+            errors = self.engine.close()
+            if len(errors) > 0:
+                simple_dialog("Critical", "Erreur de sauvegarde",
+                              "Une erreur est survenue lors de l'écriture des données sur le disque: {}\n\nVérifiez "
+                              "le rapport de la session avant de fermer la caisse.".format(
+                                  "\n".join(str(error) for error in errors)))
             self.main_widget.close()
 
     # All things related to a session
     # Methods to interact with the session manager
     def validate_login(self, date: QDate, cash_count: float, supervisor: str) -> None:
         """ Validate the login data. First sets all data to the session manager, and then checks if a previous session
-        backup exists, which should exist after an app crash. """
-        self.session_manager.initialize_paths(date)
-        self.session_manager.date = date
-        self.session_manager.initialize_cash_count(cash_count)
-        self.session_manager.supervisor = supervisor
-
-        # Check if a previous backup file_path resulting from a prior crash is present and if so give option to restore
-        if self.session_manager.backup_file_exist() is True:
-            backup = BMCSessionManager.from_backup(self.session_manager.backup_path)
-            recover = ask_to_recover_from_backup_popup(backup, date, cash_count)
-            if recover:
-                self.session_manager = backup
-            self.session_manager.save_to_backup()
+        backup exists, which should exist after an app crash, in which case the user is asked whether to restore it. """
+        self.engine.login(date, cash_count, supervisor,
+                          ask_to_recover=lambda backup: ask_to_recover_from_backup_popup(backup, date, cash_count),
+                          ask_to_start_new_session=lambda error: ask_to_start_new_session_popup(date, error))
 
     def update_product(self, button: QPushButton):
         """ Updates the current transaction with a product sale. """
-        self.products_manager.adjust_local_stocks(button.objectName())
-        product = self.products_manager.get_with_name(button.objectName())
+        product = self.engine.ring_product(button.objectName())
         button.setText(product.description)
         if product.stock <= 0:
             button.setEnabled(False)
-        self.update_transaction("achat " + button.objectName())
+        self.update_main_view()
 
-    def cancel_update_product(self, buttons: list):
-        """ Cancels an update to the products stock. """
+    def cancel_update_product(self, buttons: list, restored_products: list):
+        """ Updates the buttons of the products whose stock was restored. """
+        restored_names = [product.name for product in restored_products]
         for button in buttons:
-            product = self.products_manager.get_with_name(button.objectName())
-            if product.changed_stock:
-                product.restore()
+            if button.objectName() in restored_names:
+                product = self.products_manager.get_with_name(button.objectName())
                 button.setText(product.description)
                 if product.stock > 0:
                     button.setEnabled(True)
@@ -183,32 +206,40 @@ class BMCMainController:
         if transaction_type == "abonnement BMC":
             self.launch_abo_view()
         else:
-            self.session_manager.update_current_transaction(transaction_type)
+            self.engine.ring_item(transaction_type)
         self.update_main_view()
 
     def apply_reduction(self, reduction: float) -> None:
         """ Applies a one time reduction on the total of the current transaction in the session manager. """
         if confirm_reduction_popup(reduction):
-            self.session_manager.apply_reduction_on_current_transaction(reduction)
+            self.engine.apply_reduction(reduction)
             self.update_main_view()
 
     def validate_transaction(self, modality: str) -> None:
-        """ Validates the current transaction in the session manager. """
-        self.session_manager.validate_current_transaction(modality)
-        self.products_manager.update_db(self.config["products db path"])
-        self.products_manager.confirm_stock()
+        """ Validates the current transaction in the session manager. The transaction stays open when its abo check-ins
+        can not be written. """
+        try:
+            self.engine.validate(modality)
+        except ValueError:
+            simple_dialog("Warning", "Erreur", "Il ne reste plus assez d'entrées sur une des cartes 10 séances de la "
+                                               "transaction. Annulez la transaction et recommencez.")
+            return
+        except sqlite3.Error:
+            simple_dialog("Warning", "Erreur", "La base de données est occupée, la transaction n'a pas été validée. "
+                                               "Réessayez dans un instant.")
+            return
         self.update_main_view()
 
     def custom_transaction(self, description: str, amount: float, modality: str) -> None:
         """ Creates and immediately validates a custom transaction which can have any description, and value (also
         negative values allowed). """
-        self.session_manager.add_custom_transaction(description, amount, modality)
+        self.engine.custom_operation(description, amount, modality)
         self.update_main_view()
 
     def cancel_transaction(self, buttons) -> None:
         """ Cancels the current transaction. """
-        self.cancel_update_product(buttons)
-        self.session_manager.cancel_current_transaction()
+        restored_products = self.engine.cancel()
+        self.cancel_update_product(buttons, restored_products)
         self.update_main_view()
 
     # Methods to update the main view
@@ -226,6 +257,26 @@ class BMCMainController:
                     self.session_manager.cash_count,
                     self.session_manager.cash_earnings + self.session_manager.card_earnings,
                     self.session_manager.client_count)
+        if self.engine.write_queue is not None:
+            if self.engine.write_queue.last_error is not None:
+                msg += "         |         Erreur base de données: {}".format(self.engine.write_queue.last_error)
+            elif self.engine.write_queue.pending_count > 0:
+                msg += "         |         Écritures DB en attente: {}{}".format(
+                    self.engine.write_queue.pending_count,
+                    " (base de données occupée)" if self.engine.write_queue.db_busy else "")
+        if self.client_searcher.search_count > 0:
+            msg += "         |         Recherche client: {:.0f} ms".format(1000 * self.client_searcher.last_latency)
+        if self.io_worker.last_error is not None:
+            msg += "         |         Erreur d'écriture: {}".format(self.io_worker.last_error)
+        elif self.io_worker.queue_depth > 0:
+            msg += "         |         Écritures en attente: {} ({:.0f} ms)".format(
+                self.io_worker.queue_depth, 1000 * self.io_worker.last_latency)
+        replica = self.abo_manager.db_interface.replica
+        if replica is not None and replica.last_error is not None:
+            msg += "         |         Erreur copie DB en mémoire: {}".format(replica.last_error)
+        snapshot_scheduler = self.engine.snapshot_scheduler
+        if snapshot_scheduler is not None and snapshot_scheduler.last_error is not None:
+            msg += "         |         Erreur snapshot analytique: {}".format(snapshot_scheduler.last_error)
         self.main_widget.statusBar.showMessage(msg)
 
     def update_details_view(self) -> None:
@@ -239,15 +290,28 @@ class BMCMainController:
     # All things related to clients and abonnements
     # Methods to interact with the abo manager
     def search_clients(self, name_part: str) -> None:
-        """ This asks the abo manager to perform a search in the database and to filter all clients whose name
-        partially match the provided name part. The list of matching clients is stored in the manager. """
-        self.abo_manager.search_clients(name_part)
+        """ This asks the client searcher to filter all clients whose name partially match the provided name part, once
+        the user stops typing. The search runs in the background, and its results are passed to
+        update_matching_clients. """
+        self.client_searcher.request(name_part)
+
+    def update_matching_clients(self, name_part: str, matching_clients: list) -> None:
+        """ Stores the results of a client search in the abo manager and shows them in the autocompleter, unless the
+        search was closed in the meantime. """
+        if not isinstance(self.child_widget, BMCAboWidget) or self.child_widget.search_widget is None or \
+                not self.child_widget.search_widget.isVisible():
+            return
+        self.abo_manager.matching_clients = matching_clients
         self.update_autocompleter_view(name_part)
 
+    def cancel_client_search(self) -> None:
+        """ Cancels the client search which is waiting or running, if any. """
+        self.client_searcher.cancel()
+
     def select_current_client(self, selected_index: int) -> None:
         """ Sets the current client in the abo manager based on the index of the current client in the matching
         clients' list. """
-        self.abo_manager.current_client = self.abo_manager.matching_clients[selected_index]
+        self.abo_manager.select_matching_client(selected_index)
         self.update_client_and_abonnements_view()
 
     def reset_current_client(self) -> None:
@@ -277,6 +341,9 @@ class BMCMainController:
                 self.abo_manager.update_current_client(*self.child_widget.get_client_data())
             new_first_name = self.abo_manager.current_client.first_name
             new_last_name = self.abo_manager.current_client.last_name
+            if not self.save_card_code():
+                self.update_client_and_abonnements_view()
+                return
             msg = "Le client {} {} a été enregistré dans la base de données.".format(new_first_name, new_last_name)
             simple_dialog("Information", "Réussi", msg)
             self.update_client_and_abonnements_view()
@@ -287,6 +354,26 @@ class BMCMainController:
             self.abo_manager.current_client = None
             return
 
+    def save_card_code(self) -> bool:
+        """ Gives the current client the membership card whose code was typed or scanned in the abo view, or takes
+        their card away when the code was erased. Returns whether the card was saved, after explaining why not. """
+        card_code = self.child_widget.get_card_code()
+        if card_code == self.abo_manager.get_card_code():
+            return True
+        try:
+            self.abo_manager.assign_card_code(card_code)
+        except ValueError:
+            msg = "Le code d'une carte ne peut pas commencer par #, qui est réservé aux numéros de client. Le client a " \
+                  "été enregistré sans cette carte."
+            simple_dialog("Warning", "Carte non enregistrée", msg)
+            return False
+        except sqlite3.IntegrityError:
+            msg = "La carte {} appartient déjà à un autre client. Le client a été enregistré sans cette " \
+                  "carte.".format(card_code)
+            simple_dialog("Warning", "Carte non enregistrée", msg)
+            return False
+        return True
+
     def create_abonnement(self, abo_type: str, reduced_price: bool, include_gear: bool) -> None:
         """ Asks the abo manager to create a new abonnement with the provided data and pops up a reminder to make
         a Lecomte fidelity card. """
@@ -304,11 +391,40 @@ class BMCMainController:
         simple_dialog(severity="Information", title="Abonnement mis à jour", text=msg)
         self.update_client_and_abonnements_view()
 
-    def subtract_entries_from_abonnement(self, num_entries: int) -> None:
-        """ Subtracts a given number of entries from a 10 entrances card. """
-        self.abo_manager.update_valid_abonnement_entrances(num_entries)
+    def check_in_abonnement(self, num_entries: int) -> None:
+        """ Adds the free entries of the current client's valid abonnement to the current transaction. They are
+        subtracted from the abonnement, if it is a 10 entrances card, when the transaction is validated. """
+        try:
+            self.engine.check_in_abonnement(num_entries)
+        except ValueError:
+            simple_dialog("Warning", "Erreur", "Il ne reste pas assez d'entrées sur la carte 10 séances de ce client.")
+            return
+        self.update_main_view()
         self.update_client_and_abonnements_view()
 
+    def check_in_member(self, member_code: str, num_entries: int) -> str:
+        """ Checks in the member with the given card code or member number, adds the free entries to the current
+        transaction, and returns the message to show to the user. """
+        try:
+            valid_abo = self.engine.check_in_member(member_code, num_entries)
+        except LookupError:
+            return "Aucun client ne correspond à la carte ou au numéro {}. Tapez un # devant un numéro de " \
+                   "client.".format(member_code)
+        except RuntimeError:
+            return "Le client {} n'a pas d'abonnement valable.".format(member_code)
+        except ValueError:
+            return "Il ne reste pas assez d'entrées sur la carte 10 séances du client {}.".format(member_code)
+        except sqlite3.Error:
+            return "La base de données est occupée, le client {} n'a pas été enregistré. Réessayez dans un " \
+                   "instant.".format(member_code)
+        self.update_main_view()
+
+        name = valid_abo.owner.first_name + " " + valid_abo.owner.last_name
+        if valid_abo.abo_type == "C10S":
+            return "{}: {} entrée(s) C10S, il reste {} entrée(s).".format(name, num_entries,
+                                                                       self.engine.get_entrances_left(valid_abo))
+        return "{}: entrée 3M, valable jusqu'au {}.".format(name, valid_abo.end_date.strftime("%d/%m/%Y"))
+
     def delete_abonnement(self) -> None:
         """ Pops up a confirmation dialog and proceeds to delete the current abonnement if the user is certain that
         that is what he wants to do. """
@@ -319,19 +435,20 @@ class BMCMainController:
 
     # Methods to update the clients and abos views
     def update_autocompleter_view(self, name_part: str) -> None:
-        """ Updates the autocompleter's view by setting the dropdown's options. """
-        name_part = name_part.lower()
+        """ Updates the autocompleter's view by setting the dropdown's options, in the order of the matching clients. """
+        name_part = normalize_name(name_part)
         vals = []
         for client in self.abo_manager.matching_clients:
             fl_name = client.first_name + ", " + client.last_name
             lf_name = client.last_name + ", " + client.first_name
 
-            if fl_name.lower().find(name_part) == 0:
+            if normalize_name(fl_name).find(name_part) == 0:
                 vals.append(fl_name)
-            elif lf_name.lower().find(name_part) == 0:
+            elif normalize_name(lf_name).find(name_part) == 0:
                 vals.append(lf_name)
             else:
-                raise RuntimeError("The filtered clients' list contains invalid entries")
+                # A client found by the fuzzy search, whose name only resembles the name part
+                vals.append(fl_name)
 
         self.child_widget.search_widget.set_completer_options(vals)
 
@@ -342,6 +459,7 @@ class BMCMainController:
         self.update_client_view()
         self.update_abonnements_current_view()
         self.update_abonnements_history_view()
+        self.update_members_view()
 
     def update_client_view(self) -> None:
         """ Checks if the manager has a currently active client and if so sets all fields etc. in the view which are
@@ -356,6 +474,7 @@ class BMCMainController:
             self.child_widget.street_name_field.setText(self.abo_manager.current_client.street_name)
             self.child_widget.city_name_field.setText(self.abo_manager.current_client.city_name)
             self.child_widget.country_field.setText(self.abo_manager.current_client.country)
+            self.child_widget.card_code_field.setText(self.abo_manager.get_card_code())
 
             # Set integer fields where None needs to be handeled separately
             if self.abo_manager.current_client.street_number is not None:
@@ -426,6 +545,17 @@ class BMCMainController:
                 history += "\n"
             self.child_widget.abo_history_browser.setText(history)
 
+    def update_members_view(self) -> None:
+        """ Shows how many clients currently are members, and which 3M abonnements end within MEMBERS_EXPIRING_DAYS
+        days, so that their owners can be reminded at the desk. """
+        expiring = self.abo_manager.get_members_expiring_within(MEMBERS_EXPIRING_DAYS)
+        self.child_widget.members_label.setText("Membres actifs: {}         |         Abonnements 3M expirant dans les "
+                                                "{} jours: {}".format(self.abo_manager.get_active_member_count(),
+                                                                      MEMBERS_EXPIRING_DAYS, len(expiring)))
+        self.child_widget.members_label.setToolTip("\n".join(
+            "{} {}: {}".format(abo.owner.first_name, abo.owner.last_name, abo.end_date.strftime("%d/%m/%Y"))
+            for abo in expiring))
+
 
 class BMCMainWindow(QMainWindow):
     """ This class implements the main view (window) of the application. The controller gets orders from the view,
@@ -458,6 +588,5 @@ if __name__ == "__main__":
 # TODO
 #  check where data is being checked, validated, and processed
 #  read ID cards
-#  the whole config shit doesn't make sense to be copied and included in every single transaction instance...
 #  use properties in bmcclient and bmcabonnement
 #  check input and set
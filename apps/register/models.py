@@ -0,0 +1,74 @@
+from typing import Any
+
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QSortFilterProxyModel, QVariant
+
+from session import BMCSessionManager
+
+
+class BMCTransactionsTableModel(QAbstractTableModel):
+    """ Table model which shows a session's transactions, one per row. The model reads the transactions straight from
+    the session manager, and only formats the rows which the view actually asks for, i.e. the visible ones. """
+
+    HEADERS = ["Nr.", "Articles", "Modalité", "Total"]
+
+    def __init__(self, session_manager: BMCSessionManager, parent=None):
+        super(BMCTransactionsTableModel, self).__init__(parent)
+        self.session_manager = session_manager
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return self.session_manager.transaction_count
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.HEADERS)
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.DisplayRole) -> Any:
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return QVariant()
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole) -> Any:
+        if not index.isValid():
+            return QVariant()
+        if role == Qt.TextAlignmentRole and index.column() in (0, 3):
+            return Qt.AlignRight | Qt.AlignVCenter
+        if role != Qt.DisplayRole:
+            return QVariant()
+
+        transaction = self.session_manager.get_transaction(index.row())
+        if index.column() == 0:
+            return str(index.row())
+        elif index.column() == 1:
+            return ", ".join("{} x {}".format(count, key) for key, (count, _) in transaction.sales_dict.items()
+                             if count > 0)
+        elif index.column() == 2:
+            return "carte" if transaction.modality == "card" else "cash"
+        return "€{}".format(round(transaction.value, 2))
+
+
+class BMCTransactionsFilterModel(QSortFilterProxyModel):
+    """ Proxy model which only shows the transactions paid with a given modality and/or containing a given item. """
+
+    def __init__(self, parent=None):
+        super(BMCTransactionsFilterModel, self).__init__(parent)
+        self.modality = None
+        self.item = None
+
+    def set_filters(self, modality: str or None, item: str or None) -> None:
+        """ Sets the modality and item to filter on. None means not to filter on that field. """
+        self.modality = modality
+        self.item = item
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row: int, source_parent: QModelIndex) -> bool:
+        if self.modality is None and self.item is None:
+            return True
+        transaction = self.sourceModel().session_manager.get_transaction(source_row)
+        if self.modality is not None and transaction.modality != self.modality:
+            return False
+        if self.item is not None and transaction.get_count(self.item) <= 0:
+            return False
+        return True
@@ -0,0 +1,98 @@
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Callable
+
+
+class BMCPersistenceWorker:
+    """ The BMCPersistenceWorker runs all writes to disk (backups, journals, reports, stocks) on a dedicated background
+    thread, so that the GUI never has to wait for a slow or synced disk. Jobs are executed one at a time in the order in
+    which they were submitted. A job can be given a key, in which case a newer job with the same key replaces an older
+    one which is still waiting, e.g. to skip a backup which has already been superseded by a more recent one. """
+
+    def __init__(self):
+        """ Initialize the worker and start its thread. """
+        self._jobs = deque()
+        self._condition = threading.Condition()
+        self._busy = False
+        self._closed = False
+
+        self.write_count = 0
+        self.coalesced_count = 0
+        self.error_count = 0
+        self.last_error = None
+        self.last_latency = 0.
+        self.max_latency = 0.
+        self._total_latency = 0.
+
+        self._thread = threading.Thread(target=self._run, name="BMCPersistenceWorker", daemon=True)
+        self._thread.start()
+
+    # Getters
+    @property
+    def queue_depth(self) -> int:
+        """ The number of jobs which are waiting or being executed. """
+        with self._condition:
+            return len(self._jobs) + (1 if self._busy else 0)
+
+    @property
+    def average_latency(self) -> float:
+        """ The average time in seconds between submitting a job and the job being done. """
+        return self._total_latency / self.write_count if self.write_count > 0 else 0.
+
+    # Methods to manage jobs
+    def submit(self, job: Callable[[], None], key: str = None) -> None:
+        """ Queue a job. If a job with the same key is still waiting it is dropped in favour of this one. """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Can not submit a job to a closed persistence worker")
+            if key is not None:
+                for pending_job in list(self._jobs):
+                    if pending_job[0] == key:
+                        self._jobs.remove(pending_job)
+                        self.coalesced_count += 1
+            self._jobs.append((key, job, time.monotonic()))
+            self._condition.notify_all()
+
+    def flush(self) -> None:
+        """ Blocks until all jobs submitted so far have been executed. """
+        with self._condition:
+            while len(self._jobs) > 0 or self._busy:
+                self._condition.wait()
+
+    def close(self) -> None:
+        """ Executes all remaining jobs and stops the worker's thread. """
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self) -> None:
+        """ The worker's loop which takes the jobs off the queue one by one. A job which fails is reported, after which
+        the worker carries on with the next job. """
+        while True:
+            with self._condition:
+                while len(self._jobs) == 0 and not self._closed:
+                    self._condition.wait()
+                if len(self._jobs) == 0 and self._closed:
+                    return
+                _, job, submit_time = self._jobs.popleft()
+                self._busy = True
+
+            try:
+                job()
+            except Exception as e:
+                traceback.print_exc()
+                self.error_count += 1
+                self.last_error = e
+
+            with self._condition:
+                latency = time.monotonic() - submit_time
+                self.write_count += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self._total_latency += latency
+                self._busy = False
+                self._condition.notify_all()
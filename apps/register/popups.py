@@ -37,6 +37,30 @@ def ask_to_recover_from_backup_popup(previous_state: BMCSessionManager, date: QD
         raise RuntimeError("unexpected error when recovering previous state")
 
 
+def ask_to_start_new_session_popup(date: QDate, error: Exception) -> bool:
+    """ Pops up a message box telling that the backup file_path of the session could not be read, and asking whether to
+    start a new session, in which case the unreadable backup is kept aside. """
+    info = "Le fichier de backup du {} n'a pas pu être lu:\n    {}\n\n".format(date.toString("dd/MM/yyyy"), error)
+    info += "Voulez-vous démarrer une nouvelle session? Le backup illisible sera conservé à côté du rapport."
+    msg = QMessageBox()
+    msg.setIcon(QMessageBox.Warning)
+    msg.setText("Attention : backup illisible")
+    msg.setInformativeText(info)
+    msg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+    msg.button(QMessageBox.Yes).setText('Nouvelle session')
+    msg.button(QMessageBox.No).setText('Quitter')
+    msg.setDefaultButton(QMessageBox.Yes)
+    msg.setWindowFlags(Qt.Window | Qt.WindowTitleHint | Qt.CustomizeWindowHint)
+
+    retval = msg.exec_()
+    if retval == 16384:
+        return True
+    elif retval == 65536:
+        return False
+    else:
+        raise RuntimeError("unexpected error when asking to start a new session")
+
+
 def ask_to_confirm_quit_popup(cash_count: float) -> bool:
     """ Pops up a message box asking to confirm to quit the application and also displays how much cash should be
     in the register. """
@@ -1,5 +1,7 @@
 import sqlite3
 
+STOCK_UPDATE_QUERY = "UPDATE produit SET stock=? WHERE name=?"
+
 
 class BMCProduct:
     """The BMCProduct class is used to represent a product that is sold at BMC. """
@@ -47,13 +49,16 @@ class BMCProductsManager:
         return sqlite3.connect(path_to_db)
 
     @staticmethod
-    def fetch_products(path_to_db):
-        """ get all products from the db"""
+    def fetch_products(path_to_db, connection=None):
+        """ get all products from the db, or through the given connection, e.g. to a read replica of the db """
         try:
-            with BMCProductsManager.connect_to_db(path_to_db) as connection:
-                cursor = connection.cursor()
-                cursor.execute("SELECT * FROM produit")
-                sql_products = cursor.fetchall()
+            if connection is not None:
+                sql_products = connection.execute("SELECT * FROM produit").fetchall()
+            else:
+                with BMCProductsManager.connect_to_db(path_to_db) as connection:
+                    cursor = connection.cursor()
+                    cursor.execute("SELECT * FROM produit")
+                    sql_products = cursor.fetchall()
         except Exception:
             return []
         python_products = []
@@ -69,15 +74,29 @@ class BMCProductsManager:
 
     @staticmethod
     def update_db(path_to_db):
+        BMCProductsManager.write_stock_updates(path_to_db, BMCProductsManager.get_stock_updates())
+
+    @staticmethod
+    def get_stock_updates():
+        """ get the new stock of every product whose stock changed, so that it can be written to the db later on """
+        updates = []
+        for product in BMCProductsManager.products:
+            if product.changed_stock:
+                updates.append((product.stock, product.name))
+                product.changed_stock = False
+        return updates
+
+    @staticmethod
+    def write_stock_updates(path_to_db, updates):
+        """ write stock updates obtained from get_stock_updates to the db """
+        if len(updates) == 0:
+            return
         with BMCProductsManager.connect_to_db(path_to_db) as connection:
             cursor = connection.cursor()
-            for product in BMCProductsManager.products:
-                if product.changed_stock:
-                    try:
-                        cursor.execute("UPDATE produit SET stock=? WHERE name=?", (product.stock, product.name))
-                    except Exception:
-                        raise Exception("Erreur lors de la mise à jour des stocks")
-                    product.changed_stock = False
+            try:
+                cursor.executemany(STOCK_UPDATE_QUERY, updates)
+            except Exception:
+                raise Exception("Erreur lors de la mise à jour des stocks")
 
     @staticmethod
     def get_with_name(name):
@@ -0,0 +1,145 @@
+import sqlite3
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import List, Tuple
+
+# How many times the db is copied while it keeps being written, before the replica is dropped until its next load
+MAX_COPY_ATTEMPTS = 3
+
+
+class BMCReadReplica:
+    """ The BMCReadReplica is an in-memory copy of a database, made with sqlite's backup API on a background thread
+    while the till starts up and the supervisor counts the cash drawer. Once it is ready, reads are served from memory
+    instead of from a database file which may be cold, or in a synced folder.
+
+    The replica is kept up to date by mirroring the till's own writes to it, once they are committed to the database,
+    by the till itself or by the write-behind queue. A write which happens while the database is being copied makes the
+    copy start over, so that the replica never misses one. Writes of other tills are only seen after the replica is
+    loaded again, which is done in the background while the previous copy keeps serving reads. If a write can not be
+    mirrored, or the database is still being written after MAX_COPY_ATTEMPTS copies, the replica is dropped, and reads
+    simply go to the database again. Errors are counted by error_count, and the last one is reported by last_error
+    until the replica is loaded again. """
+
+    def __init__(self, db_path: Path or str, lock: threading.RLock):
+        """ Initialize the replica.
+
+        db_path: the database to copy.
+        lock: the lock which is held while writing to the database, and while mirroring a write to the replica.
+
+        """
+        self.db_path = db_path
+        self.lock = lock
+        self.connection = None
+        self.write_version = 0
+        self.copy_count = 0
+        self.load_time = 0.
+        self.error_count = 0
+        self.last_error = None
+        self._loaded = threading.Event()
+        self._thread = None
+
+    # Getters
+    @property
+    def is_ready(self) -> bool:
+        return self.connection is not None
+
+    @property
+    def is_loading(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # Methods to load the replica
+    def start(self, setup_statements: List[str] = ()) -> None:
+        """ Starts loading the replica in the background, or loading it again if it is loaded already. Does nothing
+        while the replica is being loaded.
+
+        setup_statements: statements to run on the replica once it is copied, e.g. to create temporary tables.
+
+        """
+        if self.is_loading:
+            return
+        self._loaded.clear()
+        self._thread = threading.Thread(target=self._run, args=(setup_statements,),
+                                        name="BMCReadReplica", daemon=True)
+        self._thread.start()
+
+    def copy(self) -> sqlite3.Connection:
+        """ Copies the database into a new in-memory database, and returns the connection to the copy. """
+        source = sqlite3.connect(str(self.db_path))
+        try:
+            target = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+            source.backup(target)
+        finally:
+            source.close()
+        self.copy_count += 1
+        return target
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Blocks until the replica is loaded, or failed to load, or until timeout seconds have passed. Returns whether
+        the replica is ready. """
+        self._loaded.wait(timeout)
+        return self.is_ready
+
+    def close(self) -> None:
+        """ Waits for the replica to be loaded, if it is being loaded, and drops it. """
+        if self._thread is not None:
+            self._thread.join()
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def _run(self, setup_statements: List[str]) -> None:
+        start = time.perf_counter()
+        try:
+            for _ in range(MAX_COPY_ATTEMPTS):
+                with self.lock:
+                    write_version = self.write_version
+                connection = self.copy()
+                with self.lock:
+                    if write_version != self.write_version:
+                        connection.close()
+                        continue
+                    for statement in setup_statements:
+                        try:
+                            connection.execute(statement)
+                        except sqlite3.Error:
+                            pass
+                    previous_connection, self.connection = self.connection, connection
+                    if previous_connection is not None:
+                        previous_connection.close()
+                    self.last_error = None
+                    return
+            # The previous copy, if any, misses the changes which the replica was loaded again for
+            with self.lock:
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+        except sqlite3.Error as e:
+            traceback.print_exc()
+            self.error_count += 1
+            self.last_error = e
+        finally:
+            self.load_time = time.perf_counter() - start
+            self._loaded.set()
+
+    # Methods to mirror writes
+    def mirror(self, statement: str, params: Tuple or List[Tuple] = (), many: bool = False) -> None:
+        """ Applies a write, which was committed to the database, to the replica as well. Several rows of
+        params are applied at once when many is True. """
+        with self.lock:
+            self.write_version += 1
+            if self.connection is None:
+                return
+            try:
+                if many:
+                    self.connection.executemany(statement, params)
+                else:
+                    self.connection.execute(statement, params)
+            except sqlite3.Error as e:
+                traceback.print_exc()
+                self.error_count += 1
+                self.last_error = e
+                self.connection.close()
+                self.connection = None
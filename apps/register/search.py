@@ -0,0 +1,108 @@
+import time
+from typing import List
+
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot
+
+from abonnements import BMCAboManager, BMCClientName
+
+SEARCH_DEBOUNCE_MS = 100
+
+
+class BMCClientSearchWorker(QObject):
+    """ The BMCClientSearchWorker runs the client searches on its own thread, so that a search which has to read from a
+    slow or synced database never blocks the GUI. A search which was superseded by a newer one while it was waiting is
+    skipped. """
+
+    results_ready = pyqtSignal(int, str, list)
+
+    def __init__(self, abo_manager: BMCAboManager):
+        super(BMCClientSearchWorker, self).__init__()
+        self.abo_manager = abo_manager
+        self.latest_generation = 0
+
+    @pyqtSlot(int, str)
+    def search(self, generation: int, name_part: str) -> None:
+        if generation != self.latest_generation:
+            return
+        self.results_ready.emit(generation, name_part, self.abo_manager.find_matching_clients(name_part))
+
+
+class BMCClientSearcher(QObject):
+    """ The BMCClientSearcher searches clients while the user types. A search only starts once the user stopped typing
+    for debounce_ms milliseconds, and is run by a BMCClientSearchWorker on a background thread. Every keystroke starts a
+    new generation, and results are only passed on through results_ready if no key was typed since their search was
+    requested, so that the suggestions never belong to an outdated name part.
+
+    The searcher keeps track of the latency between the last keystroke and its suggestions being ready, which includes
+    the debounce delay. """
+
+    results_ready = pyqtSignal(str, list)
+    search_requested = pyqtSignal(int, str)
+
+    def __init__(self, abo_manager: BMCAboManager, debounce_ms: int = SEARCH_DEBOUNCE_MS, parent: QObject = None):
+        """ Initialize the searcher and start its worker's thread. """
+        super(BMCClientSearcher, self).__init__(parent)
+        self.generation = 0
+        self.name_part = ""
+        self.keystroke_time = 0.
+
+        self.search_count = 0
+        self.dropped_count = 0
+        self.last_latency = 0.
+        self.max_latency = 0.
+        self._total_latency = 0.
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(debounce_ms)
+        self.timer.timeout.connect(self.start_search)
+
+        self.thread = QThread()
+        self.worker = BMCClientSearchWorker(abo_manager)
+        self.worker.moveToThread(self.thread)
+        self.search_requested.connect(self.worker.search)
+        self.worker.results_ready.connect(self.on_results_ready)
+        self.thread.start()
+
+    # Getters
+    @property
+    def average_latency(self) -> float:
+        """ The average time in seconds between the last keystroke and the suggestions being ready. """
+        return self._total_latency / self.search_count if self.search_count > 0 else 0.
+
+    # Methods to search
+    def request(self, name_part: str) -> None:
+        """ Requests a search for the name part, which replaces any search which was requested before. """
+        self.generation += 1
+        self.worker.latest_generation = self.generation
+        self.name_part = name_part
+        self.keystroke_time = time.perf_counter()
+        self.timer.start()
+
+    def cancel(self) -> None:
+        """ Cancels the requested search, if any. Results of searches which are already running are dropped. """
+        self.timer.stop()
+        self.generation += 1
+        self.worker.latest_generation = self.generation
+
+    @pyqtSlot()
+    def start_search(self) -> None:
+        self.search_requested.emit(self.generation, self.name_part)
+
+    @pyqtSlot(int, str, list)
+    def on_results_ready(self, generation: int, name_part: str, matching_clients: List[BMCClientName]) -> None:
+        if generation != self.generation:
+            self.dropped_count += 1
+            return
+        latency = time.perf_counter() - self.keystroke_time
+        self.search_count += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self._total_latency += latency
+        self.results_ready.emit(name_part, matching_clients)
+
+    def close(self) -> None:
+        """ Cancels the requested search and stops the worker's thread, after the running search, if any. """
+        self.cancel()
+        self.thread.quit()
+        self.thread.wait()
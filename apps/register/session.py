@@ -1,16 +1,67 @@
 from __future__ import annotations
 
+import datetime
+import json
 import os
 import pickle
 import time
 from pathlib import Path
+from typing import Callable
 from typing import List
 from typing import Tuple
 
 from PyQt5.QtCore import QDate
 
-from utils import get_most_recent_report_path, get_path_to_new_report_file, get_weekday_from_date, \
-    get_expected_cash_from_report, write_report_file
+from journal import BMCTransactionJournal
+from utils import get_path_to_new_report_file, get_weekday_from_date, get_expected_cash_from_report, \
+    write_report_file, get_most_recent_report_entry, update_report_index
+
+
+class BMCSessionLedger:
+    """ The BMCSessionLedger keeps running totals of a session's validated transactions. Every transaction is recorded
+    once when it is validated, so that reading the cash, card and client totals never requires going over all of the
+    session's previous transactions again. """
+
+    def __init__(self):
+        """ Initialize an empty ledger. Totals are kept per payment modality, and counters are kept per sold item. """
+        self.modality_totals = dict()
+        self.modality_counts = dict()
+        self.item_counts = dict()
+        self.client_count = 0
+        self.transaction_count = 0
+
+    # Alternative constructor
+    @classmethod
+    def from_transactions_list(cls, transactions_list: List) -> BMCSessionLedger:
+        """ Build a ledger by recording all transactions of a list, for instance after recovering from a backup. """
+        ledger = BMCSessionLedger()
+        for t in transactions_list:
+            ledger.record(t)
+
+        return ledger
+
+    def record(self, transaction: BMCTransaction) -> None:
+        """ Add a validated transaction to the running totals. """
+        self.modality_totals[transaction.modality] = self.modality_totals.get(transaction.modality, 0.) + \
+            transaction.value
+        self.modality_counts[transaction.modality] = self.modality_counts.get(transaction.modality, 0) + 1
+        for key in transaction.sales_dict:
+            if transaction.sales_dict[key][0] > 0:
+                self.item_counts[key] = self.item_counts.get(key, 0) + transaction.sales_dict[key][0]
+        self.client_count += transaction.client_count
+        self.transaction_count += 1
+
+    def get_modality_total(self, modality: str) -> float:
+        """ Get the summed value of all transactions which were paid with the given modality. """
+        return self.modality_totals.get(modality, 0.)
+
+    def get_modality_count(self, modality: str) -> int:
+        """ Get the number of transactions which were paid with the given modality. """
+        return self.modality_counts.get(modality, 0)
+
+    def get_item_count(self, item: str) -> int:
+        """ Get how many times an item was sold during the session. """
+        return self.item_counts.get(item, 0)
 
 
 class BMCSessionManager:
@@ -23,29 +74,121 @@ class BMCSessionManager:
          expected cash count, which can be read from previous financial report files. As some fields are kinda
          required before properly starting a session, a separate, external login function can be ran. """
         self.config = config if config is not None else None
+        self.catalog = BMCPriceCatalog.from_config(self.config)
         self.supervisor = "None"
         self.date = QDate()
+        self.session_id = self.get_new_session_id()
         self.expected_initial_cash_count, self.last_report_date = self.read_expected_cash_count_and_date_from_file()
         self.observed_initial_cash_count = 0.
 
         self._older_transactions = list()
         self._current_transaction = None
+        self.ledger = BMCSessionLedger()
 
         self.recap = ""
         self.details = ""
 
-        self.save_path, self.backup_path = None, None
+        self.save_path, self.backup_path, self.journal_path = None, None, None
+        self.journal = None
+        self.io_worker = None
+        self.shared_store = None
+
+    @staticmethod
+    def get_new_session_id() -> str:
+        """ A session is identified by the time at which it was started, which tells it apart from the other sessions
+        of the same till on the same day. """
+        return datetime.datetime.now().isoformat(sep=" ", timespec="microseconds")
 
     # Alternative constructor
     @classmethod
-    def from_backup(cls, file_path: Path) -> BMCSessionManager:
+    def from_backup(cls, file_path: Path, config: dict) -> BMCSessionManager:
         """ Alternative constructor which makes it possible to retrieve a session manager object from a pickeled
-        backup file. """
+        backup file. The transactions which were journaled after the backup was taken are replayed on top of it. """
         with (open(str(file_path), "rb")) as openfile:
             obj = pickle.load(openfile)
+        obj.attach_config(config)
+        for record in BMCTransactionJournal.read_records(obj.journal_path):
+            if record["seq"] >= len(obj._older_transactions):
+                obj._older_transactions.append(BMCTransaction.from_journal_record(obj.catalog, record))
+                obj.ledger.record(obj._older_transactions[-1])
+        obj.journal = BMCTransactionJournal(obj.journal_path)
 
         return obj
 
+    def __getstate__(self) -> dict:
+        """ Get the compact state which is written to backup files. The config and the journal are not part of it, dates
+        are stored as julian days, amounts as integer cents, and transactions as count tables which refer to the
+        catalog stored alongside them. """
+        return {
+            "version": BMCSessionSnapshot.VERSION,
+            "session_id": self.session_id,
+            "supervisor": self.supervisor,
+            "date": BMCSessionSnapshot.encode_date(self.date),
+            "last_report_date": BMCSessionSnapshot.encode_date(self.last_report_date),
+            "expected_initial_cash_count": BMCSessionSnapshot.encode_amount(self.expected_initial_cash_count),
+            "observed_initial_cash_count": BMCSessionSnapshot.encode_amount(self.observed_initial_cash_count),
+            "catalog": BMCSessionSnapshot.encode_catalog(self.catalog),
+            "transactions": [BMCSessionSnapshot.encode_transaction(t) for t in self._older_transactions],
+            "current_transaction": BMCSessionSnapshot.encode_transaction(self._current_transaction)
+            if self._current_transaction is not None else None,
+            "recap": self.recap,
+            "details": self.details,
+            "save_path": str(self.save_path) if self.save_path is not None else None,
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        """ Restore a session manager from the state found in a backup file. The restored manager has no config, which
+        must be attached again before it can be used. Backups pickled by releases before the snapshot format are
+        upgraded first. """
+        if "version" not in state:
+            state = BMCSessionSnapshot.upgrade_legacy_state(state)
+        elif state["version"] == 1:
+            state = dict(state, version=BMCSessionSnapshot.VERSION, session_id=self.get_new_session_id())
+        if state.get("version") != BMCSessionSnapshot.VERSION:
+            raise IOError("Unsupported session backup version: {}".format(state.get("version")))
+        catalog = BMCSessionSnapshot.decode_catalog(state["catalog"])
+
+        self.config = None
+        self.catalog = catalog
+        self.session_id = state["session_id"]
+        self.__supervisor = state["supervisor"]
+        self.date = BMCSessionSnapshot.decode_date(state["date"])
+        self.last_report_date = BMCSessionSnapshot.decode_date(state["last_report_date"])
+        self.expected_initial_cash_count = BMCSessionSnapshot.decode_amount(state["expected_initial_cash_count"])
+        self.observed_initial_cash_count = BMCSessionSnapshot.decode_amount(state["observed_initial_cash_count"])
+
+        self._older_transactions = [BMCSessionSnapshot.decode_transaction(catalog, t) for t in state["transactions"]]
+        self._current_transaction = BMCSessionSnapshot.decode_transaction(catalog, state["current_transaction"]) \
+            if state["current_transaction"] is not None else None
+        self.ledger = BMCSessionLedger.from_transactions_list(self._older_transactions)
+
+        self.recap = state["recap"]
+        self.details = state["details"]
+
+        self.save_path = Path(state["save_path"]) if state["save_path"] is not None else None
+        self.backup_path = self.save_path.with_suffix(".bcp") if self.save_path is not None else None
+        self.journal_path = self.save_path.with_suffix(".jnl") if self.save_path is not None else None
+        self.journal = None
+        self.io_worker = None
+        self.shared_store = None
+
+    def attach_config(self, config: dict) -> None:
+        """ Attach the current config to a session manager which was restored from a backup. If prices changed since
+        the backup was taken, the restored transactions keep referring to the catalog they were made with. """
+        self.config = config
+        catalog = BMCPriceCatalog.from_config(config)
+        if catalog == self.catalog:
+            for t in self._older_transactions:
+                t.catalog = catalog
+            if self._current_transaction is not None:
+                self._current_transaction.catalog = catalog
+        elif self._current_transaction is not None:
+            current_transaction = BMCTransaction.from_transactions_list(catalog, [self._current_transaction])
+            current_transaction.modality = self._current_transaction.modality
+            current_transaction.reduction_applied = self._current_transaction.reduction_applied
+            self._current_transaction = current_transaction
+        self.catalog = catalog
+
     # Getters
     @property
     def supervisor(self) -> str:
@@ -95,11 +238,7 @@ class BMCSessionManager:
 
     @property
     def cash_count(self) -> float:
-        cash_count = self.observed_initial_cash_count
-        for t in self._older_transactions:
-            if t.modality == "cash":
-                cash_count += t.value
-        return round(cash_count, 2)
+        return round(self.observed_initial_cash_count + self.ledger.get_modality_total("cash"), 2)
 
     @property
     def cash_earnings(self) -> float:
@@ -107,11 +246,7 @@ class BMCSessionManager:
 
     @property
     def card_earnings(self) -> float:
-        card_count = 0.0
-        for t in self._older_transactions:
-            if t.modality == "card":
-                card_count += t.value
-        return round(card_count, 2)
+        return round(self.ledger.get_modality_total("card"), 2)
 
     @property
     def total_earnings(self) -> float:
@@ -119,10 +254,15 @@ class BMCSessionManager:
 
     @property
     def client_count(self) -> int:
-        client_count = 0
-        for t in self._older_transactions:
-            client_count += t.client_count
-        return client_count
+        return self.ledger.client_count
+
+    @property
+    def transaction_count(self) -> int:
+        return self.ledger.transaction_count
+
+    def get_transaction(self, index: int) -> BMCTransaction:
+        """ Get one of this session's validated transactions, in the order in which they were validated. """
+        return self._older_transactions[index]
 
     # Methods to initialize the manager
     def initialize_cash_count(self, initial_cash_count: float) -> None:
@@ -137,8 +277,13 @@ class BMCSessionManager:
         self.save_path = Path(get_path_to_new_report_file(self.config["logs root dir"], date))
         if self.save_path.is_file():
             renamed_extension = "-version-{}.csv".format(time.strftime("%Hh%Mm%Ss", time.localtime()))
-            self.save_path.rename(str(self.save_path).replace(".csv", renamed_extension))
+            renamed_path = Path(str(self.save_path).replace(".csv", renamed_extension))
+            self.save_path.rename(str(renamed_path))
+            root_dir, save_path = self.config["logs root dir"], self.save_path
+            self.run_io(lambda: update_report_index(root_dir, renamed_path, previous_path=save_path))
         self.backup_path = self.save_path.with_suffix(".bcp")
+        self.journal_path = self.save_path.with_suffix(".jnl")
+        self.journal = BMCTransactionJournal(self.journal_path)
 
     # Methods that represent the session's state in one or another string form
     def __str__(self) -> str:
@@ -152,11 +297,12 @@ class BMCSessionManager:
         msg += "Erreur caisse : €{}\n".format(self.initial_cash_count_error)
         msg += "\n\n"
         msg += "Transactions\n"
-        msg += "{}".format(str(BMCTransaction.from_transactions_list(self.config, self._older_transactions)))
+        msg += "{}".format(self.get_item_counts_str())
         msg += "\n\n"
         msg += "Total rentrées : €{}".format(self.total_earnings)
-        msg += "\n     - cash : €{}".format(self.cash_earnings)
-        msg += "\n     - cartes : €{}".format(self.card_earnings)
+        msg += "\n     - cash : €{} ({} transactions)".format(self.cash_earnings, self.ledger.get_modality_count("cash"))
+        msg += "\n     - cartes : €{} ({} transactions)".format(self.card_earnings,
+                                                              self.ledger.get_modality_count("card"))
         msg += "\n\n"
         msg += "Caisse fin : €{}".format(self.cash_count)
 
@@ -174,20 +320,22 @@ class BMCSessionManager:
         """ Summarize all of this session's parameters. """
         return str(self)
 
-    def get_transactions_str(self) -> str:
-        """ Get the list of all of this session's transactions. """
-        if len(self._older_transactions) == 0:
-            return "Aucune transaction enregistrée pour cette session."
+    def get_item_counts_str(self) -> str:
+        """ Get how many times every item was sold during this session, read from the ledger's running counters.
+        Catalog items come first in catalog order, followed by the custom transactions. """
         msg = str()
-        for trans_nr, transaction in enumerate(self._older_transactions):
-            msg += "-------- Transaction nr. {} --------\n".format(trans_nr)
-            msg += str(transaction)
-            msg += "Modalité: {}\n".format("carte" if transaction.modality == "card" else "cash")
-            msg += "Total: €{}\n".format(transaction.value)
-            msg += "\n"
+        for key in self.get_sold_items():
+            msg += "{} x {}\n".format(self.ledger.get_item_count(key), key)
 
         return msg
 
+    def get_sold_items(self) -> List[str]:
+        """ Get the names of all items which were sold during this session. """
+        sold_items = [key for key in self.catalog.names if self.ledger.get_item_count(key) > 0]
+        sold_items += [key for key in self.ledger.item_counts
+                       if self.catalog.get_id(key) is None and self.ledger.get_item_count(key) > 0]
+        return sold_items
+
     def set_recap_str(self, msg_type: str, **kwargs) -> None:
         """ Constructs a recap string according to some predefined formats. """
         if msg_type == "initial":
@@ -247,7 +395,7 @@ class BMCSessionManager:
         transaction with a predefined transaction type which must match one of the transaction types in the
         configuration. """
         if self._current_transaction is None:
-            self._current_transaction = BMCTransaction(self.config)
+            self._current_transaction = BMCTransaction(self.catalog)
         self._current_transaction.update(transaction_type)
         self.set_recap_str(msg_type="current value")
         self.set_details_str(msg_type="current transaction")
@@ -263,8 +411,8 @@ class BMCSessionManager:
 
     def validate_current_transaction(self, modality: str) -> None:
         """ Validates the current transaction which amounts to checking the payment modality, and writing off the
-        transaction to the list of previous transactions. Also makes a backup of the manager's internal state so that
-        in the case of a crash the manager can recover its previous state. """
+        transaction to the list of previous transactions. Also journals the transaction so that in the case of a crash
+        the manager can recover its previous state. """
         if self._current_transaction is not None:
             self._current_transaction.modality = modality
             assert self._current_transaction.modality == "cash" or self._current_transaction.modality == "card"
@@ -272,17 +420,18 @@ class BMCSessionManager:
             assert self._current_transaction.client_count >= 0
             assert isinstance(self._current_transaction.value, float)
             self._older_transactions.append(self._current_transaction)
+            self.ledger.record(self._current_transaction)
             self.set_recap_str(msg_type="validate", modality=modality,
                                transaction_value=self._current_transaction.value)
             self.set_details_str(msg_type="clear")
+            self.save_to_journal(self._current_transaction)
             self._current_transaction = None
-            self.save_to_backup()
 
     def add_custom_transaction(self, msg: str, value: float, modality: str, client_count: int = 0) -> None:
         """ Creates and immediately validates a custom transaction: a transaction which does not adhere to the
         predefined formats in the config, and which can also be negative. """
         custom_transaction = BMCTransaction.from_manual_params(
-            self.config, str(msg).lower() + " (op. caisse {})".format(len(self._older_transactions)),
+            self.catalog, str(msg).lower() + " (op. caisse {})".format(self.transaction_count),
             value,
             client_count,
             modality)
@@ -291,10 +440,11 @@ class BMCSessionManager:
         assert custom_transaction.client_count >= 0
         assert isinstance(custom_transaction.value, float)
         self._older_transactions.append(custom_transaction)
+        self.ledger.record(custom_transaction)
         self.set_recap_str(msg_type="operation", transaction_value=value)
         self.set_details_str(msg_type="clear")
         self._current_transaction = None
-        self.save_to_backup()
+        self.save_to_journal(custom_transaction)
 
     def cancel_current_transaction(self) -> None:
         """ Obviously cancels the current transaction. """
@@ -304,39 +454,99 @@ class BMCSessionManager:
 
     # Methods that handle IO stuff
     def read_expected_cash_count_and_date_from_file(self) -> Tuple[float, QDate or None]:
-        """ Looks in the reports folder for the most recently created financial report file and reads the cash count
+        """ Looks up the most recently created financial report file in the reports' catalog and reads the cash count
         to be expected from that file. As all chartal transactions with the registry should be logged this should
         return the actual cash count in the register. """
         root_dir = self.config["logs root dir"]
-        most_recent_report = get_most_recent_report_path(root_dir)
+        most_recent_report, summary = get_most_recent_report_entry(root_dir)
         ps = Path(most_recent_report).stem.split("-")
         most_recent_report_date = QDate()
         most_recent_report_date.setDate(int(ps[0]), int(ps[1]), int(ps[2]))
-        expected_cash_count = get_expected_cash_from_report(most_recent_report)
+        if summary["closing cash"] is not None:
+            expected_cash_count = summary["closing cash"]
+        else:
+            expected_cash_count = get_expected_cash_from_report(most_recent_report)
 
-        return expected_cash_count, most_recent_report_date
+        return float(expected_cash_count), most_recent_report_date
 
     def backup_file_exist(self) -> bool:
         """ Simply checks if there is already a backupfile for this session. """
         return Path(self.backup_path).is_file()
 
+    def run_io(self, job: Callable[[], None], key: str = None) -> None:
+        """ Runs a job which writes to disk. If the session has an io worker the job is handed to it and runs in the
+        background, else it runs immediately. """
+        if self.io_worker is not None:
+            self.io_worker.submit(job, key)
+        else:
+            job()
+
+    def attach_shared_store(self, shared_store) -> None:
+        """ Makes this session one of the tills of a shared session store. The till's session is registered in the
+        store, together with the transactions which were already validated, e.g. when recovering from a backup. """
+        self.shared_store = shared_store
+        date, session_id, supervisor = self.date, self.session_id, self.supervisor
+        expected_cash, observed_cash = self.expected_initial_cash_count, self.observed_initial_cash_count
+        lines = [json.dumps(BMCTransactionJournal.encode_transaction(seq, t), ensure_ascii=False, separators=(",", ":"))
+                 for seq, t in enumerate(self._older_transactions)]
+
+        def open_till():
+            shared_store.open_till(date, session_id, supervisor, expected_cash, observed_cash)
+            for line in lines:
+                shared_store.append(date, session_id, line)
+
+        self.run_io(open_till)
+
+    def save_to_journal(self, transaction: BMCTransaction) -> None:
+        """ Appends a freshly validated transaction to the journal, and to the shared session store if there is one.
+        Takes a new snapshot of the whole session once the journal has grown long enough. """
+        journal, line = self.journal, self.journal.encode(len(self._older_transactions) - 1, transaction)
+        self.run_io(lambda: journal.write(line))
+        if self.shared_store is not None:
+            shared_store, date, session_id = self.shared_store, self.date, self.session_id
+            self.run_io(lambda: shared_store.append(date, session_id, line))
+        if self.journal.needs_snapshot():
+            self.save_to_backup()
+
     def save_to_backup(self) -> None:
         """ Backs up the session manager's internal state and nothing else to a pickle file, which makes it possible to
-        recover the manager's internal state after a crash."""
-        backup_file = open(str(self.backup_path), "wb")
-        pickle.dump(self, backup_file, protocol=pickle.HIGHEST_PROTOCOL)
-        backup_file.close()
-        os.chmod(str(self.backup_path), 0o777)
+        recover the manager's internal state after a crash. The state is pickled right away, but written to disk by the
+        io job. The snapshot is written to a temporary file first so that a crash while writing never corrupts the
+        previous snapshot, after which the journal can safely be emptied. A pending backup which has not been written
+        yet is superseded by this one. """
+        data = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+        backup_path, journal = self.backup_path, self.journal
+        self.journal.mark_snapshot()
+
+        def write_backup():
+            tmp_path = backup_path.with_suffix(".bcp.tmp")
+            with open(str(tmp_path), "wb") as backup_file:
+                backup_file.write(data)
+                backup_file.flush()
+                os.fsync(backup_file.fileno())
+            os.replace(str(tmp_path), str(backup_path))
+            os.chmod(str(backup_path), 0o777)
+            journal.truncate()
+
+        self.run_io(write_backup, key="backup")
 
     def remove_backup_file(self) -> None:
         """ Deletes older backups of this session to avoid cluttering the file system. """
-        if self.backup_path.is_file():
-            self.backup_path.unlink()
+        backup_path, journal = self.backup_path, self.journal
+
+        def remove_backup():
+            journal.remove()
+            if backup_path.is_file():
+                backup_path.unlink()
 
-    def save_to_file(self) -> None:
+        self.run_io(remove_backup, key="backup")
+
+    def save_to_file(self, remove_backup: bool = False) -> None:
         """ Saves (what should be the final state of) the session manager's important data in a nice csv file, which
-        is nicely classified and dated. """
-        transactions = BMCTransaction.from_transactions_list(self.config, self._older_transactions)
+        is nicely classified and dated. With remove_backup, the session's backup and journal are deleted once the
+        report is written, to avoid cluttering the file system. They are kept when the report can not be written, so
+        that the session can still be recovered. """
+        transactions = BMCTransaction.from_transactions_list(self.catalog, self._older_transactions)
         session_dict = {
             "Jour": get_weekday_from_date(self.date),
             "Date": self.date.toString("dd/MM/yyyy"),
@@ -349,100 +559,341 @@ class BMCSessionManager:
             "# de clients": self.client_count,
             "Caisse fin": self.cash_count,
         }
-        write_report_file(transactions, session_dict, self.save_path)
+        root_dir, save_path = self.config["logs root dir"], self.save_path
+        backup_path, journal = self.backup_path, self.journal
+
+        def write_report():
+            write_report_file(transactions, session_dict, save_path)
+            update_report_index(root_dir, save_path)
+            if remove_backup:
+                journal.remove()
+                if backup_path.is_file():
+                    backup_path.unlink()
+
+        self.run_io(write_report)
+
+        if self.shared_store is not None:
+            shared_store, date, session_id, catalog = self.shared_store, self.date, self.session_id, self.catalog
+
+            def write_day_report():
+                if shared_store.close_till(date, session_id):
+                    shared_store.write_day_report(date, catalog)
+                shared_store.close()
+
+            self.run_io(write_day_report)
+
+
+class BMCSessionSnapshot:
+    """ The BMCSessionSnapshot class groups the helpers which convert a session's state to and from the compact form
+    which is written to backup files. Only builtin types are used so that a snapshot does not depend on the layout of
+    the classes it was made from, and the VERSION is bumped whenever the format changes. Version 2 added the session
+    id, which is made up for the backups of version 1. """
+
+    VERSION = 2
+
+    @staticmethod
+    def encode_amount(amount: float) -> int:
+        """ Amounts are stored as integer cents. """
+        return int(round(amount * 100))
+
+    @staticmethod
+    def decode_amount(cents: int) -> float:
+        return cents / 100
+
+    @staticmethod
+    def encode_date(date: QDate or None) -> int or None:
+        """ Dates are stored as julian day ordinals. """
+        if date is None or not date.isValid():
+            return None
+        return date.toJulianDay()
+
+    @staticmethod
+    def decode_date(julian_day: int or None) -> QDate:
+        if julian_day is None:
+            return QDate()
+        return QDate.fromJulianDay(julian_day)
+
+    @staticmethod
+    def encode_catalog(catalog: BMCPriceCatalog) -> Tuple:
+        """ A catalog is stored as its names, its prices in cents, and the names of the items which count clients. """
+        client_names = tuple(name for item_id, name in enumerate(catalog.names) if catalog.counts_clients(item_id))
+        return catalog.names, tuple(BMCSessionSnapshot.encode_amount(p) for p in catalog.prices), client_names
+
+    @staticmethod
+    def decode_catalog(encoded_catalog: Tuple) -> BMCPriceCatalog:
+        names, prices, client_names = encoded_catalog
+        return BMCPriceCatalog(names, [BMCSessionSnapshot.decode_amount(p) for p in prices], client_names)
+
+    @staticmethod
+    def encode_transaction(transaction: BMCTransaction) -> Tuple:
+        """ A transaction is stored as a flat tuple: its modality, value in cents, client count, whether a reduction
+        was applied, a table of (item id, count) pairs, and a table of (description, count, price in cents) triples
+        for its custom sales. """
+        return (transaction.modality,
+                BMCSessionSnapshot.encode_amount(transaction.value),
+                transaction.client_count,
+                transaction.reduction_applied,
+                tuple(transaction.counts.items()),
+                tuple((key, count, BMCSessionSnapshot.encode_amount(price))
+                      for key, (count, price) in transaction.custom_sales.items()))
+
+    @staticmethod
+    def upgrade_legacy_state(legacy_state: dict) -> dict:
+        """ Converts the state of a session manager which was pickled as a whole, before the snapshot format existed,
+        to the current snapshot format. Such a state holds its config, from which the catalog is rebuilt, and its
+        transactions, whose sales are merged in the catalog again. """
+        catalog = BMCPriceCatalog.from_config(legacy_state["config"])
+
+        def upgrade_transaction(legacy_transaction: BMCTransaction) -> Tuple:
+            transaction = BMCTransaction(catalog=catalog)
+            transaction.value = legacy_transaction.value
+            transaction.client_count = legacy_transaction.client_count
+            transaction.modality = legacy_transaction.modality
+            transaction.reduction_applied = legacy_transaction.reduction_applied
+            for name, (count, price) in legacy_transaction.custom_sales.items():
+                transaction.merge_sale(name, count, price)
+            return BMCSessionSnapshot.encode_transaction(transaction)
+
+        current_transaction = legacy_state.get("_current_transaction")
+        save_path = legacy_state.get("save_path")
+        return {
+            "version": BMCSessionSnapshot.VERSION,
+            "session_id": BMCSessionManager.get_new_session_id(),
+            "supervisor": legacy_state["_BMCSessionManager__supervisor"],
+            "date": BMCSessionSnapshot.encode_date(legacy_state["_BMCSessionManager__date"]),
+            "last_report_date": BMCSessionSnapshot.encode_date(legacy_state.get("last_report_date")),
+            "expected_initial_cash_count": BMCSessionSnapshot.encode_amount(
+                legacy_state["_BMCSessionManager__expected_initial_cash_count"]),
+            "observed_initial_cash_count": BMCSessionSnapshot.encode_amount(
+                legacy_state["_BMCSessionManager__observed_initial_cash_count"]),
+            "catalog": BMCSessionSnapshot.encode_catalog(catalog),
+            "transactions": [upgrade_transaction(t) for t in legacy_state["_older_transactions"]],
+            "current_transaction": upgrade_transaction(current_transaction)
+            if current_transaction is not None else None,
+            "recap": legacy_state.get("recap", ""),
+            "details": legacy_state.get("details", ""),
+            "save_path": str(save_path) if save_path is not None else None,
+        }
+
+    @staticmethod
+    def decode_transaction(catalog: BMCPriceCatalog, encoded_transaction: Tuple) -> BMCTransaction:
+        modality, value, client_count, reduction_applied, counts, custom_sales = encoded_transaction
+        transaction = BMCTransaction(catalog=catalog)
+        transaction.modality = modality
+        transaction.value = BMCSessionSnapshot.decode_amount(value)
+        transaction.client_count = client_count
+        transaction.reduction_applied = reduction_applied
+        transaction.counts = dict(counts)
+        transaction.custom_sales = {key: [count, BMCSessionSnapshot.decode_amount(price)]
+                                    for key, count, price in custom_sales}
+
+        return transaction
+
+
+class BMCPriceCatalog:
+    """ The BMCPriceCatalog holds the names and prices of all the items which can be sold during a session, and maps
+    every item name to a small integer id. A session builds its catalog once from the config, after which it is shared
+    by, and never modified through, all of the session's transactions. """
+
+    __slots__ = ("_names", "_prices", "_ids", "_client_ids")
+
+    def __init__(self, names: List[str], prices: List[float], client_names: List[str] = ()):
+        """ Initialize a catalog. Item i has name names[i] and price prices[i]. Selling an item whose name is in
+        client_names counts as a client entering the gym. """
+        if len(names) != len(prices):
+            raise ValueError("names and prices must have the same length")
+        self._names = tuple(names)
+        self._prices = tuple(prices)
+        self._ids = {name: item_id for item_id, name in enumerate(self._names)}
+        self._client_ids = frozenset(self._ids[name] for name in client_names)
+
+    # Alternative constructor
+    @classmethod
+    def from_config(cls, config: dict) -> BMCPriceCatalog:
+        """ Build the catalog of all entries, rentals and sales defined in the config dict. """
+        prices = dict()
+        prices.update(config["prices of entries"])
+        prices.update(config["prices of rentals"])
+        prices.update(config["prices of sales"])
+
+        return BMCPriceCatalog(list(prices.keys()), list(prices.values()), list(config["prices of entries"].keys()))
+
+    # Getters
+    @property
+    def names(self) -> Tuple[str, ...]:
+        return self._names
+
+    @property
+    def prices(self) -> Tuple[float, ...]:
+        return self._prices
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __eq__(self, other) -> bool:
+        """ Two catalogs are equal if they sell the same items at the same prices. """
+        if not isinstance(other, BMCPriceCatalog):
+            return NotImplemented
+        return self._names == other._names and self._prices == other._prices and \
+            self._client_ids == other._client_ids
+
+    def get_id(self, name: str) -> int or None:
+        """ Get the id of an item, or None if the item is not in the catalog. """
+        return self._ids.get(name)
+
+    def counts_clients(self, item_id: int) -> bool:
+        """ Whether selling this item counts as a client entering the gym. """
+        return item_id in self._client_ids
 
 
 class BMCTransaction:
     """ The BMCTransaction class generates objects which represent a single transaction. It is used to hold and
     prganise transactional data. It is also possible to merge a list of transactions in one big transaction, although
     some information gets lost such as the different modalities of payment employed for each of the constituent
-    transactions. """
+    transactions.
 
-    def __init__(self, config: dict = None):
+    A transaction only keeps track of what was actually sold: a sparse count vector maps catalog item ids to the number
+    of times they were sold, and custom sales which are not in the catalog are kept apart with their own price. """
+
+    __slots__ = ("catalog", "value", "client_count", "counts", "custom_sales", "modality", "reduction_applied")
+
+    def __init__(self, catalog: BMCPriceCatalog = None):
         """ Initialize a transaction. By default a transaction is empty, and must be filled by calling its update
-        method with a transaction type which matches the transaction types defined in the config dict. """
-        self.config = config
+        method with a transaction type which matches one of the items in the session's catalog. """
+        self.catalog = catalog
         self.value = 0.
         self.client_count = 0
-        self.sales_dict = dict()
+        self.counts = dict()
+        self.custom_sales = dict()
         self.modality = None
         self.reduction_applied = False
 
-        if config is not None:
-            self.prices = dict()
-            self.prices.update(self.config["prices of entries"])
-            self.prices.update(self.config["prices of rentals"])
-            self.prices.update(self.config["prices of sales"])
-
-            for key in self.prices:
-                self.sales_dict[key] = [0, self.prices[key]]
-
     # Alternative constructors
     @classmethod
-    def from_transactions_list(cls, config: dict, transactions_list: List) -> BMCTransaction:
-        """ Merge a list of transactions into one single transaction. """
-        merged_transaction = BMCTransaction(config=config)
+    def from_transactions_list(cls, catalog: BMCPriceCatalog, transactions_list: List) -> BMCTransaction:
+        """ Merge a list of transactions into one single transaction. All transactions are aggregated in a single pass:
+        the counts of catalog items are summed in one count vector as long as the catalog, and custom sales are summed
+        per description, so merging N transactions costs O(N + K) for a catalog of K items. """
+        merged_transaction = BMCTransaction(catalog=catalog)
+        if len(transactions_list) == 0:
+            return merged_transaction
+
+        counts = [0] * len(catalog)
+        custom_sales = merged_transaction.custom_sales
         for t in transactions_list:
-            merged_transaction = merged_transaction + t
+            merged_transaction.value += t.value
+            merged_transaction.client_count += t.client_count
+            if t.catalog is catalog:
+                for item_id in t.counts:
+                    counts[item_id] += t.counts[item_id]
+            else:
+                # Transactions restored from a backup made with other prices are merged by name
+                for item_id in t.counts:
+                    merged_transaction.merge_sale(t.catalog.names[item_id], t.counts[item_id],
+                                                  t.catalog.prices[item_id])
+            for key in t.custom_sales:
+                count = custom_sales[key][0] if key in custom_sales else 0
+                custom_sales[key] = [count + t.custom_sales[key][0], t.custom_sales[key][1]]
+
+        for item_id, count in enumerate(counts):
+            if count != 0:
+                merged_transaction.counts[item_id] = merged_transaction.counts.get(item_id, 0) + count
+        merged_transaction.modality = "multiple"
 
         return merged_transaction
 
     @classmethod
-    def from_manual_params(cls, config: dict, msg: str, value: float, client_count: int,
+    def from_journal_record(cls, catalog: BMCPriceCatalog, record: dict) -> BMCTransaction:
+        """ Recreate a transaction from a record which was written to a session's journal. """
+        journaled_transaction = BMCTransaction(catalog=catalog)
+        journaled_transaction.value = record["value"]
+        journaled_transaction.client_count = record["client_count"]
+        journaled_transaction.modality = record["modality"]
+        journaled_transaction.reduction_applied = record["reduction_applied"]
+        for key in record["sales"]:
+            count, price = record["sales"][key]
+            journaled_transaction.merge_sale(key, count, price)
+
+        return journaled_transaction
+
+    @classmethod
+    def from_manual_params(cls, catalog: BMCPriceCatalog, msg: str, value: float, client_count: int,
                            modality: str) -> BMCTransaction:
         """ Create a transaction manually which does not adhere to a predefined format (description and value). """
-        manual_transaction = BMCTransaction(config=config)
+        manual_transaction = BMCTransaction(catalog=catalog)
         manual_transaction.value = value
         manual_transaction.client_count = client_count
         manual_transaction.modality = modality
-        manual_transaction.sales_dict[msg] = [1, value]
+        manual_transaction.custom_sales[msg] = [1, value]
 
         return manual_transaction
 
+    @property
+    def sales_dict(self) -> dict:
+        """ Get what was sold in this transaction as a dict which maps item names to their count and price. Catalog
+        items come first in catalog order, followed by the custom sales. """
+        sales_dict = dict()
+        for item_id in sorted(self.counts):
+            sales_dict[self.catalog.names[item_id]] = [self.counts[item_id], self.catalog.prices[item_id]]
+        for key in self.custom_sales:
+            sales_dict[key] = [self.custom_sales[key][0], self.custom_sales[key][1]]
+
+        return sales_dict
+
+    def __setstate__(self, state: Tuple or dict) -> None:
+        """ Restore a pickled transaction. Transactions pickled before they had a catalog hold a config and a dict which
+        maps every item name to its count and price, whose sales are restored as custom sales without a catalog. """
+        if isinstance(state, tuple):
+            for slot, value in state[1].items():
+                setattr(self, slot, value)
+            return
+        self.catalog = None
+        self.value = state["value"]
+        self.client_count = state["client_count"]
+        self.counts = dict()
+        self.custom_sales = {name: [count, price] for name, (count, price) in state["sales_dict"].items() if count != 0}
+        self.modality = state["modality"]
+        self.reduction_applied = state.get("reduction_applied", False)
+
+    def merge_sale(self, name: str, count: int, price: float) -> None:
+        """ Add a number of sales of an item at a given price. If the item is not in the catalog, or if the catalog
+        has a different price for it, the sale is kept as a custom sale. """
+        item_id = self.catalog.get_id(name)
+        if item_id is not None and self.catalog.prices[item_id] == price:
+            self.counts[item_id] = self.counts.get(item_id, 0) + count
+        else:
+            key = name if item_id is None else "{} (€{})".format(name, price)
+            previous_count = self.custom_sales[key][0] if key in self.custom_sales else 0
+            self.custom_sales[key] = [previous_count + count, price]
+
+    def get_count(self, name: str) -> int:
+        """ Get how many times an item, or custom sale, is part of this transaction. """
+        item_id = self.catalog.get_id(name)
+        if item_id is not None and item_id in self.counts:
+            return self.counts[item_id]
+        return self.custom_sales[name][0] if name in self.custom_sales else 0
+
     def update(self, transaction_type: str) -> None:
         """ Update a transaction by adding a predefined type of transactions to it. The allowed transaction typed
-        are defined in the config dict. """
-        if transaction_type not in self.config["prices of entries"] and \
-                transaction_type not in self.config["prices of rentals"] and \
-                transaction_type not in self.config["prices of sales"]:
+        are the items of the session's catalog. """
+        item_id = self.catalog.get_id(transaction_type)
+        if item_id is None:
             raise RuntimeError("A sale has been initialised that is not in the known config.")
-        if transaction_type in self.config["prices of entries"]:
+        if self.catalog.counts_clients(item_id):
             self.client_count += 1
-        self.sales_dict[transaction_type][0] += 1
-        self.value += self.prices[transaction_type]
+        self.counts[item_id] = self.counts.get(item_id, 0) + 1
+        self.value += self.catalog.prices[item_id]
 
     def __str__(self) -> str:
         """ Represent a single transaction as a string. """
         msg = ""
-        for key in self.sales_dict:
-            if float(self.sales_dict[key][0]) > 0.:
-                msg += "{} x {}\n".format(self.sales_dict[key][0], key)
+        sales_dict = self.sales_dict
+        for key in sales_dict:
+            if float(sales_dict[key][0]) > 0.:
+                msg += "{} x {}\n".format(sales_dict[key][0], key)
 
         return msg
 
     def __add__(self, other: BMCTransaction) -> BMCTransaction:
         """ Define the addition operator on BMCTransactions. """
-        # Make a new transaction
-        comb_trans = BMCTransaction(config=self.config)
-
-        # Set it's main fields
-        comb_trans.value = self.value + other.value
-        comb_trans.client_count = self.client_count + other.client_count
-        comb_trans.modality = "multiple"
-
-        # Set the exact sales dict by merging both together
-        self_keys = self.sales_dict.keys()
-        other_keys = other.sales_dict.keys()
-        common_keys = [key for key in self_keys if key in other_keys]
-        unique_self_keys = [key for key in self_keys if key not in other_keys]
-        unique_other_keys = [key for key in other_keys if key not in self_keys]
-
-        comb_trans.sales_dict = {}
-        for key in common_keys:
-            comb_trans.sales_dict[key] = [self.sales_dict[key][0] + other.sales_dict[key][0], other.sales_dict[key][1]]
-        for key in unique_self_keys:
-            comb_trans.sales_dict[key] = [self.sales_dict[key][0], self.sales_dict[key][1]]
-        for key in unique_other_keys:
-            comb_trans.sales_dict[key] = [other.sales_dict[key][0], other.sales_dict[key][1]]
-
-        return comb_trans
+        return BMCTransaction.from_transactions_list(self.catalog, [self, other])
@@ -0,0 +1,191 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import List
+
+from PyQt5.QtCore import QDate
+
+from session import BMCPriceCatalog, BMCTransaction
+from utils import get_path_to_new_report_file, get_weekday_from_date, write_report_file
+
+SHARED_SESSION_DB_FILE_NAME = "shared_session.db"
+
+
+class BMCSharedSessionStore:
+    """ The BMCSharedSessionStore lets several registers ('tills') work on the same day, e.g. during events. Every till
+    keeps its own session manager, cash drawer and report, and additionally appends its validated transactions to one
+    SQLite database which lives in a folder shared by all tills, typically a network share. The database uses a
+    rollback journal rather than WAL mode, which needs shared memory and is not safe on a network share. Every sale is
+    a single short insert, so adding a till hardly slows down the others. The day's merged report, covering all tills,
+    is written next to the database by the last till which closes.
+
+    A till may work several sessions on the same day, e.g. when the supervisor changes at noon. Every session is kept
+    apart by its session id, so that its initial cash count and its sales never replace those of an earlier one.
+
+    The store's connection is opened lazily by the first call, so that all calls can be run by the persistence worker's
+    thread. """
+
+    def __init__(self, root_dir: Path or str, till: str):
+        """ Initialize a store.
+
+        root_dir: the folder shared by all tills, which holds the database and the merged reports.
+        till: the name of this till, which must be unique among the tills working on the same day.
+
+        """
+        self.root_dir = Path(root_dir)
+        self.till = str(till)
+        self.db_path = self.root_dir.joinpath(SHARED_SESSION_DB_FILE_NAME)
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # Autocommit mode, every statement is its own short transaction. The timeout makes a till wait for the lock
+            # when another till happens to be writing at the same time, instead of failing.
+            self._connection = sqlite3.connect(str(self.db_path), timeout=30., isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=DELETE")
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS till_session (
+                    day TEXT NOT NULL,
+                    till TEXT NOT NULL,
+                    session TEXT NOT NULL,
+                    supervisor TEXT NOT NULL,
+                    expected_initial_cash REAL NOT NULL,
+                    observed_initial_cash REAL NOT NULL,
+                    closed INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, till, session));
+                CREATE TABLE IF NOT EXISTS sale (
+                    day TEXT NOT NULL,
+                    till TEXT NOT NULL,
+                    session TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    modality TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    client_count INTEGER NOT NULL,
+                    record TEXT NOT NULL,
+                    PRIMARY KEY (day, till, session, seq));""")
+        return self._connection
+
+    @staticmethod
+    def get_day(date: QDate) -> str:
+        return date.toString("yyyy-MM-dd")
+
+    # Methods used by one till
+    def open_till(self, date: QDate, session_id: str, supervisor: str, expected_initial_cash: float,
+                  observed_initial_cash: float) -> None:
+        """ Registers one of this till's sessions of the day. A session which is registered already, e.g. when it is
+        recovered after a crash, keeps its supervisor and initial cash count, and is opened again. A till works one
+        session at a time, so its other sessions of the day are closed, e.g. one which crashed and was not recovered,
+        whose sales are kept. """
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("UPDATE till_session SET closed = 1 WHERE day = ? AND till = ? AND session != ?",
+                               (self.get_day(date), self.till, session_id))
+            connection.execute(
+                "INSERT INTO till_session(day, till, session, supervisor, expected_initial_cash, "
+                "observed_initial_cash) VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT(day, till, session) DO UPDATE SET "
+                "closed = 0",
+                (self.get_day(date), self.till, session_id, supervisor, expected_initial_cash, observed_initial_cash))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def append(self, date: QDate, session_id: str, line: str) -> None:
+        """ Appends a transaction, encoded as a journal line, to the sales of one of this till's sessions of the day. A
+        transaction which was already appended, e.g. when a session is recovered after a crash, is ignored. """
+        record = json.loads(line)
+        self.connection.execute(
+            "INSERT OR IGNORE INTO sale(day, till, session, seq, modality, value, client_count, record) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.get_day(date), self.till, session_id, record["seq"], record["modality"], record["value"],
+             record["client_count"], line))
+
+    def close_till(self, date: QDate, session_id: str) -> bool:
+        """ Marks one of this till's sessions of the day as closed, and returns whether all sessions of all tills of the
+        day are closed now. Both are done in one transaction, so that only one till finds itself to be the last one. """
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("UPDATE till_session SET closed = 1 WHERE day = ? AND till = ? AND session = ?",
+                               (self.get_day(date), self.till, session_id))
+            open_count = connection.execute("SELECT COUNT(*) FROM till_session WHERE day = ? AND closed = 0",
+                                            (self.get_day(date),)).fetchone()[0]
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return open_count == 0
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # Methods covering all tills
+    def read_till_totals(self, date: QDate) -> List[dict]:
+        """ Get every session of every till which worked on the given day, in the order in which the sessions of a till
+        were started, with the totals of its own cash drawer. """
+        rows = self.connection.execute(
+            "SELECT t.till, t.session, t.supervisor, t.expected_initial_cash, t.observed_initial_cash, t.closed, "
+            "COALESCE(SUM(CASE WHEN s.modality = 'cash' THEN s.value END), 0), "
+            "COALESCE(SUM(CASE WHEN s.modality = 'card' THEN s.value END), 0), "
+            "COALESCE(SUM(s.client_count), 0) "
+            "FROM till_session t LEFT JOIN sale s ON s.day = t.day AND s.till = t.till AND s.session = t.session "
+            "WHERE t.day = ? GROUP BY t.till, t.session ORDER BY t.till, t.session", (self.get_day(date),)).fetchall()
+
+        return [{
+            "till": row[0],
+            "session": row[1],
+            "supervisor": row[2],
+            "expected initial cash": row[3],
+            "observed initial cash": row[4],
+            "closed": bool(row[5]),
+            "cash earnings": round(row[6], 2),
+            "card earnings": round(row[7], 2),
+            "client count": row[8],
+            "closing cash": round(row[4] + row[6], 2),
+        } for row in rows]
+
+    def read_records(self, date: QDate) -> List[dict]:
+        """ Get the journal records of the transactions of all tills on the given day. """
+        rows = self.connection.execute("SELECT record FROM sale WHERE day = ? ORDER BY till, session, seq",
+                                       (self.get_day(date),)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def write_day_report(self, date: QDate, catalog: BMCPriceCatalog) -> Path:
+        """ Writes the day's report which merges the sessions of all tills, in the same format as a single till's
+        report, and returns its path. The report is organised by year - month - day in the shared folder. It should
+        only be written once all tills are closed, see close_till, as it would otherwise miss the sales of the tills
+        which are still open.
+
+        A till which worked several sessions starts the day with the initial cash of its first session, and ends it
+        with the closing cash of its last one. The cash count errors of all sessions add up. """
+        sessions = self.read_till_totals(date)
+        first_sessions, last_sessions = dict(), dict()
+        for session in sessions:
+            first_sessions.setdefault(session["till"], session)
+            last_sessions[session["till"]] = session
+        transactions = BMCTransaction.from_transactions_list(
+            catalog, [BMCTransaction.from_journal_record(catalog, record) for record in self.read_records(date)])
+        cash_earnings = round(sum(session["cash earnings"] for session in sessions), 2)
+        card_earnings = round(sum(session["card earnings"] for session in sessions), 2)
+        supervisors = list(dict.fromkeys(session["supervisor"] for session in sessions))
+        session_dict = {
+            "Jour": get_weekday_from_date(date),
+            "Date": date.toString("dd/MM/yyyy"),
+            "Permanent": " et ".join(supervisors),
+            "Caisse début": round(sum(session["observed initial cash"] for session in first_sessions.values()), 2),
+            "Erreur caisse": round(sum(session["expected initial cash"] - session["observed initial cash"]
+                                       for session in sessions), 2),
+            "Total cash": cash_earnings,
+            "Total cartes": card_earnings,
+            "Total rentrées": round(cash_earnings + card_earnings, 2),
+            "# de clients": sum(session["client count"] for session in sessions),
+            "Caisse fin": round(sum(session["closing cash"] for session in last_sessions.values()), 2),
+        }
+        report_path = Path(get_path_to_new_report_file(self.root_dir, date))
+        write_report_file(transactions, session_dict, report_path)
+
+        return report_path
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The register's modules import each other by their flat names, as when the app is run from its own folder
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,43 @@
+import random
+from pathlib import Path
+
+from PyQt5.QtCore import QDate
+
+from benchmark import create_config, create_database
+from engine import BMCRegisterEngine
+from shared_store import BMCSharedSessionStore
+from utils import get_path_to_new_report_file
+
+
+def test_second_session_of_a_till_keeps_the_first_one(tmp_path):
+    """ A till which closes its session and opens a new one on the same day, e.g. when the supervisor changes, keeps
+    the sales and the initial cash count of its first session in the shared store and in the day's merged report. """
+    db_path = tmp_path.joinpath("abo.db")
+    create_database(db_path, 10, random.Random(0))
+    config = create_config(tmp_path, db_path, "1")
+    config["supervisors"] = ["Matin", "Soir"]
+    date = QDate.currentDate()
+
+    for supervisor, cash_count, modality in [("Matin", 100., "cash"), ("Soir", 120., "card")]:
+        engine = BMCRegisterEngine(config)
+        engine.login(date, cash_count, supervisor)
+        engine.ring_item("entrée normale")
+        engine.validate(modality)
+        assert engine.close() == []
+
+    store = BMCSharedSessionStore(tmp_path, "1")
+    sessions = store.read_till_totals(date)
+    assert [session["supervisor"] for session in sessions] == ["Matin", "Soir"]
+    assert [session["observed initial cash"] for session in sessions] == [100., 120.]
+    assert all(session["closed"] for session in sessions)
+    assert [session["cash earnings"] for session in sessions] == [9., 0.]
+    assert [session["card earnings"] for session in sessions] == [0., 9.]
+    assert len(store.read_records(date)) == 2
+    store.close()
+
+    # The day starts with the first session's cash drawer and ends with the last one's
+    report = Path(get_path_to_new_report_file(tmp_path, date)).read_text(encoding="utf-8").splitlines()
+    assert "Permanent;Matin et Soir" in report
+    assert "Caisse début;100.0" in report
+    assert "Caisse fin;120.0" in report
+    assert "Total rentrées;18.0" in report
@@ -1,11 +1,22 @@
 import csv
+import json
 import os
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Tuple
 
 from PyQt5.QtCore import QDate
 from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import QPushButton, QSizePolicy
 
+# Name of the catalog of all report files, which is kept in the reports' root dir
+REPORT_INDEX_FILE_NAME = "reports_index.json"
+# Name of the file which a till creates while it changes the catalog, and after how many seconds the file is considered
+# to be left behind by a till which crashed
+REPORT_INDEX_LOCK_FILE_NAME = "reports_index.lock"
+REPORT_INDEX_LOCK_TIMEOUT = 10.
+
 
 def get_button(name: str, min_width: int, min_height: int, color: str = "#ededed", gradient: int = 10) -> QPushButton:
     """ Wrapper to get a QPushButton easily. """
@@ -139,22 +150,149 @@ def get_path_to_new_report_file(root_dir: Path or str, date: QDate) -> str:
     return new_file_path
 
 
-def get_most_recent_report_path(root_dir: str or Path) -> str:
-    """ Goes through all files in the folder containing all the registry's reports, filters for csv's and returns the
-     path to the most recent report. """
+def read_report_summary(file_path: Path or str) -> dict:
+    """ Given the path to a registry report file_path parses the session data at the top and bottom of the report and
+    returns it as a dict which can be stored in the reports' index. Fields missing from older reports are None. """
+    fields = {"Date": None, "Permanent": None, "Total cash": None, "Total cartes": None, "Total rentrées": None,
+              "# de clients": None, "Caisse fin": None}
+    with open(file_path, encoding='utf-8') as report:
+        csv_reader = csv.reader(report, delimiter=";")
+        for row in csv_reader:
+            if len(row) == 2 and row[0] in fields:
+                fields[row[0]] = row[1].replace("€", "")
+
+    date = None
+    if fields["Date"] is not None:
+        day, month, year = fields["Date"].split("/")
+        date = "{}-{}-{}".format(year, month, day)
+
+    return {
+        "date": date,
+        "supervisor": fields["Permanent"],
+        "cash earnings": float(fields["Total cash"]) if fields["Total cash"] is not None else None,
+        "card earnings": float(fields["Total cartes"]) if fields["Total cartes"] is not None else None,
+        "total earnings": float(fields["Total rentrées"]) if fields["Total rentrées"] is not None else None,
+        "client count": int(fields["# de clients"]) if fields["# de clients"] is not None else None,
+        "closing cash": float(fields["Caisse fin"]) if fields["Caisse fin"] is not None else None,
+    }
+
+
+def read_report_index(root_dir: str or Path) -> dict or None:
+    """ Reads the catalog of all report files in the reports' root dir, or returns None if there is no (readable)
+    catalog. The catalog maps every report's path relative to the root dir to its summary, and keeps track of which
+    report is the most recent one. """
+    index_path = Path(root_dir).joinpath(REPORT_INDEX_FILE_NAME)
+    try:
+        with open(str(index_path), encoding='utf-8') as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_report_index(root_dir: str or Path, index: dict) -> None:
+    """ Writes the catalog of all report files to the reports' root dir. The catalog is written to a temporary file
+    first so that it is never left half written. """
+    index_path = Path(root_dir).joinpath(REPORT_INDEX_FILE_NAME)
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(str(tmp_path), mode="w", encoding='utf-8') as index_file:
+        json.dump(index, index_file, ensure_ascii=False, indent=1)
+    os.replace(str(tmp_path), str(index_path))
+    os.chmod(str(index_path), 0o777)
+
+
+@contextmanager
+def report_index_lock(root_dir: str or Path):
+    """ Holds the lock of the catalog of all report files while the catalog is read, changed and written back, so that
+    tills which share the reports' root dir never lose each other's changes. The lock is a file which only one till can
+    create. A lock which is older than REPORT_INDEX_LOCK_TIMEOUT seconds was left behind by a till which crashed, and is
+    taken over. """
+    lock_path = Path(root_dir).joinpath(REPORT_INDEX_LOCK_FILE_NAME)
+    while True:
+        try:
+            os.close(os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - lock_path.stat().st_mtime > REPORT_INDEX_LOCK_TIMEOUT:
+                    lock_path.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def rebuild_report_index(root_dir: str or Path) -> dict:
+    """ Builds the catalog of all report files by going through all files in the folder containing all the registry's
+    reports. This is only needed when the catalog is missing or out of date. """
     root_dir = Path(root_dir)
-    most_recent_file, most_recent_mod = None, 0.0
+    index = {"latest": None, "reports": {}}
+    most_recent_mod = 0.0
     for file in root_dir.glob("*/*/*.csv"):
-        if file.is_file() and file.stat().st_mtime > most_recent_mod:
-            most_recent_file = file
-            most_recent_mod = file.stat().st_mtime
+        if file.is_file():
+            key = str(file.relative_to(root_dir))
+            mtime = file.stat().st_mtime
+            try:
+                index["reports"][key] = read_report_summary(file)
+            except (OSError, ValueError):
+                continue
+            index["reports"][key]["mtime"] = mtime
+            if mtime > most_recent_mod:
+                index["latest"] = key
+                most_recent_mod = mtime
+
+    return index
+
+
+def update_report_index(root_dir: str or Path, file_path: str or Path, previous_path: str or Path = None) -> None:
+    """ Adds a freshly written report to the catalog of all report files and marks it as the most recent report. If the
+    report was renamed, its previous path can be given to move its entry in the catalog instead. The catalog is read
+    and written back while holding its lock, so that the reports of other tills which are added meanwhile are kept. """
+    root_dir = Path(root_dir)
+    key = str(Path(file_path).relative_to(root_dir))
+    summary = read_report_summary(file_path) if previous_path is None else None
+
+    with report_index_lock(root_dir):
+        index = read_report_index(root_dir)
+        if index is None:
+            index = rebuild_report_index(root_dir)
+
+        if previous_path is not None:
+            previous_key = str(Path(previous_path).relative_to(root_dir))
+            if previous_key in index["reports"]:
+                index["reports"][key] = index["reports"].pop(previous_key)
+            if index["latest"] == previous_key:
+                index["latest"] = key
+        else:
+            index["reports"][key] = summary
+            index["reports"][key]["mtime"] = time.time()
+            index["latest"] = key
+
+        write_report_index(root_dir, index)
+
+
+def get_most_recent_report_entry(root_dir: str or Path) -> Tuple[str, dict]:
+    """ Gets the path to and the summary of the most recent report from the catalog of all report files. The catalog is
+    only rebuilt when it is missing or when the report it points to no longer exists. """
+    root_dir = Path(root_dir)
+    index = read_report_index(root_dir)
+    if index is None or index["latest"] is None or not root_dir.joinpath(index["latest"]).is_file():
+        with report_index_lock(root_dir):
+            index = rebuild_report_index(root_dir)
+            if index["latest"] is not None:
+                write_report_index(root_dir, index)
 
     # Check that the most recent financial report was found
-    if most_recent_file is None:
-        print("Most recent file is none")
+    if index["latest"] is None:
         raise IOError("The most recent financial report file_path was not found in root dir {}".format(root_dir))
 
-    return str(most_recent_file)
+    return str(root_dir.joinpath(index["latest"])), index["reports"][index["latest"]]
 
 
 def get_expected_cash_from_report(file_path: Path or str) -> float or int:
@@ -6,7 +6,9 @@ from PyQt5 import uic
 from PyQt5.QtCore import Qt, QDate, QModelIndex, pyqtSlot
 from PyQt5.QtGui import QKeyEvent, QCloseEvent
 from PyQt5.QtWidgets import QGridLayout, QWidget, QSplitter, QHBoxLayout, QTextBrowser, QApplication, QCompleter, \
-    QSizePolicy, QSpacerItem
+    QSizePolicy, QSpacerItem, QHeaderView
+
+from models import BMCTransactionsTableModel, BMCTransactionsFilterModel
 
 from products import BMCProductsManager
 from utils import get_button, get_fake_label
@@ -24,6 +26,7 @@ class BMCMainWidget(QWidget):
         self.normal_button = get_button("Tarif normal", 200, 70)
         self.discount_button = get_button("Tarif réduit", 200, 70)
         self.member_button = get_button("Abonnement BMC", 200, 70)
+        self.check_in_button = get_button("Check-in abonné", 200, 70)
         self.belt_button = get_button("Baudrier", 200, 70)
         self.belay_button = get_button("Gri-gri", 200, 70)
         self.shoe_button = get_button("Chaussons", 200, 70)
@@ -64,6 +67,7 @@ class BMCMainWidget(QWidget):
         self.normal_button.clicked.connect(lambda: self.controller.update_transaction("entrée normale"))
         self.discount_button.clicked.connect(lambda: self.controller.update_transaction("entrée réduit"))
         self.member_button.clicked.connect(lambda: self.controller.update_transaction("abonnement BMC"))
+        self.check_in_button.clicked.connect(lambda: self.controller.launch_check_in_view())
         self.belt_button.clicked.connect(lambda: self.controller.update_transaction("location baudrier"))
         self.belay_button.clicked.connect(lambda: self.controller.update_transaction("location gri-gri"))
         self.shoe_button.clicked.connect(lambda: self.controller.update_transaction("location chaussons"))
@@ -96,6 +100,7 @@ class BMCMainWidget(QWidget):
         grid.addWidget(self.normal_button, 1, 0)
         grid.addWidget(self.discount_button, 1, 1)
         grid.addWidget(self.member_button, 1, 2)
+        grid.addWidget(self.check_in_button, 1, 3)
         separator = QWidget(minimumHeight=20)
         separator.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
         grid.addWidget(separator, 2, 0)
@@ -236,16 +241,36 @@ class BMCLoginWidget(BMCBaseChildWidget):
 
 
 class BMCHistoryWidget(BMCBaseChildWidget):
-    """ This widget is very simple and just shows the history of this session's transactions, and a resume of the
-    current session. It does nothing else. """
-
-    def __init__(self, controller, transactions, resume):
+    """ This widget is very simple and just shows the history of this session's transactions, which can be filtered on
+    payment modality and sold item, and a resume of the current session. It does nothing else. """
+
+    def __init__(self, controller, session_manager, resume):
+        # The models exist before the base class connects the filters' signals to them
+        self.transactions_model = BMCTransactionsTableModel(session_manager)
+        self.filter_model = BMCTransactionsFilterModel()
+        self.filter_model.setSourceModel(self.transactions_model)
         super(BMCHistoryWidget, self).__init__(controller)
-        self.transactions_browser.setText(transactions)
+        self.transactions_view.setModel(self.filter_model)
+        self.transactions_view.verticalHeader().hide()
+        self.transactions_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.transactions_view.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        self.transactions_view.scrollToBottom()
+
+        self.modality_filter.addItem("Toutes modalités", None)
+        self.modality_filter.addItem("cash", "cash")
+        self.modality_filter.addItem("carte", "card")
+        self.item_filter.addItem("Tous les articles", None)
+        for item in session_manager.get_sold_items():
+            self.item_filter.addItem(item, item)
         self.resume_browser.setText(resume)
 
     def connect_signals_to_slots(self) -> None:
         self.validate_button.clicked.connect(self.validate)
+        self.modality_filter.currentIndexChanged.connect(self.update_filters)
+        self.item_filter.currentIndexChanged.connect(self.update_filters)
+
+    def update_filters(self) -> None:
+        self.filter_model.set_filters(self.modality_filter.currentData(), self.item_filter.currentData())
 
     def build_ui(self) -> None:
         uic.loadUi('resources/history.ui', self)
@@ -296,6 +321,38 @@ class BMCCustomOperationWidget(BMCBaseChildWidget):
         self.close()
 
 
+class BMCCheckInWidget(BMCBaseChildWidget):
+    """ This compact widget checks members in from the code of their membership card, typed or scanned, or from their
+    member number typed after a '#', without opening the abo view. It stays open so that a group of members can be
+    checked in one after the other, and shows the result of the last check-in. """
+
+    def __init__(self, controller):
+        super(BMCCheckInWidget, self).__init__(controller)
+        self.member_field.setFocus()
+
+    def connect_signals_to_slots(self) -> None:
+        self.validate_button.clicked.connect(self.validate)
+        self.close_button.clicked.connect(self.close)
+
+    def build_ui(self) -> None:
+        uic.loadUi('resources/check_in.ui', self)
+
+    def keyPressEvent(self, event: QKeyEvent) -> None:
+        # Keyboard-wedge scanners type the card's code followed by return
+        if event.key() == Qt.Key_Return or event.key() == Qt.Key_Enter:
+            self.validate()
+        elif event.key() == Qt.Key_Escape:
+            self.close()
+
+    def validate(self) -> None:
+        member_code = self.member_field.text().strip()
+        if member_code:
+            self.message_label.setText(self.controller.check_in_member(member_code, self.entries_field.value()))
+            self.member_field.clear()
+            self.entries_field.setValue(1)
+        self.member_field.setFocus()
+
+
 class BMCAboWidget(BMCBaseChildWidget):
     """ This widget enables interactions with the clients and abonnements' database to query and set such data. It can
     spawn 2 different simple child widgets which allow showing suggestions when searching the database, or making a
@@ -333,6 +390,9 @@ class BMCAboWidget(BMCBaseChildWidget):
             uic.loadUi('resources/search_client.ui', self)
 
         def setup_autocompleter(self):
+            # The options are already filtered and ordered by the search, and fuzzy matches do not start with the typed
+            # text, so the completer must show all of them as they are
+            self.completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
             self.completer.setCaseSensitivity(Qt.CaseInsensitive)
             self.completer.activated[QModelIndex].connect(self.completer_activated)
             self.completer.highlighted[QModelIndex].connect(self.completer_highlighted)
@@ -448,6 +508,7 @@ class BMCAboWidget(BMCBaseChildWidget):
         self.on_search_close()
 
     def on_search_close(self) -> None:
+        self.controller.cancel_client_search()
         self.search_widget.close()
         self.setEnabled(True)
 
@@ -492,12 +553,10 @@ class BMCAboWidget(BMCBaseChildWidget):
     def validate_abonnement(self) -> None:
         abo_type = self.get_valid_abonnement_data()[0]
         if abo_type == "3M":
-            self.controller.update_transaction("entrée 3M BMC")
+            self.controller.check_in_abonnement(1)
         elif abo_type == "C10S":
             clicked_spots = self.get_c10s_spots_data()[1]
-            for _ in range(clicked_spots):
-                self.controller.update_transaction("entrée C10S BMC")
-            self.controller.subtract_entries_from_abonnement(clicked_spots)
+            self.controller.check_in_abonnement(clicked_spots)
         else:
             raise RuntimeError("abo_type should be C10S or 3M")
         self.close()
@@ -526,6 +585,7 @@ class BMCAboWidget(BMCBaseChildWidget):
         self.female_button.setChecked(False)
         self.buttonGroup.setExclusive(True)
         self.birthdate_field.setDate(datetime.date(year=1900, month=1, day=1))
+        self.card_code_field.setText(None)
         self.save_button.setText("Créer")
 
     def clear_abonnement_view(self) -> None:
@@ -580,6 +640,9 @@ class BMCAboWidget(BMCBaseChildWidget):
         return first_name, last_name, reduced_price, email, phone, date_of_birth, sex, street_name, street_number, \
             city_zip, city_name, country
 
+    def get_card_code(self):
+        return self.card_code_field.text().strip() or None
+
     def get_valid_abonnement_data(self):
         # Abo type
         if self.abo_type_field.text() == "3M":
@@ -0,0 +1,278 @@
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+def is_busy_error(error: sqlite3.Error) -> bool:
+    """ Tells whether an error means that the db is locked by another connection, e.g. another till or a file sync
+    client, in which case the write can simply be tried again later. """
+    if getattr(error, "sqlite_errorname", None) in ("SQLITE_BUSY", "SQLITE_LOCKED"):
+        return True
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+
+class BMCWriteBehindQueue:
+    """ The BMCWriteBehindQueue takes the updates of clients, abonnements and stocks off the till's hands, so that the
+    till never waits for, or crashes on, a database which is locked by another till or by a file sync client. Every
+    write is first stored in a small local SQLite file, which takes no time and survives a crash, and a background
+    thread then applies the pending writes to their database in batches, each in one transaction. When the database is
+    busy the batch is tried again after a delay which doubles after every failed attempt, up to max_backoff seconds.
+
+    A write can be given a key, in which case a newer write with the same key replaces an older one which is still
+    pending, e.g. two stock updates of the same product. Writes which fail for another reason than a busy database are
+    moved to the failed_write table of the queue's file, and reported by last_error. Any other error, e.g. when the
+    database can not be opened, is counted by error_count and reported by last_error as well, and the batch is tried
+    again after a delay as if the database were busy. Writes which are still pending when the app is closed, or
+    crashes, are applied when the queue is opened again.
+
+    A listener can be added for a database, which is told about every batch of writes once it is committed, e.g. to
+    apply them to a copy of the database, and whether another connection committed to the database meanwhile. """
+
+    def __init__(self, queue_path: Path or str, batch_size: int = 100, busy_timeout: float = 0.1,
+                 min_backoff: float = 0.05, max_backoff: float = 5.):
+        """ Initialize the queue and start its thread.
+
+        queue_path: the local file in which pending writes are stored. It must not be in a synced folder.
+        batch_size: the maximum number of writes applied in one transaction.
+        busy_timeout: how long sqlite itself waits for a lock before a batch counts as failed.
+        min_backoff, max_backoff: the first and the largest delay in seconds before a failed batch is tried again.
+
+        """
+        self.queue_path = Path(queue_path)
+        self.batch_size = batch_size
+        self.busy_timeout = busy_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self._condition = threading.Condition()
+        self._closed = False
+        self._connections: Dict[str, sqlite3.Connection] = dict()
+        self._listeners: Dict[str, object] = dict()
+        # Only used while holding the condition. Each 'with self._queue' block is one transaction
+        self._queue = sqlite3.connect(str(self.queue_path), check_same_thread=False)
+        self._queue.execute("PRAGMA journal_mode=WAL")
+        self._queue.execute("PRAGMA synchronous=NORMAL")
+        self._queue.executescript("""
+            CREATE TABLE IF NOT EXISTS pending_write (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                db_path TEXT NOT NULL,
+                key TEXT,
+                statement TEXT NOT NULL,
+                params TEXT NOT NULL,
+                queued_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS pending_write_key ON pending_write(db_path, key);
+            CREATE TABLE IF NOT EXISTS failed_write (
+                id INTEGER PRIMARY KEY,
+                db_path TEXT NOT NULL,
+                key TEXT,
+                statement TEXT NOT NULL,
+                params TEXT NOT NULL,
+                queued_at REAL NOT NULL,
+                error TEXT NOT NULL);""")
+        self._pending_count = self._queue.execute("SELECT COUNT(*) FROM pending_write").fetchone()[0]
+
+        self.write_count = 0
+        self.batch_count = 0
+        self.retry_count = 0
+        self.failed_count = 0
+        self.error_count = 0
+        self.db_busy = False
+        self.last_error = None
+        self.max_latency = 0.
+
+        self._thread = threading.Thread(target=self._run, name="BMCWriteBehindQueue", daemon=True)
+        self._thread.start()
+
+    # Getters
+    @property
+    def pending_count(self) -> int:
+        """ The number of writes which were not applied to their database yet. """
+        with self._condition:
+            return self._pending_count
+
+    # Methods to manage writes
+    def submit(self, db_path: Path or str, statement: str, params: Tuple, key: str = None) -> None:
+        """ Queue a write of one statement to a database. If a write with the same key is still pending it is dropped in
+        favour of this one. Dates are stored as ISO strings, as sqlite does. """
+        self.submit_many(db_path, [(statement, params, key)])
+
+    def submit_many(self, db_path: Path or str, writes: List[Tuple[str, Tuple, str or None]]) -> None:
+        """ Queue several (statement, params, key) writes to a database at once. """
+        if len(writes) == 0:
+            return
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Can not submit a write to a closed write-behind queue")
+            with self._queue:
+                for statement, params, key in writes:
+                    if key is not None:
+                        self._pending_count -= self._queue.execute(
+                            "DELETE FROM pending_write WHERE db_path = ? AND key = ?", (str(db_path), key)).rowcount
+                    self._queue.execute("INSERT INTO pending_write(db_path, key, statement, params, queued_at) "
+                                        "VALUES(?, ?, ?, ?, ?)",
+                                        (str(db_path), key, statement, json.dumps(params, default=str), time.time()))
+                    self._pending_count += 1
+            self._condition.notify_all()
+
+    def add_listener(self, db_path: Path or str, listener) -> None:
+        """ Adds the listener of a database. Its methods are called on the queue's thread: before_queued_writes before
+        a batch is written, and after_queued_writes(writes, others_committed) with the (statement, params) of the writes
+        of the batch once they are committed. Writes which fail are never passed to it. others_committed tells whether
+        another connection, e.g. another till, committed to the database since before_queued_writes was called. """
+        with self._condition:
+            self._listeners[str(db_path)] = listener
+
+    def flush(self, timeout: float = None) -> bool:
+        """ Blocks until all writes submitted so far have been applied, or until timeout seconds have passed. A batch
+        which is waiting for its next attempt is tried again right away. Returns whether all writes were applied. """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            self._condition.notify_all()
+            while self._pending_count > 0 and not self._closed:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return self._pending_count == 0
+
+    def close(self, timeout: float = 5.) -> None:
+        """ Tries to apply the pending writes for at most timeout seconds, then stops the queue's thread. Writes which
+        are still pending remain in the queue's file. """
+        self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._queue.close()
+
+    # Methods run by the queue's thread
+    def get_connection(self, db_path: str) -> sqlite3.Connection:
+        if db_path not in self._connections:
+            self._connections[db_path] = sqlite3.connect(db_path, timeout=self.busy_timeout, isolation_level=None)
+        return self._connections[db_path]
+
+    def _run(self) -> None:
+        """ The queue's loop which applies the pending writes batch by batch, and waits before trying a batch again when
+        the db is busy. """
+        backoff = self.min_backoff
+        while True:
+            with self._condition:
+                while self._pending_count == 0 and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    break
+                batch = self._queue.execute(
+                    "SELECT id, db_path, statement, params, queued_at FROM pending_write WHERE db_path = "
+                    "(SELECT db_path FROM pending_write ORDER BY id LIMIT 1) ORDER BY id LIMIT ?",
+                    (self.batch_size,)).fetchall()
+                if len(batch) == 0:
+                    self._pending_count = 0
+                    continue
+
+            try:
+                done, error = self._apply(batch), None
+            except Exception as e:
+                traceback.print_exc()
+                done, error = False, e
+                self.error_count += 1
+                self.last_error = e
+            if done:
+                self.db_busy = False
+                backoff = self.min_backoff
+                continue
+
+            # The db is busy, or failed, wait before trying again unless the queue is flushed or closed in the meantime
+            self.db_busy = error is None
+            self.retry_count += 1
+            with self._condition:
+                if not self._closed:
+                    self._condition.wait(backoff)
+            backoff = min(2 * backoff, self.max_backoff)
+
+        # The connections to the dbs belong to this thread
+        for connection in self._connections.values():
+            connection.close()
+
+    def _apply(self, batch: List[Tuple]) -> bool:
+        """ Applies a batch of writes, see _apply_batch, and tells the listener of its db about the ones which were
+        applied before they are removed from the queue, so that the listener is done with them once the queue is
+        flushed. The data version of the queue's connection only changes when another connection commits, which tells
+        the queue's own commits apart from those of other connections. """
+        connection = self.get_connection(batch[0][1])
+        with self._condition:
+            listener = self._listeners.get(batch[0][1])
+        if listener is not None:
+            data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+            listener.before_queued_writes()
+        applied = []
+        done = self._apply_batch(batch, applied)
+        if len(applied) == 0:
+            return done
+
+        # The applied writes are committed, so they are removed from the queue even when the listener fails
+        try:
+            if listener is not None:
+                listener.after_queued_writes([(statement, tuple(json.loads(params)))
+                                              for _, _, statement, params, _ in applied], False)
+                # Checked once the listener is told, so that a commit which came before it is never missed
+                if connection.execute("PRAGMA data_version").fetchone()[0] != data_version:
+                    listener.after_queued_writes([], True)
+        finally:
+            self._remove(applied)
+        return done
+
+    def _apply_batch(self, batch: List[Tuple], applied: List[Tuple]) -> bool:
+        """ Applies a batch of writes to one db in a single transaction, and adds them to applied. Returns False if the
+        db is busy, in which case nothing was applied. When a write fails for another reason, the writes are applied
+        one by one instead, and the ones which fail are set aside. """
+        connection = self.get_connection(batch[0][1])
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for _, _, statement, params, _ in batch:
+                connection.execute(statement, json.loads(params))
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            if is_busy_error(e):
+                return False
+            if len(batch) > 1:
+                for write in batch:
+                    if not self._apply_batch([write], applied):
+                        return False
+                return True
+            traceback.print_exc()
+            self._set_aside(batch[0], e)
+            return True
+
+        applied.extend(batch)
+        return True
+
+    def _remove(self, batch: List[Tuple]) -> None:
+        """ Removes a batch of applied writes from the queue. """
+        with self._condition:
+            with self._queue:
+                self._pending_count -= self._queue.executemany(
+                    "DELETE FROM pending_write WHERE id = ?", [(write[0],) for write in batch]).rowcount
+            now = time.time()
+            self.write_count += len(batch)
+            self.batch_count += 1
+            self.max_latency = max([self.max_latency] + [now - write[4] for write in batch])
+            self._condition.notify_all()
+
+    def _set_aside(self, write: Tuple, error: sqlite3.Error) -> None:
+        """ Moves a write which can not be applied from the pending writes to the failed writes. """
+        with self._condition:
+            with self._queue:
+                self._queue.execute("INSERT INTO failed_write(id, db_path, key, statement, params, queued_at, error) "
+                                    "SELECT id, db_path, key, statement, params, queued_at, ? FROM pending_write "
+                                    "WHERE id = ?", (str(error), write[0]))
+                self._pending_count -= self._queue.execute("DELETE FROM pending_write WHERE id = ?",
+                                                           (write[0],)).rowcount
+            self.failed_count += 1
+            self.last_error = error
+            self._condition.notify_all()
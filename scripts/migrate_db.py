@@ -1,14 +1,33 @@
+import argparse
 import datetime
 import sqlite3
+import sys
 from dateutil.relativedelta import relativedelta
 from apps.register.abonnements import BMCClient, BMCAboDBInterfacer, BMCAbonnement
+from apps.register.db_snapshot import open_analytics_snapshot, take_snapshot
 
-# Connection to the old db and new db
-legacy_connection = sqlite3.connect("/Applications/BMCRegistry/legacy.db")
+parser = argparse.ArgumentParser(description="Upgrades the schema of prod.db to the one the register expects, then "
+                                             "replaces its clients and abonnements by those of legacy.db. Run it while "
+                                             "no till is open.")
+parser.add_argument("--schema-only", action="store_true",
+                    help="only upgrade the schema, and keep the clients and abonnements of prod.db")
+parser.add_argument("--search-index", action="store_true",
+                    help="also add the full text index of the fuzzy client search. Only use it when the sqlite library "
+                         "of every till has the FTS5 extension with the trigram tokenizer, as the other tills can no "
+                         "longer write clients once the index exists")
+args = parser.parse_args()
+
+# Add the columns, indexes, views and tables which the register expects, the tills never change the schema themselves
 interfacer = BMCAboDBInterfacer("/Applications/BMCRegistry/prod.db")
+interfacer.upgrade_schema(search_index=args.search_index)
+if args.schema_only:
+    sys.exit()
+
+# Connection to the old db
+legacy_connection = sqlite3.connect("/Applications/BMCRegistry/legacy.db")
 
 # Wipe the whole new db
-with interfacer.connect_to_db() as connection:
+with interfacer.transaction() as connection:
     cursor = connection.cursor()
     cursor.execute("DELETE FROM abonnement")
     cursor.execute("DELETE FROM client")
@@ -21,37 +40,60 @@ with legacy_connection as connection:
     results = cursor.fetchall()
     interfacer = BMCAboDBInterfacer("/Applications/BMCRegistry/prod.db")
 
-    # For every entry in the old db try to make a client in the new db
+    # Make a client in the new db for every person in the old db, all at once
+    clients = dict()
     for res in results:
         lname = res[0]
         fname = res[1]
-        client = BMCClient(first_name=fname, last_name=lname)
         try:
-            interfacer.create_client(client)
+            client = BMCClient(first_name=fname, last_name=lname)
+            clients[(client.first_name, client.last_name)] = client
         except Exception as e:
             print(e)
             no_errors = False
+    try:
+        client_ids = interfacer.create_clients(list(clients.values()))
+    except Exception as e:
+        print(e)
+        no_errors = False
 
     # If everything went smoothly try to make for every row a new abonnement, regardless off if it is still valid
     if no_errors:
+        abonnements = []
         for res in results:
             lname = res[0].upper()
             fname = res[1].title()
             abo_type = res[3]
-            buy_date = datetime.datetime.strptime(res[4], "%Y-%m-%d").date()
-            gear_included = bool(res[6])
-            end_date = buy_date + relativedelta(months=+3) + relativedelta(days=-1) if abo_type == "3M" else None
-            entrances_remaining = int(res[5]) if abo_type == "C10S" else None
 
             try:
-                client = interfacer.find_client_from_name(last_name=lname, first_name=fname)
-                new_abo = BMCAbonnement(owner=client, abo_type=abo_type, buy_date=buy_date, db_id=None,
+                buy_date = datetime.datetime.strptime(res[4], "%Y-%m-%d").date()
+                gear_included = bool(res[6])
+                end_date = buy_date + relativedelta(months=+3) + relativedelta(days=-1) if abo_type == "3M" else None
+                entrances_remaining = int(res[5]) if abo_type == "C10S" else None
+                new_abo = BMCAbonnement(owner=clients[(fname, lname)], abo_type=abo_type, buy_date=buy_date, db_id=None,
                  include_gear=gear_included, end_date=end_date, entrances_remaining=entrances_remaining)
-                interfacer.create_abonnement(new_abo)
+                abonnements.append(new_abo)
 
             except Exception as e:
                 print(e)
                 print(lname)
                 print(fname)
 
+        try:
+            interfacer.create_abonnements(abonnements, client_ids)
+        except Exception as e:
+            print(e)
 
+# Check the migration against a snapshot of the new db, so that the checks never contend with a till which is open
+take_snapshot("/Applications/BMCRegistry/prod.db", "/Applications/BMCRegistry/analytics.db")
+snapshot = open_analytics_snapshot("/Applications/BMCRegistry/analytics.db")
+legacy_names = {(res[1].title(), res[0].upper()) for res in results}
+client_count = snapshot.execute("SELECT COUNT(*) FROM client").fetchone()[0]
+abonnement_count = snapshot.execute("SELECT COUNT(*) FROM abonnement").fetchone()[0]
+orphan_count = snapshot.execute("SELECT COUNT(*) FROM abonnement WHERE client_id NOT IN (SELECT id FROM client)")\
+    .fetchone()[0]
+print("Clients: {} migrated, {} in the legacy db".format(client_count, len(legacy_names)))
+print("Abonnements: {} migrated, {} in the legacy db".format(abonnement_count, len(results)))
+if orphan_count > 0:
+    print("{} abonnements have no client".format(orphan_count))
+snapshot.close()